@@ -6,24 +6,34 @@ Saves data to a database (file)
 Interfaces "live" events to the host GUI program
 Provides database access for the host GUI program
 
+Commands and queries go to gh_io over the io_ctrl pipe (see gh_rpc).
+Each query carries a request id and gh_io sends the id back with the
+response, so any number of threads can have queries in flight and a late
+response can't be taken as the answer to a later query.
+
 '''
 
 import multiprocessing
 from time import sleep
 from datetime import datetime, timedelta
 import queue
-from threading import Thread
+from itertools import count
+from threading import Thread, Lock
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from process_control import pr_cont
 
 import gh_io
 import gh_db_manager
+from gh_ring import sample_ring
 
 MAX_IO_Q_LEN = 100
+DEFAULT_TRANSPORT = 'queue'  #how samples get from gh_io to gh_db.  See gh_db.__init__
 
 #monitor thread
 class gh_mon(Thread):
     '''__init__
-    io_q=the queue to monitor
+    io_q=the queue (or sample_ring) to monitor.  Each item is a batch (list) of samples
+    consumer_fn=called with each batch
     '''
     def __init__(self,io_q,consumer_fn):
         Thread.__init__(self)
@@ -42,28 +52,126 @@ class gh_mon(Thread):
         self._startup()
         while(self.__running):
             try:
-                op_data=self._io_q.get(timeout=0.1) #wait 100ms max
+                batch=self._io_q.get(timeout=0.1) #wait 100ms max
             except queue.Empty:
                 continue            
             #consume the data using the provided function
-            self._fn(op_data)            
+            self._fn(batch)            
                
     def _startup(self):
         self.__running=True
         pass
         
+#RPC thread for the io_ctrl pipe
+class gh_rpc(Thread):
+    '''__init__
+    io_ctrl=this end of the control pipe to gh_io.  Only this thread
+    reads it
+    Each command is a dict of 'command', 'data' and 'id'.  'id' is None for
+    a command with no response.  gh_io answers every other command with a
+    dict of 'id' and 'data' (the response, which may be None)
+    '''
+    def __init__(self,io_ctrl):
+        Thread.__init__(self)
+        self.daemon=True
+        self._io_ctrl=io_ctrl
+        self._send_lock=Lock()
+        self._pending=dict()   #request id -> Future of the response
+        self._pending_lock=Lock()
+        self._ids=count(1)
+        
+    #sends a command.  req_id is None if no response is wanted
+    def send(self,cmd,data,req_id=None):
+        ctrl_data=dict()
+        ctrl_data['command']=cmd
+        ctrl_data['data']=data
+        ctrl_data['id']=req_id
+        with self._send_lock:
+            self._io_ctrl.send(ctrl_data)
+    
+    '''
+        call
+        Sends a query and returns a concurrent.futures.Future of the
+        response.  Cancel the Future to give up on it.  If gh_io stops
+        before it answers, the Future raises EOFError
+    '''
+    def call(self,cmd,data):
+        fut=Future()
+        with self._pending_lock:
+            req_id=next(self._ids)
+            self._pending[req_id]=fut
+        fut.add_done_callback(lambda fut: self._forget(req_id))
+        try:
+            self.send(cmd,data,req_id)
+        except BaseException:
+            self._forget(req_id)
+            raise
+        return fut
+        
+    def _forget(self,req_id):
+        with self._pending_lock:
+            self._pending.pop(req_id,None)
+    
+    #the number of queries waiting for a response
+    def get_pending(self):
+        with self._pending_lock:
+            return len(self._pending)
+    
+    def run(self):
+        pr_cont.set_name('gh_rpc') #allows process to be idenfified in htop
+        while True:
+            try:
+                reply=self._io_ctrl.recv()
+            except (EOFError,OSError):  #gh_io has gone, or the pipe was closed
+                break
+            with self._pending_lock:
+                fut=self._pending.pop(reply['id'],None)
+            if fut is None:  #it was cancelled, e.g. io_query timed out
+                print('gh_rpc: Dropped late response to request',reply['id'])
+                continue
+            if fut.set_running_or_notify_cancel():
+                fut.set_result(reply['data'])
+        #fail anything still waiting
+        with self._pending_lock:
+            pending=list(self._pending.values())
+            self._pending.clear()
+        for fut in pending:
+            if fut.set_running_or_notify_cancel():
+                fut.set_exception(EOFError('gh_rpc: io_ctrl closed'))
+        
 #START class gh_db-------------------------------------
 class gh_db:
-    def __init__(self):
-        self._io_q=multiprocessing.Queue(MAX_IO_Q_LEN)
+    '''__init__
+    Optional kwargs:-
+    io_batch_delay - max seconds gh_io holds a sample before sending it.
+                     See gh_io.IO_BATCH_DELAY
+    transport - 'queue' to send the samples through a multiprocessing.Queue
+                of MAX_IO_Q_LEN batches
+                'ring' to send them through shared memory.  See gh_ring
+    commit_delay - max seconds a sample waits before it is committed to the
+                   database.  See gh_db_manager.DEFAULT_COMMIT_DELAY
+    '''
+    def __init__(self,**kwargs):
+        self._commit_delay=kwargs.get('commit_delay',gh_db_manager.DEFAULT_COMMIT_DELAY)
+        self._transport=kwargs.get('transport',DEFAULT_TRANSPORT)
+        if self._transport=='ring':
+            self._io_q=sample_ring()
+            self._io_q_max=self._io_q.get_capacity()  #samples
+        else:
+            self._io_q=multiprocessing.Queue(MAX_IO_Q_LEN)
+            self._io_q_max=MAX_IO_Q_LEN               #batches
         (self._io_ctrl,self.__io_ctrl_gh_io)=multiprocessing.Pipe()  #not end b only used by gh_io end
+        batch_delay=kwargs.get('io_batch_delay',gh_io.IO_BATCH_DELAY)
         self._gh_io_process=\
-            multiprocessing.Process(name="gh_io process",target=gh_io.gh_io_main,args=(self.get_io_q(),self.__io_ctrl_gh_io))            
+            multiprocessing.Process(name="gh_io process",target=gh_io.gh_io_main,\
+                                    args=(self.get_io_q(),self.__io_ctrl_gh_io,batch_delay))            
         self._gh_io_process.daemon=True
         self._gh_mon=gh_mon(self.get_io_q(),self._consumer_fn)
+        self._rpc=gh_rpc(self._io_ctrl)
                 
     def start_io(self):
         self._gh_io_process.start()  #start IO process
+        self._rpc.start()
         self._init_db_manager()          #wait for this to complete - can be slow
         self.send_io_command('START',0)  #This starts the threads
         print("gh_db: IO Started.")
@@ -74,59 +182,93 @@ class gh_db:
     '''
     def _init_db_manager(self):
         io_desc=self.io_query('OPDESC?',0,15)  #command,data,timeout - need long timeout if using spawn instead of fork
-        self._db_manager=gh_db_manager.gh_db_manager(all_op_desc=io_desc)
+        self._series=self.io_query('SERIES?',0,15)
+        self._db_manager=gh_db_manager.gh_db_manager(all_op_desc=io_desc,series=self._series,\
+                                                     commit_delay=self._commit_delay)
     
     def get_db_manager(self):
         return self._db_manager
     
+    #returns the (tname,pname) of each series id.  See io_thread.IO_Sample
+    def get_series(self):
+        return self._series
+    
     #this is the despatch function.  It is called by the thread
-    #every time data is received in the io_q
+    #every time a batch (list of IO_Sample) is received in the io_q
     #you can override this in a derived method for your preferred behaviour
-    def _consumer_fn(self,data):
-        #print("gh_db._consumer_fn: data=",data)
-        self._save_to_db(data)
+    def _consumer_fn(self,batch):
+        #print("gh_db._consumer_fn: batch=",batch)
+        self._save_to_db(batch)
         
     #add function here to save the data to the database
-    def _save_to_db(self,data):
-        self._db_manager.process_data(data)
+    def _save_to_db(self,batch):
+        self._db_manager.process_batch(batch)
         
     def start_events(self):
         self._gh_mon.start()  #start receiving thread
     
     def send_io_command(self,cmd,data):
-        ctrl_data=dict()
-        ctrl_data['command']=cmd
-        ctrl_data['data']=data
-        self._io_ctrl.send(ctrl_data)
+        self._rpc.send(cmd,data)
     
     #Query command.  timeout is max time to wait in seconds
+    #Returns the response, or None if there isn't one in time.  It can be
+    #called from any thread.  It only waits for its own response
     def io_query(self,cmd,data,timeout):
-        self.send_io_command(cmd,data)
-        if self._io_ctrl.poll(timeout):
-            rx_data=self._io_ctrl.recv()
-        else:
-            rx_data=None
-        return rx_data
+        fut=self.io_query_async(cmd,data)
+        try:
+            return fut.result(timeout)
+        except FutureTimeoutError:
+            fut.cancel()  #so a late response is dropped
+            return None
+        except EOFError:
+            return None
+    
+    #As io_query, but returns a concurrent.futures.Future of the response
+    #straight away.  See gh_rpc.call
+    #DB: queries are answered here - the database isn't in the gh_io process
+    def io_query_async(self,cmd,data):
+        if cmd=='DB:STATS?':
+            fut=Future()
+            fut.set_result(self.get_db_stats())
+            return fut
+        return self._rpc.call(cmd,data)
     
     def stop_io(self):
         #send the stop signal and wait for IO process to stop
         self.send_io_command('TERMINATE',0)
         self._gh_io_process.join()
         
-        #shut down both ends of the pipe
-        self._io_ctrl.close()
+        #shut down both ends of the pipe.  Closing gh_io's end first ends
+        #the rpc thread's recv()
         self.__io_ctrl_gh_io.close()
+        self._rpc.join()
+        self._io_ctrl.close()
         
         #stop the monitoring thread
         self._gh_mon.term()
         self._gh_mon.join()
+        if self._transport=='ring':
+            self._io_q.close()
+            self._io_q.unlink()
         print("gh_db: IO Stopped.")
         
-        #flush all data to disk
-        self._db_manager.commit_all()
+        #flush all data to disk and stop the writer
+        self._db_manager.close()
         
     def get_io_q(self):
         return self._io_q
+    
+    #returns gh_db_manager.get_stats() plus how full io_q is (in batches, or
+    #samples for the ring).  If the writer stalls (e.g. a slow fsync) io_q
+    #fills up and gh_io has to wait
+    def get_db_stats(self):
+        stats=self._db_manager.get_stats()
+        try:
+            size=self._io_q.qsize()
+        except NotImplementedError:  #not available on macOS
+            size=None
+        stats['io_q']={'queue':size,'queue_max':self._io_q_max}
+        return stats
 #START class gh_db-------------------------------------
 
 def gh_db_test():
@@ -156,4 +298,4 @@ def gh_db_test():
 
 if __name__ == "__main__":   
     multiprocessing.set_start_method('spawn')
-    gh_db_test()
\ No newline at end of file
+    gh_db_test()
\ No newline at end of file
@@ -0,0 +1,362 @@
+'''
+gh_db_archive
+
+Compressed archive files for old raw data
+
+Once a month is over and has been compressed into comp_data its raw data
+never changes, so it is moved out of raw_data into one archive file per
+month.  Values are already integers (see param_db.compress_val) and
+samples come at a near steady rate, so they pack down to a few bits each
+with Gorilla style encoding:-
+timestamp - delta of the delta from the previous sample, usually 0
+val - delta from the previous value, usually small
+Both are zig-zag encoded (so small negative numbers are small too) and
+written as varints (7 bits per byte, top bit set on all but the last).
+
+The samples are split into blocks of ARCHIVE_BLOCK samples.  Each block
+starts again from an absolute timestamp and value, so it can be decoded
+on its own.  An index of the blocks (first and last timestamp, offset and
+count) is kept at the end of the file, so a range read only decodes the
+blocks that overlap it.  Decoding is done a block at a time (see
+iter_range()) so a whole month is never held in memory.
+
+File layout:-
+MAGIC
+blocks
+index - one BLOCK_ENTRY per block
+trailer - TRAILER (month start, month end, index offset, number of blocks)
+
+Run this module to benchmark encoding and decoding
+'''
+import os
+import struct
+import threading
+from bisect import bisect_left, bisect_right
+
+ARCHIVE_BLOCK=1024     #samples in one block
+MAGIC=b'GHA1'
+BLOCK_ENTRY=struct.Struct('<qqQI')  #(Tfirst,Tlast,offset,n)
+TRAILER=struct.Struct('<qqQI')      #(Tstart,Tend,index offset,nblocks)
+
+#zig-zag encoding maps 0,-1,1,-2,2... to 0,1,2,3,4...
+def zigzag(n):
+    return n<<1 if n>=0 else ((-n)<<1)-1
+
+def unzigzag(u):
+    return (u>>1)^-(u&1)
+
+def put_varint(out,u):
+    while u>=0x80:
+        out.append((u&0x7f)|0x80)
+        u=u>>7
+    out.append(u)
+
+#encodes a list of (timestamp,val) integer pairs as one block
+def encode_block(rows):
+    out=bytearray()
+    (Tprev,vprev)=rows[0]
+    put_varint(out,zigzag(Tprev))
+    put_varint(out,zigzag(vprev))
+    dprev=0
+    for (ts,val) in rows[1:]:
+        delta=ts-Tprev
+        put_varint(out,zigzag(delta-dprev))
+        put_varint(out,zigzag(val-vprev))
+        (Tprev,vprev,dprev)=(ts,val,delta)
+    return out
+
+'''
+    decode_block
+    Returns the n (timestamp,val) pairs in buf.
+    The varint reading is written out inline as it is the slow part
+'''
+def decode_block(buf,n):
+    rows=[]
+    pos=0
+    ts=0
+    val=0
+    delta=0
+    for i in range(n):
+        #timestamp (or delta of delta)
+        u=0
+        shift=0
+        while True:
+            b=buf[pos]
+            pos=pos+1
+            u=u|((b&0x7f)<<shift)
+            if b<0x80:
+                break
+            shift=shift+7
+        d=(u>>1)^-(u&1)
+        #value (or delta)
+        u=0
+        shift=0
+        while True:
+            b=buf[pos]
+            pos=pos+1
+            u=u|((b&0x7f)<<shift)
+            if b<0x80:
+                break
+            shift=shift+7
+        v=(u>>1)^-(u&1)
+        if i==0:
+            ts=d
+            val=v
+        else:
+            delta=delta+d
+            ts=ts+delta
+            val=val+v
+        rows.append((ts,val))
+    return rows
+
+'''archive_file
+One month.  Use write() to create it and archive_file(path) to read it
+'''
+class archive_file:
+    def __init__(self,path):
+        self.path=path
+        with open(path,'rb') as f:
+            if f.read(len(MAGIC))!=MAGIC:
+                raise ValueError('gh_db_archive: Not an archive file '+path)
+            f.seek(-TRAILER.size,os.SEEK_END)
+            (self.Tstart,self.Tend,index_offset,nblocks)=TRAILER.unpack(f.read(TRAILER.size))
+            f.seek(index_offset)
+            index=f.read(nblocks*BLOCK_ENTRY.size)
+        self._blocks=[BLOCK_ENTRY.unpack_from(index,i*BLOCK_ENTRY.size) for i in range(nblocks)]
+        self._Tfirsts=[blk[0] for blk in self._blocks]
+        self._Tlasts=[blk[1] for blk in self._blocks]
+        self._index_offset=index_offset
+        self.n=sum(blk[3] for blk in self._blocks)
+
+    '''
+        write
+        Writes the (timestamp,val) rows of the month Tstart..Tend (Tend is
+        the start of the next month) to path.  rows can be any iterable,
+        e.g. a cursor.  Each block is encoded and written as soon as its
+        rows have arrived, so only one block is held in memory.
+        The file is written under a temporary name and renamed, so it
+        never exists half written.
+        Returns the number of rows written
+    '''
+    @staticmethod
+    def write(path,Tstart,Tend,rows):
+        tmp=path+'.tmp'
+        with open(tmp,'wb') as f:
+            f.write(MAGIC)
+            offset=len(MAGIC)
+            index=bytearray()
+            n=0
+            block=[]
+            for row in rows:
+                block.append(row)
+                if len(block)==ARCHIVE_BLOCK:
+                    offset=archive_file._write_block(f,offset,index,block)
+                    n=n+len(block)
+                    block=[]
+            if len(block)>0:
+                offset=archive_file._write_block(f,offset,index,block)
+                n=n+len(block)
+            f.write(index)
+            f.write(TRAILER.pack(Tstart,Tend,offset,len(index)//BLOCK_ENTRY.size))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp,path)
+        return n
+    
+    #writes block at offset in f and adds it to index.  Returns the offset
+    #of the next block
+    @staticmethod
+    def _write_block(f,offset,index,block):
+        data=encode_block(block)
+        f.write(data)
+        index.extend(BLOCK_ENTRY.pack(block[0][0],block[-1][0],offset,len(block)))
+        return offset+len(data)
+
+    #decodes block k from open file f
+    def _read_block(self,f,k):
+        (Tfirst,Tlast,offset,n)=self._blocks[k]
+        end=self._blocks[k+1][2] if k+1<len(self._blocks) else self._index_offset
+        f.seek(offset)
+        return decode_block(f.read(end-offset),n)
+    
+    #yields the (timestamp,val) pairs between Tstart and Tstop inclusive
+    def iter_range(self,Tstart,Tstop):
+        k=bisect_left(self._Tlasts,Tstart)
+        if k>=len(self._blocks):
+            return
+        with open(self.path,'rb') as f:
+            for (Tfirst,Tlast,offset,n) in self._blocks[k:]:
+                if Tfirst>Tstop:
+                    return
+                rows=self._read_block(f,k)
+                k=k+1
+                if Tfirst>=Tstart and Tlast<=Tstop:
+                    yield from rows
+                else:
+                    for row in rows:
+                        if Tstart<=row[0]<=Tstop:
+                            yield row
+
+    #returns the last (timestamp,val) at or before T, or None.  Only one
+    #block is decoded
+    def get_last_at(self,T):
+        k=bisect_right(self._Tfirsts,T)-1
+        if k<0:
+            return None
+        with open(self.path,'rb') as f:
+            rows=self._read_block(f,k)
+        return rows[bisect_right(rows,(T,float('inf')))-1]
+
+'''archive_store
+All the archive files of one series, one per month, in directory dirname.
+The directory is only created when the first month is archived.
+The methods can be called from any thread.
+With read_only=True files left by a crash (or being written) are left
+alone.  Only the read methods can be used then
+'''
+class archive_store:
+    def __init__(self,dirname,read_only=False):
+        self._dirname=dirname
+        self._lock=threading.Lock()
+        self._files=[]
+        if os.path.isdir(dirname):
+            for fname in sorted(os.listdir(dirname)):
+                if fname.endswith('.gar'):
+                    self._files.append(archive_file(os.path.join(dirname,fname)))
+                elif fname.endswith('.tmp') and not read_only:
+                    os.remove(os.path.join(dirname,fname))  #left by a crash in write()
+
+    #end of the last archived month (everything before it is archived), or 0
+    def get_end(self):
+        with self._lock:
+            return self._files[-1].Tend if len(self._files)>0 else 0
+
+    #archives the rows of the month Tstart..Tend and returns the number
+    #written.  See archive_file.write
+    def write_month(self,Tstart,Tend,rows):
+        os.makedirs(self._dirname,exist_ok=True)
+        path=os.path.join(self._dirname,'%016d.gar' % Tstart)
+        n=archive_file.write(path,Tstart,Tend,rows)
+        afile=archive_file(path)
+        with self._lock:
+            self._files.append(afile)
+        return n
+
+    '''
+        merge_month
+        Adds rows (sorted by timestamp) to the month Tstart..Tend, which
+        may or may not be archived already.  Where a timestamp is already
+        in the archive the archived sample is kept.  The whole file is
+        rewritten, so this is for imports (see param_db.bulk_load) while
+        nothing is reading the archive.
+        Returns the number of rows added
+    '''
+    def merge_month(self,Tstart,Tend,rows):
+        os.makedirs(self._dirname,exist_ok=True)
+        path=os.path.join(self._dirname,'%016d.gar' % Tstart)
+        with self._lock:
+            files=[afile for afile in self._files if afile.path==path]
+        merged=dict(rows)
+        nold=0
+        for afile in files:
+            old=dict(afile.iter_range(Tstart,Tend-1))
+            nold=len(old)
+            merged.update(old)
+        rows=sorted(merged.items())
+        archive_file.write(path,Tstart,Tend,rows)
+        afile=archive_file(path)
+        with self._lock:
+            self._files=[f for f in self._files if f.path!=path]
+            k=bisect_left([f.Tstart for f in self._files],Tstart)
+            self._files.insert(k,afile)
+        return len(rows)-nold
+
+    #yields the (timestamp,val) pairs between Tstart and Tstop inclusive
+    def iter_range(self,Tstart,Tstop):
+        with self._lock:
+            files=[afile for afile in self._files if afile.Tend>Tstart and afile.Tstart<=Tstop]
+        for afile in files:
+            yield from afile.iter_range(Tstart,Tstop)
+
+    def read(self,Tstart,Tstop):
+        return list(self.iter_range(Tstart,Tstop))
+
+    #returns a list of the archive file paths
+    def get_files(self):
+        with self._lock:
+            return [afile.path for afile in self._files]
+
+    #returns the last (timestamp,val) at or before T, or None
+    def get_last_at(self,T):
+        with self._lock:
+            files=[afile for afile in self._files if afile.Tstart<=T]
+        for afile in reversed(files):
+            row=afile.get_last_at(T)
+            if row is not None:
+                return row
+        return None
+    
+    '''
+        drop_before
+        Deletes the oldest month if it ends at or before Tlimit.
+        Returns the number of samples deleted
+    '''
+    def drop_before(self,Tlimit):
+        with self._lock:
+            if len(self._files)==0 or self._files[0].Tend>Tlimit:
+                return 0
+            afile=self._files.pop(0)
+        os.remove(afile.path)
+        return afile.n
+
+if __name__=='__main__':
+    #benchmark - one month of 5s samples with some jitter and dropouts
+    import random
+    import sqlite3
+    import tempfile
+    from time import perf_counter
+    random.seed(1)
+    rows=[]
+    ts=1767225600000
+    val=2000
+    while len(rows)<31*24*720:
+        ts=ts+5000+random.choice([0,0,0,0,1,-1,2])
+        if random.random()<0.001:
+            ts=ts+random.randint(10,600)*1000   #dropout
+        val=val+random.choice([-2,-1,0,0,0,1,2])
+        rows.append((ts,val))
+    tmpdir=tempfile.mkdtemp()
+    path=os.path.join(tmpdir,'bench.gar')
+    t0=perf_counter()
+    archive_file.write(path,rows[0][0],rows[-1][0]+1,rows)
+    t_enc=perf_counter()-t0
+    size=os.path.getsize(path)
+    dbpath=os.path.join(tmpdir,'bench.db')
+    con=sqlite3.connect(dbpath)
+    con.execute('CREATE TABLE raw_data (timestamp integer PRIMARY KEY, val integer)')
+    con.executemany('INSERT INTO raw_data VALUES (?,?)',rows)
+    con.commit()
+    con.close()
+    db_size=os.path.getsize(dbpath)
+    afile=archive_file(path)
+    t0=perf_counter()
+    n=0
+    for row in afile.iter_range(0,2**62):
+        n=n+1
+    t_dec=perf_counter()-t0
+    assert list(afile.iter_range(0,2**62))==rows
+    Tmid=rows[len(rows)//2][0]
+    t0=perf_counter()
+    nseeks=200
+    for i in range(nseeks):
+        part=list(afile.iter_range(Tmid+i*60000,Tmid+i*60000+3600*1000))
+    t_seek=(perf_counter()-t0)/nseeks
+    print('samples              ',len(rows))
+    print('archive size         ',size,'bytes (%.2f bytes/sample)' % (size/len(rows)))
+    print('sqlite raw_data size ',db_size,'bytes (%.1fx archive)' % (db_size/size))
+    print('encode               %.0f samples/s' % (len(rows)/t_enc))
+    print('decode               %.0f samples/s' % (n/t_dec))
+    print('1 hour range read    %.2f ms' % (t_seek*1000))
+    os.remove(path)
+    os.remove(dbpath)
+    os.rmdir(tmpdir)
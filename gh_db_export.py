@@ -0,0 +1,229 @@
+'''
+gh_db_export
+
+Exports series to columnar files for offline analysis (pandas, polars,
+duckdb...), so nothing has to open the db files or undo their scaling.
+One file holds any number of series in long format, one row per sample:-
+tname, pname - the series
+timestamp - UTC.  A timestamp[ms] column in Parquet and Arrow files, an
+            ISO 8601 date/time in CSV files
+val - for raw_data, or
+avg, min, max - for comp_data and the rollup tiers
+Values are in the units of the parameter (de-scaled by val_comp_mult).
+
+The format comes from the file extension:-
+.parquet - Parquet.  Needs pyarrow
+.arrow, .feather - Arrow IPC file.  Needs pyarrow
+.csv - CSV with a header line
+
+Rows are read a window at a time (param_db.iter_export) and written
+EXPORT_BATCH rows at a time (one Parquet row group or Arrow record batch),
+so memory use doesn't depend on how much is exported.  The file is
+written under a temporary name and renamed once complete.
+
+Use gh_db_manager.export() while the system is running, or from the
+command line:-
+
+python gh_db_export.py [--table raw_data] [--series tname/pname ...] [--start ISO] [--stop ISO] file
+
+The command line opens the databases itself, read only, so it is safe to
+run alongside the system but only sees what the system has committed.
+The series and their raw backends come from the manifest.
+'''
+import os
+import csv
+import json
+import argparse
+from datetime import datetime, timezone
+from time import monotonic
+
+try:
+    import pyarrow as pa    #optional - only needed for Parquet and Arrow files
+    import pyarrow.parquet as pq
+    _pyarrow_ok=True
+except ImportError:
+    _pyarrow_ok=False
+
+EXPORT_BATCH=65536   #rows per Parquet row group / Arrow record batch
+
+FORMATS={'.parquet':'parquet','.arrow':'arrow','.feather':'arrow','.csv':'csv'}
+
+#returns the format of fname from its extension, or None
+def get_format(fname):
+    return FORMATS.get(os.path.splitext(fname)[1].lower(),None)
+
+#returns the value columns of table
+def get_columns(table):
+    if table=='raw_data':
+        return ['val']
+    return ['avg','min','max']
+
+'''export_writer
+Writes rows of any number of series to one file.  Call write() for each
+list of rows of a series and close() at the end, or abort() to delete
+the file.  fmt is 'parquet', 'arrow' or 'csv'
+'''
+class export_writer:
+    def __init__(self,fname,fmt,columns):
+        self._fname=fname
+        self._tmp=fname+'.tmp'
+        self._fmt=fmt
+        self._columns=columns
+        self._buf=[]      #(tname,pname,rows) waiting to be written
+        self._nbuf=0
+        self.n=0
+        if fmt=='csv':
+            self._file=open(self._tmp,'w',newline='')
+            self._csv=csv.writer(self._file)
+            self._csv.writerow(['tname','pname','timestamp']+columns)
+            return
+        fields=[('tname',pa.string()),('pname',pa.string()),('timestamp',pa.timestamp('ms',tz='UTC'))]
+        fields.extend((col,pa.float64()) for col in columns)
+        self._schema=pa.schema(fields)
+        if fmt=='parquet':
+            self._writer=pq.ParquetWriter(self._tmp,self._schema)
+        else:
+            self._writer=pa.ipc.new_file(self._tmp,self._schema)
+
+    #rows is a list of (ms timestamp,value...) of series tname/pname
+    def write(self,tname,pname,rows):
+        if len(rows)==0:
+            return
+        self.n=self.n+len(rows)
+        if self._fmt=='csv':
+            for row in rows:
+                ts=datetime.fromtimestamp(row[0]/1000,timezone.utc).isoformat(timespec='milliseconds')
+                self._csv.writerow((tname,pname,ts)+row[1:])
+            return
+        self._buf.append((tname,pname,rows))
+        self._nbuf=self._nbuf+len(rows)
+        if self._nbuf>=EXPORT_BATCH:
+            self._flush()
+
+    #writes the buffered rows as one record batch
+    def _flush(self):
+        if self._nbuf==0:
+            return
+        (tnames,pnames)=([],[])
+        columns=[[] for i in range(len(self._columns)+1)]
+        for (tname,pname,rows) in self._buf:
+            tnames.extend([tname]*len(rows))
+            pnames.extend([pname]*len(rows))
+            for (col,values) in zip(columns,zip(*rows)):
+                col.extend(values)
+        arrays=[pa.array(tnames,pa.string()),pa.array(pnames,pa.string())]
+        arrays.extend(pa.array(col,field.type) for (col,field) in zip(columns,list(self._schema)[2:]))
+        batch=pa.record_batch(arrays,schema=self._schema)
+        if self._fmt=='parquet':
+            self._writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+        self._buf=[]
+        self._nbuf=0
+
+    def close(self):
+        if self._fmt=='csv':
+            self._file.close()
+        else:
+            self._flush()
+            self._writer.close()
+        os.replace(self._tmp,self._fname)
+
+    def abort(self):
+        try:
+            if self._fmt=='csv':
+                self._file.close()
+            else:
+                self._writer.close()
+        finally:
+            os.remove(self._tmp)
+
+'''
+    export_dbs
+    Writes table of each of pdbs (a list of ((tname,pname),param_db))
+    between Tstart and Tstop to fname.  See gh_db_manager.export.
+    Returns the number of rows written, or None if the file couldn't be
+    written
+'''
+def export_dbs(fname,pdbs,Tstart,Tstop,table='raw_data'):
+    fmt=get_format(fname)
+    if fmt is None:
+        print('gh_db_export: Unknown format ',fname,' - use ',', '.join(FORMATS))
+        return None
+    if fmt!='csv' and not _pyarrow_ok:
+        print('gh_db_export: pyarrow is needed to write ',fname,' (pip install pyarrow), or use .csv')
+        return None
+    for (key,pdb) in pdbs:
+        if table!='raw_data' and table not in dict(pdb.get_tiers()):
+            print('gh_db_export: ',key[0],'/',key[1],' has no table ',table)
+            return None
+    t0=monotonic()
+    writer=export_writer(fname,fmt,get_columns(table))
+    try:
+        for ((tname,pname),pdb) in pdbs:
+            for rows in pdb.iter_export(table,Tstart,Tstop):
+                writer.write(tname,pname,rows)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    print('gh_db_export: ',fname,': ',writer.n,' rows of ',len(pdbs),' series in %.1fs' % (monotonic()-t0))
+    return writer.n
+
+#returns the raw backend of a series from its manifest entry.  Manifests
+#saved before it was added there are checked for the raw files instead.
+#base is the path of the series files without the suffix
+def get_raw_backend(entry,base):
+    if 'raw_backend' in entry:
+        return entry['raw_backend']
+    if os.path.isdir(base+'-raw'):
+        return 'segment'
+    if os.path.isdir(base+'-parts'):
+        return 'partition'
+    return 'sqlite'
+
+if __name__=='__main__':
+    import gh_db_manager
+    parser=argparse.ArgumentParser(description='Export series from the greenhouse databases')
+    parser.add_argument('file',help='file to write - .parquet, .arrow or .csv')
+    parser.add_argument('--table',default='raw_data',help='raw_data, comp_data or a rollup tier table e.g. comp_data_1h')
+    parser.add_argument('--series',nargs='+',help='tname/pname of each series to export (default all)')
+    parser.add_argument('--start',help='ISO 8601 date/time of the first sample (default the first)')
+    parser.add_argument('--stop',help='ISO 8601 date/time of the last sample (default now)')
+    parser.add_argument('--backend',choices=['file','shared'],default=gh_db_manager.DEFAULT_BACKEND)
+    args=parser.parse_args()
+    Tstart=0 if args.start is None else gh_db_manager.datetime_to_timestamp(datetime.fromisoformat(args.start))
+    Tstop=gh_db_manager.datetime_to_timestamp(datetime.now() if args.stop is None else datetime.fromisoformat(args.stop))
+    #the series and their meta_data come from the manifest, so the system must have run with them
+    try:
+        with open(gh_db_manager.DB_DIR+gh_db_manager.MANIFEST_NAME % args.backend,'r') as f:
+            manifest=json.load(f)
+    except (OSError,ValueError):
+        manifest=dict()
+    if args.series is None:
+        series=[(tname,pname) for tname in manifest for pname in manifest[tname]]
+    else:
+        series=[tuple(name.split('/',1)) for name in args.series]
+    store=gh_db_manager.shared_store(read_only=True) if args.backend=='shared' else None
+    pdbs=[]
+    for (tname,pname) in series:
+        entry=manifest.get(tname,dict()).get(pname,None)
+        if entry is None:
+            print('gh_db_export: Skipping ',tname,'/',pname,' - no such series')
+            continue
+        raw_backend=get_raw_backend(entry,gh_db_manager.DB_DIR+(tname+'-'+pname).replace(' ','-'))
+        if store is not None:
+            pdbs.append(((tname,pname),gh_db_manager.series_db(tname=tname,pname=pname,op_desc=entry['meta_data'],\
+                                                              raw_backend=raw_backend,manifest=entry,\
+                                                              read_only=True,store=store)))
+        else:
+            pdbs.append(((tname,pname),gh_db_manager.param_db(tname=tname,pname=pname,op_desc=entry['meta_data'],\
+                                                             raw_backend=raw_backend,manifest=entry,\
+                                                             read_only=True)))
+    try:
+        export_dbs(args.file,pdbs,Tstart,Tstop,args.table)
+    finally:
+        for (key,pdb) in pdbs:
+            pdb.close()
+        if store is not None:
+            store.close()
@@ -0,0 +1,263 @@
+'''
+gh_db_import
+
+Imports historical readings (e.g. from a previous logger) into the
+param_db files.  Run it while the greenhouse application is stopped:-
+
+python gh_db_import.py [options] file [file...]
+
+Formats (--format):-
+csv - one reading per line.  With --series tname/pname the columns are
+      timestamp,value, otherwise tname,pname,timestamp,value.  A header
+      line is skipped
+line - InfluxDB line protocol:-
+       measurement[,tag=x...] field=value[,field=value...] timestamp
+       The measurement is the tname and each numeric field a pname.  Tags
+       are ignored, as are lines without a timestamp.  Escaped spaces and
+       commas are not supported.  Timestamps are in --precision units
+
+CSV timestamps (--time):-
+auto - a number is ms if it is over 1e11, otherwise seconds.  Anything
+       else is an ISO 8601 date/time (local time unless it has an offset)
+s, ms - seconds or ms since 1/1/1970
+iso - ISO 8601 date/time
+
+The files are streamed.  Only IMPORT_BUFFER readings per series are held
+in memory, and they are written with param_db.bulk_load().  At the end
+the comp_data chunks that readings went into and the rollups are rebuilt
+once per series with param_db.rebuild_tiers(), and compact() compresses
+anything after the end of the existing data.  Chunks from before the
+oldest raw data that already have comp_data are left as they are, as
+their raw data has been pruned (see param_db.rebuild_tiers).
+
+A series must already exist - be in the manifest written by
+gh_db_manager, so the application has run with it at least once - unless
+--ptype is given, in which case it is created with that ptype.
+'''
+import os
+import csv
+import json
+import sqlite3
+import argparse
+from datetime import datetime
+from time import monotonic
+import gh_db_manager
+
+IMPORT_BUFFER=100000   #readings held per series before they are bulk loaded
+MAX_BAD_LINES=10       #bad lines reported per file.  The rest are only counted
+
+PRECISION={'ns':(1,1000000),'us':(1,1000),'ms':(1,1),'s':(1000,1)}  #(mult,div) to ms
+
+#returns the ms timestamp of text.  See --time
+def parse_time(text,mode='auto'):
+    if mode=='ms':
+        return int(float(text))
+    if mode=='s':
+        return round(float(text)*1000)
+    if mode=='iso':
+        return round(datetime.fromisoformat(text).timestamp()*1000)
+    try:
+        t=float(text)
+    except ValueError:
+        return parse_time(text,'iso')
+    return round(t) if t>1e11 else round(t*1000)
+
+#returns a list of (tname,pname,ms timestamp,value) for one line of line protocol
+def parse_line_protocol(line,precision='ns'):
+    parts=line.split()
+    if len(parts)<3 or parts[0].startswith('#'):
+        return []
+    tname=parts[0].split(',')[0]
+    (mult,div)=PRECISION[precision]
+    ts=int(parts[2])*mult//div
+    readings=[]
+    for field in parts[1].split(','):
+        (pname,sep,val)=field.partition('=')
+        if val.endswith('i'):
+            val=val[:-1]   #integer field
+        try:
+            readings.append((tname,pname,ts,float(val)))
+        except ValueError:
+            pass   #string or boolean field
+    return readings
+
+'''gh_db_importer
+Bulk loads readings into the databases.  Call add() for each reading (in
+any order) and finish() at the end.
+kwargs:-
+backend - 'file' or 'shared', as gh_db_manager
+raw_backend - raw backend for the series, as param_db.  Use the one the
+              application uses
+ptype - ptype for series that don't exist yet, or None to skip them
+'''
+class gh_db_importer:
+    def __init__(self,**kwargs):
+        self._backend=kwargs.get('backend',gh_db_manager.DEFAULT_BACKEND)
+        self._raw_backend=kwargs.get('raw_backend',gh_db_manager.DEFAULT_RAW_BACKEND)
+        self._ptype=kwargs.get('ptype',None)
+        self._store=None
+        if self._backend=='shared':
+            self._store=gh_db_manager.shared_store()
+        self._manifest=self._read_manifest()
+        self._dbs=dict()      #(tname,pname) -> param_db, or None if it can't be imported
+        self._buffers=dict()  #(tname,pname) -> list of (ms timestamp,value)
+        self._loaded=dict()   #(tname,pname) -> [nrows,Tmin,Tmax,chunks] loaded so far
+        self._sources=dict()  #(tname,pname) -> first raw timestamp before the import, or None
+
+    def _read_manifest(self):
+        fname=gh_db_manager.DB_DIR+gh_db_manager.MANIFEST_NAME % self._backend
+        try:
+            with open(fname,'r') as f:
+                return json.load(f)
+        except (OSError,ValueError):
+            return dict()
+
+    #returns the op_desc of a series, or None if it isn't known
+    def _get_op_desc(self,tname,pname):
+        entry=self._manifest.get(tname,dict()).get(pname,None)
+        if entry is not None:
+            return entry['meta_data']
+        fname=gh_db_manager.get_db_fname(tname,pname)
+        if self._store is None and os.path.exists(fname):
+            con=sqlite3.connect(fname)
+            try:
+                meta_data=dict(con.execute('SELECT key,val FROM meta_data'))
+            finally:
+                con.close()
+            if len(meta_data)>0:
+                return meta_data
+        if self._ptype is not None:
+            return {'pdesc':pname,'ptype':self._ptype,'pdatatype':'float','pmin':0,'pmax':0,'punits':''}
+        return None
+
+    #returns the param_db for a series, opening it if need be, or None
+    def _get_db(self,tname,pname):
+        key=(tname,pname)
+        if key in self._dbs:
+            return self._dbs[key]
+        op_desc=self._get_op_desc(tname,pname)
+        if op_desc is None:
+            print('gh_db_import: Skipping ',tname,'/',pname,' - no such series (use --ptype to create it)')
+            pdb=None
+        elif self._store is not None:
+            pdb=gh_db_manager.series_db(tname=tname,pname=pname,op_desc=op_desc,\
+                                        raw_backend=self._raw_backend,store=self._store)
+        else:
+            pdb=gh_db_manager.param_db(tname=tname,pname=pname,op_desc=op_desc,\
+                                       raw_backend=self._raw_backend)
+        if pdb is not None:
+            self._sources[key]=pdb.get_first_raw_time()
+        self._dbs[key]=pdb
+        return pdb
+
+    def add(self,tname,pname,timestamp,val):
+        key=(tname,pname)
+        buf=self._buffers.get(key,None)
+        if buf is None:
+            if self._get_db(tname,pname) is None:
+                self._buffers[key]=None
+                return
+            buf=[]
+            self._buffers[key]=buf
+        buf.append((timestamp,val))
+        if len(buf)>=IMPORT_BUFFER:
+            self._flush(key)
+
+    def _flush(self,key):
+        buf=self._buffers[key]
+        if buf is None or len(buf)==0:
+            return
+        (nrows,Tmin,Tmax,chunks)=self._dbs[key].bulk_load(buf)
+        self._buffers[key]=[]
+        if Tmin is None:
+            return
+        if key in self._loaded:
+            loaded=self._loaded[key]
+            loaded[0]=loaded[0]+nrows
+            loaded[1]=min(loaded[1],Tmin)
+            loaded[2]=max(loaded[2],Tmax)
+            loaded[3].update(chunks)
+        else:
+            self._loaded[key]=[nrows,Tmin,Tmax,chunks]
+
+    '''
+        import_file
+        Reads one file.  fmt is 'csv' or 'line'.  series is (tname,pname)
+        for a csv file of timestamp,value.  See the module description.
+        Returns the number of readings read
+    '''
+    def import_file(self,fname,fmt='csv',series=None,time_mode='auto',precision='ns'):
+        t0=monotonic()
+        (n,nbad)=(0,0)
+        with open(fname,'r',newline='') as f:
+            if fmt=='line':
+                lines=f
+            else:
+                lines=csv.reader(f)
+            for (lineno,line) in enumerate(lines,1):
+                try:
+                    if fmt=='line':
+                        readings=parse_line_protocol(line,precision)
+                    elif series is not None:
+                        readings=[(series[0],series[1],parse_time(line[0],time_mode),float(line[1]))]
+                    else:
+                        readings=[(line[0],line[1],parse_time(line[2],time_mode),float(line[3]))]
+                except (ValueError,IndexError):
+                    if lineno>1 or fmt=='line':   #the first line of a csv may be a header
+                        nbad=nbad+1
+                        if nbad<=MAX_BAD_LINES:
+                            print('gh_db_import: ',fname,': Bad line ',lineno,': ',line)
+                    continue
+                for (tname,pname,ts,val) in readings:
+                    self.add(tname,pname,ts,val)
+                n=n+len(readings)
+        dt=monotonic()-t0
+        print('gh_db_import: ',fname,': ',n,' readings in %.1fs (%.0f/s), ' % (dt,n/max(dt,1e-6)),\
+              nbad,' bad lines')
+        return n
+
+    '''
+        finish
+        Loads what is left in the buffers, rebuilds the compressed data of
+        each series that was imported and closes the databases
+    '''
+    def finish(self):
+        for key in self._buffers:
+            self._flush(key)
+        for key in self._loaded:
+            (nrows,Tmin,Tmax,chunks)=self._loaded[key]
+            pdb=self._dbs[key]
+            t0=monotonic()
+            n=pdb.rebuild_tiers(chunks,self._sources[key])
+            while True:
+                k=pdb.compact(10000)
+                if k==0:
+                    break
+                n=n+k
+            print('gh_db_import: ',key[0],'/',key[1],': ',nrows,' readings from ',\
+                  gh_db_manager.timestamp_to_datetime(Tmin),' to ',gh_db_manager.timestamp_to_datetime(Tmax),\
+                  ', ',n,' chunks compressed in %.1fs' % (monotonic()-t0))
+        for pdb in self._dbs.values():
+            if pdb is not None:
+                pdb.close()
+        if self._store is not None:
+            self._store.close()
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Import historical readings into the greenhouse databases')
+    parser.add_argument('files',nargs='+',help='files to import')
+    parser.add_argument('--format',choices=['csv','line'],default='csv')
+    parser.add_argument('--series',help='tname/pname of a csv file of timestamp,value')
+    parser.add_argument('--time',choices=['auto','s','ms','iso'],default='auto',help='csv timestamp format')
+    parser.add_argument('--precision',choices=list(PRECISION),default='ns',help='line protocol timestamp units')
+    parser.add_argument('--backend',choices=['file','shared'],default=gh_db_manager.DEFAULT_BACKEND)
+    parser.add_argument('--raw-backend',choices=['sqlite','segment','partition'],default=gh_db_manager.DEFAULT_RAW_BACKEND)
+    parser.add_argument('--ptype',help='ptype for series that don\'t exist yet')
+    args=parser.parse_args()
+    series=tuple(args.series.split('/',1)) if args.series is not None else None
+    importer=gh_db_importer(backend=args.backend,raw_backend=args.raw_backend,ptype=args.ptype)
+    t0=monotonic()
+    for fname in args.files:
+        importer.import_file(fname,args.format,series,args.time,args.precision)
+    importer.finish()
+    print('gh_db_import: Done in %.1fs' % (monotonic()-t0))
@@ -4,6 +4,13 @@ gh_db_manager
 Manages access to the database itself
 Uses sqlite3 database
 
+Writes are handled by a dedicated writer thread (gh_db_writer).  Incoming
+samples are queued, grouped into per-parameter batches and written with
+executemany in one transaction per parameter.  See gh_db_writer below.
+Samples are also appended to a journal which is replayed at start up, so
+a power cut doesn't lose the ones that haven't been committed.  See
+gh_db_journal.
+
 '''
 
 '''param_db
@@ -19,13 +26,25 @@ Each db file contains the following tables:-
 TABLE: raw_data. Uncompressed data:-
 timestamp - integer - ms timestamp
 val - integer - value of the data
+With raw_backend='segment' the raw data is kept in segment files instead
+(see gh_db_segment), and with raw_backend='partition' in one database file
+per month (see gh_db_partition).  This table is then left empty
+Raw data of months that are over is moved to compressed archive files.
+See archive_month() and gh_db_archive
 
 TABLE comp_data.  Compressed data:-
-timestamp - integer ms timestamp at the END of the sample period
+timestamp - integer ms timestamp at the END of the sample period (the last
+            sample in it).  Periods are chunks of Tchunk ms aligned to
+            multiples of Tchunk, whichever path compressed them
 avg - integer - average value in compressed interval
 min - integer - min value in compressed interval
 max - integer - max value in compressed interval
 
+TABLE comp_data_<tier>.  Rollups of comp_data (see ROLLUP_TIERS):-
+timestamp - integer ms timestamp at the END of the rollup period.  Rollup
+            periods are aligned to multiples of the period
+avg, min, max - as comp_data
+
 TABLE meta_data.  Additional info:-
 key - text - key
 val - text - value
@@ -37,16 +56,85 @@ comp_period - float formatted as text - the time interval in seconds of the comp
 '''
 import sqlite3
 import threading
+import os
+import sys
+import queue
+import json
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from time import monotonic, sleep
+from contextlib import contextmanager
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from math import inf
+from itertools import chain
+from urllib.request import pathname2url
+from process_control import pr_cont
+from gh_db_segment import segment_store
+from gh_db_partition import partition_store, get_month, get_month_range
+from gh_db_archive import archive_store
+from gh_db_export import export_dbs
+
+try:
+    import numpy as np    #optional - only needed for the get_*_array() functions
+    _numpy_ok=True
+except ImportError:
+    _numpy_ok=False
 
 
 DB_DIR='db/'
-MAX_COMMIT_DELAY=20 #max number of seconds to not flush data to db
-                    #Note that data is only flushed when a new point is received
-                    #so if the periodicity of the data is greater than MAX_COMMIT_DELAY,
-                    #it won't get written until later.
+DEFAULT_COMMIT_DELAY=20 #Durability/latency knob.  Max number of seconds a sample
+                        #can wait in the writer before it is committed to the db.
+                        #Larger values mean fewer (slow) commits but more data at
+                        #risk on a power cut (unless the journal is on - see
+                        #gh_db_journal).  0 commits every batch as soon as
+                        #it is received.
+DEFAULT_BATCH_SIZE=500  #flush early if this many samples are waiting
+DEFAULT_BACKEND='file'  #'file' - one db per parameter, 'shared' - one db for all.
+                        #See shared_store
+DEFAULT_RAW_BACKEND='sqlite'  #where param_db keeps raw data. 'sqlite' - the raw_data
+                              #table, 'segment' - append-only files. See gh_db_segment
+                              #'partition' - a database per month. See gh_db_partition
+RAW_BACKENDS=dict()     #(tname,pname) -> raw backend for that series. '*' sets the default
+MAX_WRITE_Q_LEN=10000   #max samples (or batches - see gh_db_writer.put_batch) queued for the writer thread
+DEFAULT_CACHE_SIZE=16*1024*1024  #bytes of query results kept by tile_cache. 0 for no cache
                     
 DEFAULT_TCHUNK=10*60*1000  #Default compression chunk size in ms
+ALIGN_TIER_RATIO=4      #get_buckets reads a tier whose periods don't line up with the
+                        #buckets only if the buckets are at least this many periods wide
+IMPORT_BATCH=20000      #rows per executemany in bulk_load
+IMPORT_COMMIT=500000    #rows per commit in bulk_load.  Bounds the size of the WAL
+IMPORT_CACHE_KB=65536   #sqlite page cache while bulk loading
+IMPORT_READ_CHUNKS=4096 #chunks of raw data read at a time by rebuild_tiers
+EXPORT_RAW_SPAN=24*60*60*1000  #ms of raw data read at a time by iter_export
+EXPORT_TIER_PERIODS=4096       #tier periods read at a time by iter_export
+ARCHIVE_READ_SPAN=24*60*60*1000 #ms of raw data read at a time by archive_month
+
+'''Rollup tiers
+comp_data is the first tier (period Tchunk).  Each tier listed here is
+built incrementally from the tier below it, never from raw_data, so that
+long time spans can be read from a few rows.
+Each entry is (name,period in ms).  The table is comp_data_<name>.
+Periods must increase and each must be a multiple of the one below.  Any
+tier that isn't (e.g. a 1 minute tier below a 10 minute Tchunk) is
+skipped.  A database created with DEFAULT_TCHUNK=1 minute gets the full
+1min/10min/1h/1d hierarchy.
+'''
+ROLLUP_TIERS=[('10m',10*60*1000),('1h',60*60*1000),('1d',24*60*60*1000)]
+
+#NumPy structured array row types returned by the param_db get_*_array() functions
+if _numpy_ok:
+    RAW_DTYPE=np.dtype([('ts',np.int64),('val',np.float64)])
+    COMP_DTYPE=np.dtype([('ts',np.int64),('avg',np.float64),('min',np.float64),('max',np.float64)])
+
+#the file param_db uses for a parameter
+def get_db_fname(tname,pname):
+    return DB_DIR+(tname+'-'+pname+'.db').replace(' ','-')
+
+#the URI that opens dbname read only
+def get_ro_uri(dbname):
+    return 'file:%s?mode=ro' % pathname2url(os.path.abspath(dbname))
 
 #Timestamp is integer number of milliseconds since 1/1/1970 
 def datetime_to_timestamp(d):
@@ -57,6 +145,12 @@ def datetime_to_timestamp(d):
 def timestamp_to_datetime(ts):
     return datetime.fromtimestamp(ts/1000)
 
+#ts as an integer ms timestamp.  ts is a datetime or already a ms timestamp
+def to_timestamp(ts):
+    if isinstance(ts,datetime):
+        return datetime_to_timestamp(ts)
+    return ts
+
 #param_db----------------------------------------------------
 class param_db:
     def __init__(self,**kwargs):
@@ -64,52 +158,257 @@ class param_db:
         self._op_desc=kwargs.get('op_desc',None)
         self._tname=kwargs.get('tname',None)
         self._pname=kwargs.get('pname',None)
+        self._rollup_tiers=kwargs.get('rollup_tiers',ROLLUP_TIERS)
+        self._cache=kwargs.get('cache',None)  #tile_cache shared by all the param_db's, or None
+        self._dirty=dict()    #table -> [Tmin,Tmax] written since the last commit. See _mark_dirty()
+        self._raw_backend=kwargs.get('raw_backend',DEFAULT_RAW_BACKEND)
+        self._raw_store=None  #segment_store or partition_store for those raw_backends
+        self._archive=None    #archive_store holding the raw data of past months
         #print('param_db __init__: tname=',self._tname,'pname=',self._pname,'opdesc=',self._op_desc)
         self._db=None
+        self._read_pool=None
+        self._lock_wait=wait_stats()
+        self._stats={'insert':wait_stats(),'commit':wait_stats(),'compress':wait_stats()}  #see get_stats()
+        self._manifest=kwargs.get('manifest',None)  #cached meta_data and tiers.  See get_manifest()
+        self._read_only=kwargs.get('read_only',False)  #see open()
+        self._get_pending=None  #see set_pending()
+        self._open_ev=threading.Event()
+        #with one file per parameter the tables hold a single series, so
+        #the series selection parts of the queries are empty.  See _sql()
+        self._sqlkeys={'sid':'','where':'','vals':''}
         if self._op_desc is not None:
-            self._dbname=DB_DIR+(self._tname+'-'+self._pname+'.db').replace(' ','-')
+            self._dbname=get_db_fname(self._tname,self._pname)
+            if not kwargs.get('lazy',False):
+                self.open()
+                
+    '''
+        open
+        Opens the database.  The constructor does this unless it is given
+        lazy=True.  Then the owner calls open() (from any thread) and
+        anything else must call wait_open() before using the param_db.
+        See gh_db_manager._open_all()
+        With read_only=True the files are opened read only and nothing is
+        created, moved or recovered, so it is safe alongside the running
+        system.  Only the read functions can be used then.  See gh_db_export
+    '''
+    def open(self):
+        try:
             self._open_db()
+        finally:
+            self._open_ev.set()   #don't leave anyone waiting if it failed
+            
+    def wait_open(self):
+        self._open_ev.wait()
             
+    '''
+        _sql
+        Formats a query for this parameter's tables.  In the query:-
+        {sid} is a series filter for a WHERE clause, ending in AND
+        {where} is a WHERE clause selecting only this series
+        {vals} is the series column value at the start of an INSERT
+        This lets derived classes keep several series in the same tables
+    '''
+    def _sql(self,query):
+        return query.format(**self._sqlkeys)
                 
     def _open_db(self):
         with self._lock:
-            #connect with thread checking disabled
-            #we use _lock to prevent simultaneous access.
-            #write_value is usually called by a different thread
-            self._db=sqlite3.connect(self._dbname, check_same_thread=False)
-            self._db.execute('''CREATE TABLE IF NOT EXISTS raw_data (
-                            timestamp integer PRIMARY KEY,
-                            val integer)''')
-            self._db.execute('''CREATE TABLE IF NOT EXISTS comp_data (
-                            timestamp integer PRIMARY KEY,
-                            avg integer,
-                            min integer,
-                            max integer)''')
-            self._db.execute('''CREATE TABLE IF NOT EXISTS meta_data (
-                            key text,
-                            val text)''')
-            self.commit()
-            self._write_meta_data()
+            self._connect()
+            if self._manifest is not None:  #the tables and meta_data are known to exist
+                self._set_meta_data(dict(self._manifest['meta_data']))
+            elif self._read_only:
+                self._read_meta_data()
+            else:
+                self._create_tables()
+                self._db.commit()
+                self._write_meta_data()
+            self._init_tiers()
+            self._db.commit()
+            self._open_raw_store()
             #calculate the time after which the next compression can proceed
-            self._Tnext_compress=self._get_last_comp_data_time()+self._Tchunk  
+            self._Tnext_compress=self._chunk_end(self._get_last_comp_data_time())
+            self._last_write_time=None
+            self._chunk=None         #chunk_acc for the open chunk.  See _stream_sync()
+            self._rollup_due=False
+        self._open_read_pool()
+            
+    '''
+        _open_raw_store
+        Opens the archive and, with raw_backend='segment' or 'partition',
+        the segment or partition files for the series.
+        Any rows left in the raw_data table (e.g. when a series is switched
+        to one of those) are moved into them.
+        The caller must hold self._lock
+    '''
+    def _open_raw_store(self):
+        self._archive=archive_store(DB_DIR+(self._tname+'-'+self._pname+'-archive').replace(' ','-'),self._read_only)
+        if self._raw_backend=='segment':
+            self._raw_store=segment_store(DB_DIR+(self._tname+'-'+self._pname+'-raw').replace(' ','-'),self._read_only)
+        elif self._raw_backend=='partition':
+            self._raw_store=partition_store(DB_DIR+(self._tname+'-'+self._pname+'-parts').replace(' ','-'),self._read_only)
+        if self._raw_store is None or self._read_only:
+            return
+        cur=self._db.execute(self._sql("SELECT timestamp,val FROM raw_data{where} ORDER BY timestamp ASC"))
+        nrows=0
+        while True:
+            rows=cur.fetchmany(10000)
+            if len(rows)==0:
+                break
+            nrows=nrows+self._raw_store.append(rows)
+        if nrows==0:
+            return
+        print('gh_db_manager param_db: Moved ',nrows,' raw_data rows to ',self._raw_backend,\
+              ' files for ',self._tname,'/',self._pname)
+        self._raw_store.flush()
+        self._db.execute(self._sql("DELETE FROM raw_data{where}"))
+        self._db.commit()
+        
+    def _close_raw_store(self):
+        if self._raw_store is not None:
+            self._raw_store.close()
+            self._raw_store=None
+            
+    #readers get their own connections if the db is in WAL mode
+    def _open_read_pool(self):
+        if self._db.execute('PRAGMA journal_mode').fetchone()[0]=='wal':
+            self._read_pool=read_pool(self._dbname)
+            
+    '''
+        _locked
+        Use in place of "with self._lock:" on the write side.  The time
+        spent waiting for the lock is added to the lock wait stats.
+    '''
+    @contextmanager
+    def _locked(self):
+        t0=monotonic()
+        with self._lock:
+            self._lock_wait.add(monotonic()-t0)
+            yield
+            
+    '''
+        _reader
+        Use as "with self._reader() as con:" to run a query that only reads.
+        In WAL mode con is a read-only connection from the pool, so reads
+        don't wait for the writer (and don't hold it up).  They only see
+        committed data.  Otherwise con is the main connection, under the lock.
+    '''
+    @contextmanager
+    def _reader(self):
+        if self._read_pool is None:
+            with self._locked():
+                yield self._db
+        else:
+            with self._read_pool.connection() as con:
+                yield con
+                
+    #returns a dictionary of the time the write side has waited for the lock
+    def get_lock_wait(self):
+        return self._lock_wait.get()
+    
+    '''
+        get_stats
+        Returns the write side timings as a dictionary of wait_stats.get()
+        dictionaries:-
+        insert - write_values(), once it has the lock
+        commit - commit(), once it has the lock
+        compress - compression cycles (compress_next_chunk() and rollups)
+        lock_wait - time the write side waited for the lock
+    '''
+    def get_stats(self):
+        stats=dict()
+        for name in self._stats:
+            stats[name]=self._stats[name].get()
+        stats['lock_wait']=self._lock_wait.get()
+        return stats
+            
+    def _connect(self):
+        #connect with thread checking disabled
+        #we use _lock to prevent simultaneous access.
+        #write_value is usually called by a different thread
+        if self._read_only:
+            self._db=sqlite3.connect(get_ro_uri(self._dbname),uri=True,check_same_thread=False)
+            return
+        self._db=sqlite3.connect(self._dbname, check_same_thread=False)
+        #lets prune_raw() hand freed pages back a few at a time.  This only
+        #takes effect on a new file.  See incremental_vacuum()
+        self._db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        #WAL lets the read_pool connections read while the writer writes
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        
+    def _create_tables(self):
+        self._db.execute('''CREATE TABLE IF NOT EXISTS raw_data (
+                        timestamp integer PRIMARY KEY,
+                        val integer)''')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS comp_data (
+                        timestamp integer PRIMARY KEY,
+                        avg integer,
+                        min integer,
+                        max integer)''')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS meta_data (
+                        key text,
+                        val text)''')
+            
+    def _create_tier_table(self,table):
+        self._db.execute('''CREATE TABLE IF NOT EXISTS %s (
+                        timestamp integer PRIMARY KEY,
+                        avg integer,
+                        min integer,
+                        max integer)''' % table)
+        
+    '''
+        _init_tiers
+        Sets up self._tiers - a list of (table,period) with comp_data first,
+        then each usable rollup tier in ROLLUP_TIERS.  Creates the tables.
+        Needs Tchunk so must run after the meta_data has been read
+    '''
+    def _init_tiers(self):
+        self._tiers=[('comp_data',int(self._Tchunk))]
+        for (name,period) in self._rollup_tiers:
+            lower_period=self._tiers[-1][1]
+            if period>lower_period and period%lower_period==0:
+                table='comp_data_'+name
+                if self._read_only:
+                    if self._db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",\
+                                        (table,)).fetchone() is None:
+                        continue   #never created, so there is nothing in it
+                elif self._manifest is None or [table,period] not in self._manifest['tiers']:
+                    self._create_tier_table(table)
+                self._tiers.append((table,period))
+        #time span of one cached tile of each table.  See tile_cache
+        self._tile_spans={'raw_data':TILE_RAW_SPAN}
+        for (table,period) in self._tiers:
+            self._tile_spans[table]=period*TILE_PERIODS
             
     def _close_db(self):
+        if self._read_pool is not None:
+            self._read_pool.close()
+            self._read_pool=None
         if self._db is not None:
             self.commit()
             self._db.close()
+            self._db=None
+        self._close_raw_store()
             
     def __del__(self):
         self._close_db()
         
+    def close(self):
+        self._close_db()
+        
     #reads meta_data from the database and returns number of elements
     def _read_meta_data(self):
-        rows=self._db.execute("SELECT * FROM meta_data")
+        rows=self._db.execute(self._sql("SELECT key,val FROM meta_data{where}"))
           
-        self._meta_data=dict()
+        meta_data=dict()
         for row in rows:
             #print(row)
-            self._meta_data[row[0]]=row[1]        
-        
+            meta_data[row[0]]=row[1]        
+        return self._set_meta_data(meta_data)
+    
+    #sets the meta_data dictionary and the settings held in it
+    def _set_meta_data(self,meta_data):
+        self._meta_data=meta_data
         if 'val_comp_mult' in self._meta_data:
             self._val_comp_mult=float(self._meta_data['val_comp_mult'])  #store with db
             self._val_uncomp_mult=1/self._val_comp_mult            
@@ -136,12 +435,29 @@ class param_db:
                 data.append( (key,self._op_desc[key]) )
             data.append( ('val_comp_mult','{:e}'.format(self._val_comp_mult)) )
             data.append( ('Tchunk','%d' % DEFAULT_TCHUNK ) )
-            self._db.executemany('INSERT INTO meta_data VALUES (?,?)',data)
-            self.commit()
+            self._db.executemany(self._sql('INSERT INTO meta_data VALUES ({vals}?,?)'),data)
+            self._db.commit()
             self._read_meta_data() #this ensures self._meta_data gets set.
             
     def get_meta_data(self):
         return self._meta_data
+    
+    #returns (tname,pname)
+    def get_names(self):
+        return (self._tname,self._pname)
+    
+    '''
+        get_manifest
+        Returns what open() needs to know to skip creating the tables and
+        reading the meta_data next time:-
+        meta_data - as get_meta_data()
+        tiers - list of [table,period] that exist
+        raw_backend - where the raw data is kept.  See gh_db_export
+        Pass it back to the constructor as manifest=
+    '''
+    def get_manifest(self):
+        return {'meta_data':self._meta_data,'tiers':[[table,period] for (table,period) in self._tiers],\
+                'raw_backend':self._raw_backend}
             
     '''
         _setup_multipliers
@@ -180,131 +496,2072 @@ class param_db:
     '''
         write_value
         Writes a (timestamp,value) pair to the database
-        timestamp is in datetime format
+        timestamp is in datetime format or a ms timestamp
         value is a numeric format
+        The data is not committed.  See write_values()
     '''
     def write_value(self,timestamp,val):
-        timestamp_ms=datetime_to_timestamp(timestamp)
-        data=(timestamp_ms,self.compress_val(val))
-        with self._lock:
-            #tstart=datetime.now()
-            self._db.execute('INSERT INTO raw_data VALUES (?,?)',data)
-            self._commit_if_due(timestamp_ms)
-            #tstop=datetime.now()
-            #tdelta=(tstop-tstart).total_seconds()
-            #print("write time=",tdelta,"s")
-            '''
-            Committing one measurement takes 120 - 200ms on windows
-            All thread data has been serialised thought the queue, so
-            for the 11 params we have running this can total over 1 second.
-            This slowly fills the queue up, and we start losing data.
-            If you comment out the commit, the time goes to below 1ms.
-            Therefore a good method is to only commit at a slower interval.   
-            Hence the commit_if_due functionality
-            MAX_COMMIT_DELAY is the maximum time with no flushing                     
-            '''
-            
-            
-    #Flush data
+        self.write_values([(timestamp,val)])
+            
+    '''
+        write_values
+        Writes a list of (timestamp,value) pairs to the database in one
+        executemany.  timestamp is in datetime format or a ms timestamp
+        The data is left uncommitted so a caller can group several
+        parameters into one flush - call commit() afterwards.
+        
+        Committing one measurement takes 120 - 200ms on windows, so
+        committing every point is far too slow when there are many params.
+        gh_db_writer batches the points and decides when to commit.
+    '''
+    def write_values(self,data):
+        rows=[(to_timestamp(ts),self.compress_val(val)) for (ts,val) in data]
+        with self._locked():
+            t0=monotonic()
+            if self._raw_backend=='segment':
+                #only the rows that are stored go on to streaming compression
+                n=len(rows)
+                rows=self._raw_store.get_new(rows)
+                if len(rows)<n:
+                    print('param_db: Dropped ',n-len(rows),' out of order samples (',self._dbname,')')
+                if len(rows)==0:
+                    return
+            if self._raw_store is not None:
+                n=self._raw_store.append(rows)
+            else:
+                n=self._db.executemany(self._sql('INSERT OR IGNORE INTO raw_data VALUES ({vals}?,?)'),rows).rowcount
+            if n<len(rows) and self._chunk is not None:
+                #some were already stored.  Reseed the open chunk from the
+                #stored data rather than count them twice.  See _stream_sync
+                self._chunk=None
+            self._last_write_time=rows[-1][0]
+            self._mark_dirty('raw_data',min(rows)[0],max(rows)[0])
+            if self._chunk is not None:
+                for (ts,val) in rows:
+                    self._stream_add(ts,val)
+            self._stats['insert'].add(monotonic()-t0)
+                    
+    '''
+        restore_values
+        As write_values, but any samples that are already in the db are
+        skipped.  Used to replay the journal (see gh_db_journal), so must
+        be called before compression has started streaming.
+    '''
+    def restore_values(self,data):
+        rows=[(to_timestamp(ts),self.compress_val(val)) for (ts,val) in data]
+        with self._locked():
+            if self._raw_store is not None:
+                Tlast=self._raw_store.get_last_time()
+                if Tlast is not None:
+                    rows=[row for row in rows if row[0]>Tlast]
+                self._raw_store.append(rows)
+            else:
+                self._db.executemany(self._sql('INSERT OR IGNORE INTO raw_data VALUES ({vals}?,?)'),rows)
+            if len(rows)>0:
+                self._last_write_time=max(rows)[0]
+                self._mark_dirty('raw_data',min(rows)[0],max(rows)[0])
+                    
+    '''
+        bulk_load
+        Fast path for importing history (see gh_db_import).  rows is an
+        iterable of (ms timestamp,val) - any length, in any order.  They are
+        written IMPORT_BATCH at a time and committed every IMPORT_COMMIT,
+        with the PRAGMAs set for speed rather than safety while it runs
+        (an import can just be run again).  Samples already in the db are
+        skipped.  The lock is released between batches.
+        Samples from months that have been archived (before
+        get_archive_end()) are merged into the archive files instead, one
+        rewrite of each month's file per call.
+        With raw_backend='segment' only those and samples after the last
+        one stored can be added.
+        Nothing is compressed - call rebuild_tiers(chunks,Tsource) afterwards.
+        Returns (nrows,Tmin,Tmax,chunks) of the rows loaded (Tmin is None if
+        none).  chunks is the set of chunk numbers (ts//Tchunk) they are in
+    '''
+    def bulk_load(self,rows):
+        with self._locked():
+            self._db.execute('PRAGMA synchronous=OFF')
+            self._db.execute('PRAGMA cache_size=-%d' % IMPORT_CACHE_KB)
+            self._chunk=None   #the rows bypass streaming compression
+        (nrows,Tmin,Tmax,ndropped)=(0,None,None,0)
+        mult=self._val_comp_mult
+        Tchunk=int(self._Tchunk)
+        chunks=set()
+        Tarch=self._archive.get_end()
+        archived=dict()   #month -> rows before Tarch.  See _load_batch
+        try:
+            batch=[]
+            for (ts,val) in rows:
+                batch.append((ts,round(val*mult)))
+                if len(batch)<IMPORT_BATCH:
+                    continue
+                ndropped=ndropped+self._load_batch(batch,nrows,Tarch,archived)
+                (Tmin,Tmax)=self._widen(Tmin,Tmax,batch)
+                chunks.update(ts//Tchunk for (ts,val) in batch)
+                nrows=nrows+len(batch)
+                batch=[]
+            if len(batch)>0:
+                ndropped=ndropped+self._load_batch(batch,nrows,Tarch,archived)
+                (Tmin,Tmax)=self._widen(Tmin,Tmax,batch)
+                chunks.update(ts//Tchunk for (ts,val) in batch)
+                nrows=nrows+len(batch)
+            for month in sorted(archived):
+                batch=sorted(archived[month])
+                (Tstart,Tend)=get_month_range(month)
+                nrows=nrows+self._archive.merge_month(Tstart,Tend,batch)
+                (Tmin,Tmax)=self._widen(Tmin,Tmax,batch)
+                chunks.update(ts//Tchunk for (ts,val) in batch)
+                with self._locked():
+                    self._mark_dirty('raw_data',batch[0][0],batch[-1][0])
+        finally:
+            with self._locked():
+                self._commit()
+                self._db.execute('PRAGMA synchronous=NORMAL')
+                self._db.execute('PRAGMA cache_size=-2000')  #the sqlite default
+                Tlast=self._get_last_raw_time()
+                if self._last_write_time is None or Tlast>self._last_write_time:
+                    self._last_write_time=Tlast
+        if ndropped>0:
+            print('gh_db_manager param_db: ',ndropped,' samples before the end of the segments skipped for ',\
+                  self._tname,'/',self._pname)
+        return (nrows,Tmin,Tmax,chunks)
+    
+    #writes one batch for bulk_load, committing every IMPORT_COMMIT rows.
+    #Rows before Tarch are moved out of batch into archived (month -> rows)
+    #Returns the number of rows dropped
+    def _load_batch(self,batch,nrows,Tarch,archived):
+        ndropped=0
+        if min(batch)[0]<Tarch:
+            for row in batch:
+                if row[0]<Tarch:
+                    archived.setdefault(get_month(row[0]),[]).append(row)
+            batch[:]=[row for row in batch if row[0]>=Tarch]
+            if len(batch)==0:
+                return 0
+        with self._locked():
+            if self._raw_store is not None:
+                if self._raw_backend=='segment':
+                    Tlast=self._raw_store.get_last_time()
+                    batch.sort()
+                    n=len(batch)
+                    batch[:]=[row for row in batch if Tlast is None or row[0]>Tlast]
+                    ndropped=n-len(batch)
+                self._raw_store.append(batch)
+            else:
+                self._db.executemany(self._sql('INSERT OR IGNORE INTO raw_data VALUES ({vals}?,?)'),batch)
+            if len(batch)>0:
+                self._mark_dirty('raw_data',min(batch)[0],max(batch)[0])
+            if (nrows+len(batch))//IMPORT_COMMIT>nrows//IMPORT_COMMIT:
+                self._commit()
+        return ndropped
+    
+    #returns (Tmin,Tmax) widened to take in the timestamps of rows
+    @staticmethod
+    def _widen(Tmin,Tmax,rows):
+        if len(rows)==0:
+            return (Tmin,Tmax)
+        lo=min(rows)[0]
+        hi=max(rows)[0]
+        return (lo if Tmin is None else min(Tmin,lo),hi if Tmax is None else max(Tmax,hi))
+    
+    '''
+        rebuild_tiers
+        Brings comp_data and the rollup tiers up to date after raw data has
+        been written out of time order, e.g. by bulk_load().  chunks is the
+        set of chunk numbers (ts//Tchunk) that were written to:-
+        Each of those up to the end of compression is recompressed from
+        the raw data (archived or not), a run of up to IMPORT_READ_CHUNKS
+        consecutive chunks at a time.  Chunks after the end of compression
+        are left to compact() as usual.
+        Tsource is the first raw timestamp there was before the import (see
+        get_first_raw_time - None if there was none).  The raw data before
+        it has been pruned, so a chunk there that already has a comp_data
+        row is kept as it is - recompressing it would only count the
+        imported samples.
+        The rollups are built from comp_data, so each rollup tier is cut
+        back to the period holding the first chunk that changed and built
+        again from there with one GROUP BY.
+        Holds the lock throughout, so is meant for when the system isn't
+        running.
+        Returns the number of comp_data rows written
+    '''
+    def rebuild_tiers(self,chunks,Tsource):
+        with self._locked():
+            Tcl=self._get_last_comp_data_time()
+            Tchunk=int(self._Tchunk)
+            todo=[]
+            nkept=0
+            for k in sorted(chunks):
+                if k>Tcl//Tchunk:
+                    break
+                if Tsource is None or k*Tchunk<Tsource:
+                    if self._db.execute(self._sql("SELECT 1 FROM comp_data WHERE {sid}timestamp>=? \
+                                        AND timestamp<? LIMIT 1"),(k*Tchunk,(k+1)*Tchunk)).fetchone() is not None:
+                        nkept=nkept+1
+                        continue
+                todo.append(k)
+            nrows=0
+            i=0
+            while i<len(todo):
+                j=i+1   #todo[i:j] is a run of consecutive chunks
+                while j<len(todo) and j-i<IMPORT_READ_CHUNKS and todo[j]==todo[j-1]+1:
+                    j=j+1
+                (T0,T1)=(todo[i]*Tchunk,(todo[j-1]+1)*Tchunk-1)
+                self._db.execute(self._sql("DELETE FROM comp_data WHERE {sid}timestamp>=? AND timestamp<=?"),\
+                                 (T0,T1))
+                rows=[]
+                acc=None
+                for (ts,val) in self._iter_raw(self._db,T0,T1):
+                    if acc is not None and ts//Tchunk==acc.Tstart//Tchunk:
+                        acc.add(ts,val)
+                    else:
+                        if acc is not None:
+                            rows.append(acc.get_row())
+                        acc=chunk_acc(ts,val)
+                if acc is not None:
+                    rows.append(acc.get_row())
+                self._db.executemany(self._sql("INSERT INTO comp_data VALUES ({vals}?,?,?,?)"),rows)
+                self._mark_dirty('comp_data',T0,T1)
+                nrows=nrows+len(rows)
+                i=j
+            if nkept>0:
+                print('gh_db_manager param_db: ',nkept,' chunks kept as their raw data has been pruned for ',\
+                      self._tname,'/',self._pname)
+            if len(todo)>0:
+                Tstart=todo[0]*Tchunk
+                Tcl=self._get_last_comp_data_time()
+                for (table,period) in self._tiers[1:]:
+                    Tp=(Tstart//period)*period
+                    self._db.execute(self._sql("DELETE FROM %s WHERE {sid}timestamp>?" % table),(Tp,))
+                    self._mark_dirty(table,Tp,max(Tp,Tcl)+period)
+                self._rollup_tiers_all()
+            self._commit()
+            self._Tnext_compress=self._chunk_end(self._get_last_comp_data_time())
+            return nrows
+            
+    #returns the timestamp of the first raw sample (archived or not), or None
+    def get_first_raw_time(self):
+        for row in self._archive.iter_range(0,inf):
+            return row[0]
+        with self._locked():
+            if self._raw_store is not None:
+                return self._raw_store.get_first_after(-1)
+            return self._db.execute(self._sql("SELECT MIN(timestamp) FROM raw_data{where}")).fetchone()[0]
+            
+    '''
+        Streaming compression
+        While the open chunk is tracked in memory (self._chunk), each new
+        point updates the running min/max/sum/count and a chunk is closed
+        with a single INSERT into comp_data when the first point past its
+        end arrives.  Nothing is read back from raw_data.
+        The chunks are the same as _compress_chunks() and rebuild_tiers() -
+        Tchunk long and aligned to multiples of Tchunk (see _chunk_end)
+        All of these must be called with self._lock held
+    '''
+    def _stream_add(self,ts,val):
+        if ts>=self._chunk_end(self._chunk.Tstart):
+            self._db.execute(self._sql('INSERT INTO comp_data VALUES ({vals}?,?,?,?)'),\
+                             self._chunk.get_row())
+            self._mark_dirty('comp_data',self._chunk.Tlast,self._chunk.Tlast)
+            self._Tnext_compress=self._chunk_end(self._chunk.Tlast)
+            self._rollup_due=True
+            self._chunk=chunk_acc(ts,val)
+        else:
+            self._chunk.add(ts,val)
+            
+    '''
+        _stream_sync
+        Starts streaming compression if raw_data has no closed chunks
+        waiting to be compressed.  The open chunk (if any) is read once to
+        seed the accumulator.  Otherwise compression is left to
+        compress_next_chunk() and gh_db_compactor until they catch up.
+    '''
+    def _stream_sync(self):
+        Tcl=self._get_last_comp_data_time()
+        if self._raw_store is not None:
+            self._raw_store.flush()
+            Tstart=self._raw_store.get_first_after(Tcl)
+            if Tstart is None or self._raw_store.get_last_time()>=self._chunk_end(Tstart):
+                return
+            rows=self._raw_store.read(Tstart,self._raw_store.get_last_time())
+            self._chunk=chunk_acc(*rows[0])
+            for (ts,val) in rows[1:]:
+                self._chunk.add(ts,val)
+            return
+        cur=self._db.execute(self._sql("SELECT MIN(timestamp),MAX(timestamp),min(val),max(val),\
+                    sum(val),count(val) FROM raw_data WHERE {sid}timestamp>?"),(Tcl,))
+        (Tstart,Tlast,min_val,max_val,sum_val,n)=cur.fetchone()
+        if Tstart is None or Tlast>=self._chunk_end(Tstart):
+            return  #no data yet to start a chunk, or a closed chunk is waiting
+        self._chunk=chunk_acc(Tstart,min_val)
+        (self._chunk.Tlast,self._chunk.max,self._chunk.sum,self._chunk.n)=(Tlast,max_val,sum_val,n)
+            
+    #Flush data.  Nothing is done if there is nothing to commit, so
+    #param_db's sharing a connection only pay for one commit
     def commit(self):
-        self._db.commit()
-        self._last_commit_time=datetime.now()
-        self._commit_pending=False
-        
-    #Flush data only if it's due
-    #accepts the timestamp of the last data to allow calculation of whether
-    #a compression cycle should happen
-    def _commit_if_due(self,timestamp_ms):
-        self._commit_pending=True
-        if self.commit_due():
-            #write the data
-            self.commit()
-            #do a compression cycle
-            #compression will cause delay, so do it only every MAX_COMMIT_DELAY seconds
-            if(timestamp_ms>self._Tnext_compress):
-                self.compress_next_chunk()
-                
-    #Check if data needs flushing
-    def commit_due(self):
-        if self._commit_pending:
-            tdelta=(datetime.now()-self._last_commit_time).total_seconds()
-            if(tdelta>MAX_COMMIT_DELAY):
-                return True
-        return False
+        with self._locked():
+            t0=monotonic()
+            self._commit()
+            self._stats['commit'].add(monotonic()-t0)
+            
+    '''
+        sync
+        Commits and makes sure everything committed so far would survive a
+        power cut.  With synchronous=NORMAL a WAL commit only reaches the
+        disk at the next checkpoint, so this runs a PASSIVE checkpoint.
+        That can't finish while a reader is still using the older part of
+        the WAL, in which case it should be tried again later.
+        Returns True if everything is on disk
+    '''
+    def sync(self):
+        with self._locked():
+            self._commit()
+            if self._raw_store is not None:
+                self._raw_store.sync()
+            (busy,nlog,nckpt)=self._db.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            return busy==0 and nlog==nckpt  #nlog is -1 if not in WAL mode
+            
+    '''
+        _commit
+        Commits and then drops any cached tiles the commit has changed.
+        The tiles must not be dropped before the commit, or a reader could
+        cache them again from the old data.  With a shared connection
+        another param_db may have done the commit already, so the tiles are
+        dropped even if there is nothing left to commit.
+        The caller must hold self._lock
+    '''
+    def _commit(self):
+        if self._raw_store is not None:
+            self._raw_store.flush()
+        if self._db.in_transaction:
+            self._db.commit()
+        if len(self._dirty)>0:
+            if self._cache is not None:
+                for table in self._dirty:
+                    (Tmin,Tmax)=self._dirty[table]
+                    self._cache.invalidate(self._tname,self._pname,table,\
+                                           Tmin,Tmax,self._tile_spans[table])
+            self._dirty=dict()
+            
+    #records that rows between Tmin and Tmax have been written to table
+    def _mark_dirty(self,table,Tmin,Tmax):
+        if table in self._dirty:
+            span=self._dirty[table]
+            span[0]=min(span[0],Tmin)
+            span[1]=max(span[1],Tmax)
+        else:
+            self._dirty[table]=[Tmin,Tmax]
+        
+    #do a compression cycle if the last data written has passed the end of
+    #the next chunk.  Called by the writer after a commit.  Cycles that do
+    #something are timed in the 'compress' stats.
+    #Returns True if closed chunks are still waiting, e.g. after downtime.
+    #They are left to gh_db_compactor, as this only does one per call
+    def compress_if_due(self):
+        with self._locked():
+            t0=monotonic()
+            busy=False
+            if self._chunk is None:  #not streaming yet - use the queries
+                if self._last_write_time is not None and \
+                    self._last_write_time>=self._Tnext_compress:
+                    busy=True
+                    if self.compress_next_chunk() is not None:
+                        self._rollup_due=True
+                self._stream_sync()
+            if self._rollup_due:
+                busy=True
+                self._rollup_tiers_all()
+                self._commit()
+                self._rollup_due=False
+            if busy:
+                self._stats['compress'].add(monotonic()-t0)
+            return self._chunk is None and self._last_write_time is not None and \
+                   self._last_write_time>=self._Tnext_compress
+    
+    #end of the compression chunk holding ts.  Chunks are Tchunk long and
+    #aligned to multiples of Tchunk, so every path compresses the same ones
+    def _chunk_end(self,ts):
+        Tchunk=int(self._Tchunk)
+        return (ts//Tchunk+1)*Tchunk
     
     #This finds the last timestamp in the comp_data table
     def _get_last_comp_data_time(self):
+        return self._get_last_time('comp_data')
+    
+    #first raw data timestamp after the last comp_data row, or None
+    def _get_first_uncompressed(self):
+        Tcl=self._get_last_comp_data_time()
+        if self._raw_store is not None:
+            return self._raw_store.get_first_after(Tcl)
+        return self._db.execute(self._sql("SELECT MIN(timestamp) FROM raw_data \
+                    WHERE {sid}timestamp>?"),(Tcl,)).fetchone()[0]
+    
+    #last raw data timestamp, or 0 if there is none
+    def _get_last_raw_time(self):
+        if self._raw_store is not None:
+            Tlast=self._raw_store.get_last_time()
+            return Tlast if Tlast is not None else 0
+        return self._get_last_time('raw_data')
+    
+    #last timestamp in a table, or 0 if it is empty
+    def _get_last_time(self,table):
         cur=self._db.cursor()
-        cur.execute("SELECT MAX(timestamp) FROM comp_data")
+        cur.execute(self._sql("SELECT MAX(timestamp) FROM %s{where}" % table))
         Tcl=cur.fetchone()[0]
         if Tcl is None:
             Tcl=0
         return Tcl
+    
+    '''
+        _rollup_tier
+        Builds all the closed periods of tier k from tier k-1 with one
+        GROUP BY.  A period is closed once the tier below has reached its end,
+        since rows in the tier below only ever arrive in time order.
+        The caller must hold self._lock and commit
+        Returns the number of rows added
+    '''
+    def _rollup_tier(self,k):
+        (table,period)=self._tiers[k]
+        lower_table=self._tiers[k-1][0]
+        Tlast=self._get_last_time(table)
+        Tclosed=(self._get_last_time(lower_table)//period)*period
+        if Tclosed<=Tlast:
+            return 0
+        cur=self._db.execute(self._sql("INSERT INTO %s \
+                    SELECT {vals}((timestamp+%d-1)/%d)*%d AS tend,avg(avg),min(min),max(max) \
+                    FROM %s WHERE {sid}timestamp>? AND timestamp<=? GROUP BY tend" % \
+                    (table,period,period,period,lower_table)),(Tlast,Tclosed))
+        if cur.rowcount>0:
+            self._mark_dirty(table,Tlast+1,Tclosed)
+        return cur.rowcount
+    
+    #cascade new comp_data up through every rollup tier
+    def _rollup_tiers_all(self):
+        for k in range(1,len(self._tiers)):
+            self._rollup_tier(k)
     '''
     
     Gets a chunk from raw_data and compresses it into comp_data
     The chunk size is self._Tchunk
-    Returns the timestamp of the chunk 
+    Returns the timestamp of the chunk, or None if there is no closed chunk
+    The caller must hold self._lock
     '''
     def compress_next_chunk(self):
-        Tcl=self._get_last_comp_data_time()
-        cur=self._db.cursor()
-        cur.execute("SELECT MIN(timestamp) FROM raw_data \
-                    WHERE timestamp>?",(Tcl,))
-        Traw_start=cur.fetchone()[0]
-        cur.execute("SELECT min(val),max(val),avg(val),max(timestamp) \
-                    FROM raw_data WHERE timestamp>=? AND timestamp<=? \
-                    ORDER BY timestamp ASC",\
-                    (Traw_start,Traw_start+self._Tchunk))
-        data=cur.fetchone()
-        (min_val,max_val,avg_val,ts)=(data[0],data[1],data[2],data[3])
-        print("param_db: compress_next_chunk (",self._dbname,")")
-        print("Tcl=",Tcl,"Traw_start=",Traw_start,"ts=",ts,\
-              "min_val=",min_val,"max_val=",max_val,"avg_val=",avg_val)
-        self._db.execute('INSERT INTO comp_data VALUES (?,?,?,?)',(ts,avg_val,min_val,max_val))
-        self.commit()
-        self._Tnext_compress=ts+self._Tchunk  #this is the next point time that can trigger a compression cycle
+        if self._compress_chunks(1)==0:
+            return None
+        ts=self._get_last_comp_data_time()
+        print("param_db: compress_next_chunk (",self._dbname,") ts=",ts)
         return ts
+    
+    '''
+        _compress_chunks
+        Compresses up to nmax chunks of raw_data into comp_data with one
+        GROUP BY query, starting with the chunk holding the first raw point
+        after the last comp_data point.  Chunks are aligned to multiples of
+        Tchunk (see _chunk_end).  A chunk is only compressed once raw_data
+        has reached its end.  Chunks with no raw data (gaps) produce no
+        comp_data.
+        The caller must hold self._lock.  Commits.
+        Returns the number of chunks written
+    '''
+    def _compress_chunks(self,nmax):
+        if self._chunk is not None:  #streaming compression is up to date
+            return 0
+        Tchunk=int(self._Tchunk)
+        cur=self._db.cursor()
+        Traw_start=self._get_first_uncompressed()
+        if Traw_start is None:  #no raw data since the last chunk
+            return 0
+        Traw_last=self._get_last_raw_time()
+        Tfirst_chunk=(Traw_start//Tchunk)*Tchunk
+        n=min(nmax,(Traw_last-Tfirst_chunk)//Tchunk)
+        if n<=0:  #the first chunk is still open
+            return 0
+        Tend=Tfirst_chunk+n*Tchunk
+        if self._raw_store is not None:
+            rows=self._get_store_chunks(Traw_start,Tend)
+            cur.executemany(self._sql("INSERT INTO comp_data VALUES ({vals}?,?,?,?)"),rows)
+            nrows=len(rows)
+        else:
+            cur.execute(self._sql("INSERT INTO comp_data \
+                        SELECT {vals}max(timestamp),avg(val),min(val),max(val) \
+                        FROM raw_data WHERE {sid}timestamp>=? AND timestamp<? \
+                        GROUP BY timestamp/?"),\
+                        (Traw_start,Tend,Tchunk))
+            nrows=cur.rowcount
+        self._mark_dirty('comp_data',Traw_start,Tend)
+        self._commit()
+        self._Tnext_compress=self._chunk_end(self._get_last_comp_data_time())  #this is the next point time that can trigger a compression cycle
+        return nrows
+    
+    #the comp_data rows for the raw_store data from Traw_start up to (not
+    #including) Tend.  As the GROUP BY in _compress_chunks()
+    def _get_store_chunks(self,Traw_start,Tend):
+        Tchunk=int(self._Tchunk)
+        rows=[]
+        acc=None
+        for (ts,val) in self._raw_store.read(Traw_start,Tend-1):
+            if acc is not None and ts//Tchunk==acc.Tstart//Tchunk:
+                acc.add(ts,val)
+            else:
+                if acc is not None:
+                    rows.append(acc.get_row())
+                acc=chunk_acc(ts,val)
+        if acc is not None:
+            rows.append(acc.get_row())
+        return rows
+    
+    '''
+        compact
+        Catch-up compression.  Compresses up to nmax chunks of any raw_data
+        that has not been compressed (e.g. after downtime or an import) and
+        cascades the rollup tiers.  The lock is only held for this call, so
+        call it repeatedly until it returns 0.  All progress is held in the
+        db, so this can be stopped and resumed at any time.  Once it has
+        caught up, streaming compression takes over.
+        Returns the number of chunks written
+    '''
+    def compact(self,nmax):
+        with self._locked():
+            nrows=self._compress_chunks(nmax)
+            if nrows>0:
+                self._rollup_tiers_all()
+                self._commit()
+            elif self._chunk is None:
+                self._stream_sync()
+            return nrows
+        
+    #returns (Tfirst,Tcl,Traw_last) - the first raw data time that isn't
+    #compressed (None if there is none), the time compression has reached
+    #and the last raw data time.  Used to report compaction progress
+    def get_compaction_state(self):
+        with self._locked():
+            return (self._get_first_uncompressed(),self._get_last_comp_data_time(),self._get_last_raw_time())
+        
+    '''
+        prune_raw
+        Deletes at most nmax rows of raw_data older than Tcutoff (ms).
+        Segments and partitions are deleted whole, so may go over nmax.
+        Archived months are deleted by prune_archive().
+        Only data that has already been compressed into comp_data is
+        deleted, so the rollups are never left with a hole.
+        The lock is only held for this call, so call it repeatedly until
+        it returns 0.
+        Returns the number of rows deleted
+    '''
+    def prune_raw(self,Tcutoff,nmax):
+        with self._locked():
+            Tlimit=min(Tcutoff,self._get_last_comp_data_time()+1)
+            if self._raw_store is not None:  #whole segments or partitions only
+                nrows=self._raw_store.drop_before(Tlimit,nmax)
+                if nrows>0:
+                    self._mark_dirty('raw_data',0,Tlimit)
+                self._commit()
+                return nrows
+            cur=self._db.execute(self._sql("SELECT timestamp FROM raw_data \
+                        WHERE {sid}timestamp<? ORDER BY timestamp ASC LIMIT 1 OFFSET ?"),\
+                        (Tlimit,nmax))
+            row=cur.fetchone()
+            if row is not None:
+                Tlimit=row[0]
+            cur=self._db.execute(self._sql("DELETE FROM raw_data WHERE {sid}timestamp<?"),(Tlimit,))
+            nrows=cur.rowcount
+            if nrows>0:
+                self._mark_dirty('raw_data',0,Tlimit)
+            self._commit()
+            return nrows
+        
+    '''
+        archive_month
+        Moves the oldest month of raw data that isn't archived yet into
+        the archive, if the month ends at or before Tlimit and it has all
+        been compressed.  The month is read and encoded without holding
+        the lock, as a month that is over doesn't change.  Reads of raw
+        data before the end of the archive come from the archive, so the
+        rows left in raw_data are not used again and can be deleted with
+        prune_raw(get_archive_end(),...) at any time.
+        Returns the number of samples archived
+    '''
+    def archive_month(self,Tlimit):
+        Tarch=self._archive.get_end()
+        with self._locked():
+            Tlimit=min(Tlimit,self._get_last_comp_data_time())
+            if self._raw_store is not None:
+                Tfirst=self._raw_store.get_first_after(Tarch-1)
+            else:
+                Tfirst=self._db.execute(self._sql("SELECT MIN(timestamp) FROM raw_data \
+                            WHERE {sid}timestamp>=?"),(Tarch,)).fetchone()[0]
+        if Tfirst is None:
+            return 0
+        d=timestamp_to_datetime(Tfirst)
+        Tstart=datetime_to_timestamp(datetime(d.year,d.month,1))
+        Tend=datetime_to_timestamp(datetime(d.year+d.month//12,d.month%12+1,1))
+        if Tend>Tlimit:
+            return 0
+        with self._reader() as con:
+            n=self._archive.write_month(Tstart,Tend,self._iter_raw_spans(con,Tstart,Tend-1))
+        print('gh_db_manager param_db: Archived ',n,' raw samples from ',\
+              d.strftime('%Y-%m'),' for ',self._tname,'/',self._pname)
+        return n
+    
+    #as _iter_raw, but reads ARCHIVE_READ_SPAN ms at a time, as the
+    #raw_store reads return lists
+    def _iter_raw_spans(self,con,Tstart,Tstop):
+        for T0 in range(Tstart,Tstop+1,ARCHIVE_READ_SPAN):
+            yield from self._iter_raw(con,T0,min(Tstop,T0+ARCHIVE_READ_SPAN-1))
+    
+    #everything before this time has been archived
+    def get_archive_end(self):
+        return self._archive.get_end()
+    
+    '''
+        prune_archive
+        Deletes the oldest archived month if it ended before Tcutoff (ms).
+        Call repeatedly until it returns 0.
+        Returns the number of samples deleted
+    '''
+    def prune_archive(self,Tcutoff):
+        nrows=self._archive.drop_before(Tcutoff)
+        if nrows>0:
+            with self._locked():
+                self._mark_dirty('raw_data',0,Tcutoff)
+                self._commit()
+        return nrows
+        
+    '''
+        incremental_vacuum
+        Returns up to npages free pages to the file system.
+        Returns False when there are no free pages left.
+        Files created before auto_vacuum was set have it off, and switching
+        it on needs a full VACUUM, which would hold the lock for as long as
+        it takes to rewrite the file.  Their free pages are left to be
+        reused by later inserts instead.  To convert one, run
+        PRAGMA auto_vacuum=INCREMENTAL; VACUUM; on it while gh_db is stopped
+    '''
+    def incremental_vacuum(self,npages):
+        with self._locked():
+            if self._db.execute('PRAGMA auto_vacuum').fetchone()[0]!=2:  #INCREMENTAL
+                return False
+            if self._db.execute('PRAGMA freelist_count').fetchone()[0]==0:
+                return False
+            self._commit()  #executescript() would commit anything waiting without it
+            #execute() only steps the PRAGMA once, which frees one page
+            self._db.executescript('PRAGMA incremental_vacuum(%d)' % npages)
+            return True
+        
+    '''
+        backup
+        Copies the database to dest_fname while it is in use, with the
+        sqlite online backup API.  pages are copied per step and self._lock
+        is released between steps (from the progress callback), so the
+        writer is only ever held up for one step.  Writes made through
+        self._db between steps are copied as well, so the backup doesn't
+        have to start again.
+        The copy is made under a temporary name and renamed once complete,
+        so dest_fname is never half written
+    '''
+    def backup(self,dest_fname,pages=None):
+        if pages is None:
+            pages=BACKUP_PAGES
+        def progress(status,remaining,total):
+            self._lock.release()
+            sleep(BACKUP_STEP_DELAY)
+            self._lock.acquire()
+        tmp=dest_fname+'.tmp'
+        dest=sqlite3.connect(tmp)
+        try:
+            with self._locked():
+                self._commit()
+                self._db.backup(dest,pages=pages,progress=progress)
+        finally:
+            dest.close()
+        os.replace(tmp,dest_fname)
+        
+    #returns the number of rows changed through the connection so far.  If it
+    #hasn't changed there is nothing new to back up
+    def get_change_count(self):
+        with self._locked():
+            return self._db.total_changes
+        
+    def get_dbname(self):
+        return self._dbname
+    
+    #returns a list of (path,nbytes) of the archive, segment and partition
+    #files.  Only the first nbytes of a file hold data.  See gh_db_backup
+    def get_raw_files(self):
+        files=[(path,os.path.getsize(path)) for path in self._archive.get_files()]
+        if self._raw_store is not None:
+            files.extend(self._raw_store.get_files())
+        return files
       
     '''
     Returns raw data between two timestamps (in ms)
     '''
     def get_raw_line(self,Tstart,Tstop):
-        with self._lock:
-            rows=self._db.execute("SELECT * FROM raw_data WHERE timestamp>=? AND timestamp<=? ORDER BY timestamp ASC",\
-                            (Tstart,Tstop))
-            data=[]
-            #add a 0.1lx offset for light readings to prevent zeros screwing up log scale
-            if self._op_desc['ptype']=='light':
-                offset=0.1 #lx
+        data=self._read('raw_data',Tstart,Tstop,'line')
+        pending=self._get_pending_rows(data[-1][0]+1 if len(data)>0 else Tstart,Tstop)
+        if len(pending)>0:
+            offset=self._get_offset()
+            data=data+[(ts,val*self._val_uncomp_mult+offset) for (ts,val) in pending]
+        return data
+    
+    '''
+        set_pending
+        get_pending(pdb) returns the (timestamp,val) samples of pdb that the
+        writer holds but hasn't committed yet (see gh_db_writer.get_pending).
+        get_raw_line and get_raw_array add the ones after the stored data,
+        so a live graph doesn't lag by up to commit_delay
+    '''
+    def set_pending(self,get_pending):
+        self._get_pending=get_pending
+        
+    #pending (ts,val) rows between two timestamps, compressed like the stored ones
+    def _get_pending_rows(self,Tstart,Tstop):
+        if self._get_pending is None:
+            return []
+        rows=[(to_timestamp(ts),self.compress_val(val)) for (ts,val) in self._get_pending(self)]
+        return sorted(row for row in rows if Tstart<=row[0]<=Tstop)
+    
+    #reads (ts,val) from raw_data using connection con
+    def _get_raw_rows(self,con,Tstart,Tstop):
+        rows=self._iter_raw(con,Tstart,Tstop)
+        data=[]
+        #add a 0.1lx offset for light readings to prevent zeros screwing up log scale
+        if self._op_desc['ptype']=='light':
+            offset=0.1 #lx
+        else:
+            offset=0
+        for row in rows:
+            data.append ((row[0],row[1]*self._val_uncomp_mult+offset))
+        return data
+        
+    #unscaled (ts,val) rows from the archive and then from the raw_store or
+    #raw_data, using connection con
+    def _iter_raw(self,con,Tstart,Tstop):
+        parts=[]
+        Tarch=self._archive.get_end()
+        if Tstart<Tarch:
+            parts.append(self._archive.iter_range(Tstart,min(Tstop,Tarch-1)))
+            Tstart=Tarch
+        if Tstart<=Tstop:
+            if self._raw_store is not None:
+                parts.append(self._raw_store.read(Tstart,Tstop))
             else:
-                offset=0
-            for row in rows:
-                data.append ((row[0],row[1]*self._val_uncomp_mult+offset))
-            return data
+                parts.append(con.execute(self._sql("SELECT timestamp,val FROM raw_data WHERE {sid}timestamp>=? AND timestamp<=? ORDER BY timestamp ASC"),\
+                                         (Tstart,Tstop)))
+        return chain(*parts)
         
     '''returns compressed line between two timestamps
     data is tuples of (ts,avg,min,max)
     '''
     def get_comp_line(self,Tstart,Tstop):
-        with self._lock:
-            rows=self._db.execute("SELECT * FROM comp_data WHERE timestamp>=? AND timestamp<=? ORDER BY timestamp ASC",\
-                            (Tstart,Tstop))
-            data=[]
-            #add a 0.1lx offset for light readings to prevent zeros screwing up log scale
-            if self._op_desc['ptype']=='light':
-                offset=0.1 #lx
+        return self._read('comp_data',Tstart,Tstop,'line')
+        
+    #reads (ts,avg,min,max) from a comp tier table using connection con
+    def _get_tier_rows(self,con,table,Tstart,Tstop):
+        rows=con.execute(self._sql("SELECT timestamp,avg,min,max FROM %s WHERE {sid}timestamp>=? AND timestamp<=? ORDER BY timestamp ASC" % table),\
+                        (Tstart,Tstop))
+        data=[]
+        #add a 0.1lx offset for light readings to prevent zeros screwing up log scale
+        if self._op_desc['ptype']=='light':
+            offset=0.1 #lx
+        else:
+            offset=0
+        for row in rows:
+            data.append ((row[0],row[1]*self._val_uncomp_mult+offset,\
+                          row[2]*self._val_uncomp_mult+offset,\
+                          row[3]*self._val_uncomp_mult+offset))
+        return data
+    
+    '''
+        get_tier_line
+        As get_comp_line, but reads the coarsest tier that still gives at
+        least one period per pixel for a plot npixels wide.
+        The newest periods of a coarse tier are only built once they close,
+        so the end of the line is filled in from the finer tiers.
+        Returns (period,data) where period is the period of the tier used
+    '''
+    def get_tier_line(self,Tstart,Tstop,npixels):
+        k=self._choose_tier(Tstart,Tstop,npixels)
+        data=[]
+        Tfrom=Tstart
+        for j in range(k,-1,-1):
+            rows=self._read(self._tiers[j][0],Tfrom,Tstop,'line')
+            data.extend(rows)
+            if len(data)>0:
+                Tfrom=data[-1][0]+1
+        return (self._tiers[k][1],data)
+        
+    #index of the coarsest tier with at least one period per pixel
+    def _choose_tier(self,Tstart,Tstop,npixels):
+        Tpixel=(Tstop-Tstart)/max(npixels,1)
+        k=0
+        for j in range(1,len(self._tiers)):
+            if self._tiers[j][1]<=Tpixel:
+                k=j
+        return k
+    
+    '''
+        NumPy query path
+        These return the same data as get_raw_line, get_comp_line and
+        get_tier_line, but as one NumPy structured array (RAW_DTYPE or
+        COMP_DTYPE) instead of a list of tuples.  The rows go straight from
+        the cursor into the array and the scaling is done on whole columns,
+        so no Python objects are kept per point.
+        Only available if numpy is installed (_numpy_ok)
+    '''
+    def get_raw_array(self,Tstart,Tstop):
+        data=self._read('raw_data',Tstart,Tstop,'array')
+        pending=self._get_pending_rows(int(data['ts'][-1])+1 if len(data)>0 else Tstart,Tstop)
+        if len(pending)>0:
+            data=np.concatenate((data,np.array(pending,dtype=RAW_DTYPE)))
+        data['val']=data['val']*self._val_uncomp_mult+self._get_offset()
+        return data
+    
+    def get_comp_array(self,Tstart,Tstop):
+        data=self._read('comp_data',Tstart,Tstop,'array')
+        return self._scale_comp_array(data)
+    
+    #returns (period,data).  See get_tier_line
+    def get_tier_array(self,Tstart,Tstop,npixels):
+        k=self._choose_tier(Tstart,Tstop,npixels)
+        parts=[]
+        Tfrom=Tstart
+        for j in range(k,-1,-1):
+            part=self._read(self._tiers[j][0],Tfrom,Tstop,'array')
+            if len(part)>0:
+                parts.append(part)
+                Tfrom=int(part['ts'][-1])+1
+        if len(parts)==1:
+            data=parts[0]
+        else:
+            data=np.concatenate(parts) if len(parts)>0 else np.empty(0,dtype=COMP_DTYPE)
+        return (self._tiers[k][1],self._scale_comp_array(data))
+    
+    #reads raw_data into an unscaled RAW_DTYPE array using connection con
+    def _get_raw_array(self,con,Tstart,Tstop):
+        parts=[]
+        Tarch=self._archive.get_end()
+        if Tstart<Tarch:
+            parts.append(np.fromiter(self._archive.iter_range(Tstart,min(Tstop,Tarch-1)),dtype=RAW_DTYPE))
+            Tstart=Tarch
+        if Tstart<=Tstop:
+            if self._raw_store is not None:
+                seg=self._raw_store.read_array(Tstart,Tstop)
+                data=np.empty(len(seg),dtype=RAW_DTYPE)
+                data['ts']=seg['ts']
+                data['val']=seg['val']
+                parts.append(data)
             else:
-                offset=0
+                rows=con.execute(self._sql("SELECT timestamp,val FROM raw_data WHERE {sid}timestamp>=? AND timestamp<=? ORDER BY timestamp ASC"),\
+                                (Tstart,Tstop))
+                parts.append(np.fromiter(rows,dtype=RAW_DTYPE))
+        if len(parts)==1:
+            return parts[0]
+        return np.concatenate(parts) if len(parts)>0 else np.empty(0,dtype=RAW_DTYPE)
+    
+    #reads a comp tier table into a COMP_DTYPE array using connection con
+    def _get_tier_array(self,con,table,Tstart,Tstop):
+        rows=con.execute(self._sql("SELECT timestamp,avg,min,max FROM %s WHERE {sid}timestamp>=? AND timestamp<=? ORDER BY timestamp ASC" % table),\
+                        (Tstart,Tstop))
+        return np.fromiter(rows,dtype=COMP_DTYPE)
+    
+    def _scale_comp_array(self,data):
+        offset=self._get_offset()
+        for col in ('avg','min','max'):
+            data[col]=data[col]*self._val_uncomp_mult+offset
+        return data
+    
+    #reads rows from table using connection con.  fmt is 'line' for a
+    #scaled list of tuples or 'array' for an unscaled NumPy array
+    def _fetch(self,con,table,Tstart,Tstop,fmt):
+        if fmt=='array':
+            if table=='raw_data':
+                return self._get_raw_array(con,Tstart,Tstop)
+            return self._get_tier_array(con,table,Tstart,Tstop)
+        if table=='raw_data':
+            return self._get_raw_rows(con,Tstart,Tstop)
+        return self._get_tier_rows(con,table,Tstart,Tstop)
+    
+    '''
+        _read
+        Reads table between Tstart and Tstop (see _fetch for fmt).
+        With a tile_cache the range is split into whole tiles aligned to
+        multiples of the tile span.  Each tile comes from the cache if it
+        is there, otherwise it is read and added to the cache.  The tiles
+        are then joined and trimmed to Tstart..Tstop.  The result is always
+        a new list/array, so callers can change it without touching the cache.
+        Ranges of more than MAX_READ_TILES tiles are read directly
+    '''
+    def _read(self,table,Tstart,Tstop,fmt):
+        cache=self._cache
+        if cache is not None:
+            span=self._tile_spans[table]
+            i0=int(Tstart)//span
+            i1=int(Tstop)//span
+            if i1-i0>=MAX_READ_TILES:
+                cache=None
+        if cache is None:
+            with self._reader() as con:
+                return self._fetch(con,table,Tstart,Tstop,fmt)
+        tiles=[]
+        for i in range(i0,i1+1):
+            key=(self._tname,self._pname,table,fmt,i)
+            tile=cache.get(key)
+            if tile is None:
+                gen=cache.get_generation(self._tname,self._pname)
+                with self._reader() as con:
+                    tile=self._fetch(con,table,i*span,(i+1)*span-1,fmt)
+                cache.put(key,tile,gen)
+            tiles.append(tile)
+        if fmt=='array':
+            if len(tiles)==0:
+                return np.empty(0,dtype=RAW_DTYPE if table=='raw_data' else COMP_DTYPE)
+            data=np.concatenate(tiles)
+            return data[np.searchsorted(data['ts'],Tstart,'left'):\
+                        np.searchsorted(data['ts'],Tstop,'right')]
+        data=[]
+        for tile in tiles:
+            data.extend(tile)
+        #rows are tuples starting with the timestamp
+        return data[bisect_left(data,(Tstart,)):bisect_right(data,(Tstop,inf))]
+    
+    #returns the tile_cache stats, or None if there is no cache
+    def get_cache_stats(self):
+        if self._cache is None:
+            return None
+        return self._cache.get_stats()
+    
+    '''
+        get_buckets
+        Splits Tstart..Tstop into buckets Tbucket ms wide, starting at
+        Tstart, and returns a list with a value for each bucket:-
+        mode='avg' - average of the samples in the bucket, or None if there
+                     are none
+        mode='locf' - the last sample before the end of the bucket (last
+                      observation carried forward), or None if there is none
+        The data is read from the coarsest tier that fits the buckets, so
+        long spans only read a few rows.  A rollup tier fits if Tstart and
+        Tbucket are multiples of its period (so each period falls in one
+        bucket), any tier fits if Tbucket is at least ALIGN_TIER_RATIO
+        periods.  Otherwise raw data is read.  The values are those of the
+        graph lines.
+        For 'locf' a tier only shows which buckets have samples.  The value
+        of each of those is looked up with as_of(), so it is always a
+        sample value, never a period average.
+    '''
+    def get_buckets(self,Tstart,Tstop,Tbucket,mode='avg'):
+        nbuckets=int((Tstop-Tstart)//Tbucket)+1
+        table='raw_data'
+        shift=0  #rollup timestamps are the END of the period, so move them back into it
+        for (tier_table,period) in self._tiers:
+            aligned=tier_table!='comp_data' and Tstart%period==0 and Tbucket%period==0
+            if aligned or period*ALIGN_TIER_RATIO<=Tbucket:
+                table=tier_table
+                tier_period=period
+                shift=0 if tier_table=='comp_data' else 1
+        rows=self._read(table,Tstart,Tstop+shift,'line')
+        if mode=='locf':
+            values=[None]*nbuckets
+            last=self.as_of(Tstart-1)
+            if last is not None:
+                last=last[1]+self._get_offset()
+            if table!='raw_data':
+                #the buckets each period's samples can be in.  Periods are
+                #aligned to multiples of the period
+                filled=set()
+                for row in rows:
+                    Tp=((row[0]-shift)//tier_period)*tier_period
+                    i0=max(0,int((Tp-Tstart)//Tbucket))
+                    i1=min(nbuckets-1,int((row[0]-shift-Tstart)//Tbucket))
+                    filled.update(range(i0,i1+1))
+                for i in range(nbuckets):
+                    if i in filled:
+                        row=self.as_of(min(Tstart+(i+1)*Tbucket-1,Tstop))
+                        if row is not None:
+                            last=row[1]+self._get_offset()
+                    values[i]=last
+                return values
+            j=0
             for row in rows:
-                data.append ((row[0],row[1]*self._val_uncomp_mult+offset,\
-                              row[2]*self._val_uncomp_mult+offset,\
-                              row[3]*self._val_uncomp_mult+offset))
-            return data 
+                i=int((row[0]-shift-Tstart)//Tbucket)
+                while j<i and j<nbuckets:
+                    values[j]=last
+                    j=j+1
+                last=row[1]
+            while j<nbuckets:
+                values[j]=last
+                j=j+1
+            return values
+        sums=[0.0]*nbuckets
+        counts=[0]*nbuckets
+        for row in rows:
+            i=int((row[0]-shift-Tstart)//Tbucket)
+            if 0<=i<nbuckets:
+                sums[i]=sums[i]+row[1]
+                counts[i]=counts[i]+1
+        return [sums[i]/counts[i] if counts[i]>0 else None for i in range(nbuckets)]
+    
+    '''
+        as_of
+        Returns (timestamp,val) of the last raw sample at or before T (ms),
+        or None if there isn't one.  This is one indexed seek in whichever
+        of the archive, the raw_store or raw_data holds T.
+        val is the stored value, without the plot offset of get_raw_line
+    '''
+    def as_of(self,T):
+        Tarch=self._archive.get_end()
+        row=None
+        if T>=Tarch:
+            #any raw rows left below Tarch are the newest archived ones, so
+            #are still the right answer
+            if self._raw_store is not None:
+                row=self._raw_store.get_last_at(T)
+            else:
+                with self._reader() as con:
+                    row=con.execute(self._sql("SELECT timestamp,val FROM raw_data \
+                            WHERE {sid}timestamp<=? ORDER BY timestamp DESC LIMIT 1"),(T,)).fetchone()
+        if row is None and Tarch>0:
+            row=self._archive.get_last_at(min(T,Tarch-1))
+        if row is None:
+            return None
+        return (row[0],self.uncompress_val(row[1]))
+    
+    '''
+        iter_export
+        Yields the rows of table ('raw_data', 'comp_data' or a rollup tier
+        table) between Tstart and Tstop as lists of (ts,val) for raw_data or
+        (ts,avg,min,max) for the others.  Values are de-scaled by
+        val_comp_mult, without the plot offset of the graph lines.
+        Each list is one window of EXPORT_RAW_SPAN ms or EXPORT_TIER_PERIODS
+        periods, read with its own read connection, so an export of any
+        length holds little in memory and never keeps the lock for long.
+        Each window starts at the next row, so gaps in the data are skipped
+        in one seek.  The tile_cache isn't used
+    '''
+    def iter_export(self,table,Tstart,Tstop):
+        if table=='raw_data':
+            span=EXPORT_RAW_SPAN
+        else:
+            span=dict(self._tiers)[table]*EXPORT_TIER_PERIODS
+        mult=self._val_uncomp_mult
+        T0=Tstart
+        while T0<=Tstop:
+            with self._reader() as con:
+                T0=self._get_first_at(con,table,T0)
+                if T0 is None or T0>Tstop:
+                    return
+                T1=min(Tstop,T0+span-1)
+                if table=='raw_data':
+                    rows=[(ts,val*mult) for (ts,val) in self._iter_raw(con,T0,T1)]
+                else:
+                    rows=con.execute(self._sql("SELECT timestamp,avg,min,max FROM %s WHERE {sid}timestamp>=? AND timestamp<=? ORDER BY timestamp ASC" % table),\
+                                    (T0,T1))
+                    rows=[(ts,avg*mult,vmin*mult,vmax*mult) for (ts,avg,vmin,vmax) in rows]
+            yield rows
+            T0=T1+1
+    
+    #returns the first timestamp at or after T in table, or None, using connection con
+    def _get_first_at(self,con,table,T):
+        if table!='raw_data':
+            return con.execute(self._sql("SELECT MIN(timestamp) FROM %s WHERE {sid}timestamp>=?" % table),(T,)).fetchone()[0]
+        Tarch=self._archive.get_end()
+        if T<Tarch:
+            for row in self._archive.iter_range(T,Tarch-1):
+                return row[0]
+            T=Tarch
+        if self._raw_store is not None:
+            return self._raw_store.get_first_after(T-1)
+        return con.execute(self._sql("SELECT MIN(timestamp) FROM raw_data WHERE {sid}timestamp>=?"),(T,)).fetchone()[0]
+    
+    #add a 0.1lx offset for light readings to prevent zeros screwing up log scale
+    def _get_offset(self):
+        if self._op_desc['ptype']=='light':
+            return 0.1 #lx
+        return 0
+        
+    #returns a list of (table,period) for comp_data and each rollup tier
+    def get_tiers(self):
+        return self._tiers
         
     def get_Tchunk(self):
         return self._Tchunk
 
+'''chunk_acc
+Running min/max/sum/count for the open compression chunk.  See
+param_db._stream_add()
+'''
+class chunk_acc:
+    __slots__=('Tstart','Tlast','min','max','sum','n')
+    
+    def __init__(self,ts,val):
+        self.Tstart=ts
+        self.Tlast=ts
+        self.min=val
+        self.max=val
+        self.sum=val
+        self.n=1
+        
+    def add(self,ts,val):
+        if ts>self.Tlast:
+            self.Tlast=ts
+        if val<self.min:
+            self.min=val
+        if val>self.max:
+            self.max=val
+        self.sum=self.sum+val
+        self.n=self.n+1
+        
+    #returns the comp_data row (timestamp,avg,min,max)
+    def get_row(self):
+        return (self.Tlast,self.sum/self.n,self.min,self.max)
+
+'''read_pool
+A small pool of read-only connections to one db file.
+
+In WAL mode readers don't block the writer and the writer doesn't block
+readers, but a connection can only be used by one thread at a time.  So
+the GUI, the webserver etc each borrow a connection from the pool for
+the length of a query.  Connections are opened when first needed, up to
+size of them.  If they are all in use the next reader waits.
+'''
+READ_POOL_SIZE=2  #read connections per param_db
+
+class read_pool:
+    def __init__(self,dbname,size=READ_POOL_SIZE):
+        self._uri=get_ro_uri(dbname)
+        self._free=queue.LifoQueue()
+        self._sem=threading.BoundedSemaphore(size)
+        
+    @contextmanager
+    def connection(self):
+        with self._sem:
+            try:
+                con=self._free.get(block=False)
+            except queue.Empty:
+                con=sqlite3.connect(self._uri,uri=True,check_same_thread=False)
+            try:
+                yield con
+            finally:
+                self._free.put(con)
+                
+    def close(self):
+        while True:
+            try:
+                con=self._free.get(block=False)
+            except queue.Empty:
+                break
+            con.close()
+            
+'''wait_stats
+Count, total, max and a histogram of a set of times in seconds
+
+hist[i] counts the times up to STATS_BOUNDS[i] (and over the bound
+before), with a last bucket for anything longer.  add() only costs a
+bisect, so it is always on.  It isn't locked - param_db only adds with
+its lock held.
+'''
+STATS_BOUNDS=[0.0001,0.0003,0.001,0.003,0.01,0.03,0.1,0.3,1.0,3.0,10.0]
+class wait_stats:
+    def __init__(self):
+        self._count=0
+        self._total=0.0
+        self._max=0.0
+        self._hist=[0]*(len(STATS_BOUNDS)+1)
+        
+    def add(self,t):
+        self._count=self._count+1
+        self._total=self._total+t
+        if t>self._max:
+            self._max=t
+        self._hist[bisect_left(STATS_BOUNDS,t)]+=1
+        
+    #adds in a dictionary from get(), to total the stats of several
+    def add_stats(self,data):
+        self._count=self._count+data['count']
+        self._total=self._total+data['total']
+        self._max=max(self._max,data['max'])
+        for i in range(len(self._hist)):
+            self._hist[i]=self._hist[i]+data['hist'][i]
+            
+    def get(self):
+        data=dict()
+        data['count']=self._count
+        data['total']=self._total
+        data['max']=self._max
+        data['mean']=self._total/self._count if self._count>0 else 0.0
+        data['hist']=list(self._hist)
+        data['bounds']=STATS_BOUNDS
+        return data
+
+'''tile_cache------------------------------------------------
+Query result cache
+
+A bounded LRU cache of query results shared by all the param_db's.  The
+GUI graphs and the webserver mostly redraw the same recent windows, so
+most of their reads can be served without going to sqlite.
+
+Results are cached in tiles.  A tile is all the rows of one table of one
+series in a fixed time span, aligned to a multiple of the span:-
+raw_data - TILE_RAW_SPAN
+comp_data and the rollup tiers - TILE_PERIODS periods of the tier
+so different windows over the same data share tiles.  The key is
+(tname,pname,table,fmt,tile index) where fmt is 'line' or 'array'.
+
+A tile is dropped when a commit changes any row in its span, so only
+the tile holding "now" is ever reloaded while older tiles stay cached.
+Every drop also bumps a generation count for the series, and a tile read
+while a commit was going on isn't added (see put()), as it could already
+be stale.
+
+Tiles are evicted least recently used first once the estimated size of
+all the tiles passes max_bytes.
+'''
+TILE_RAW_SPAN=60*60*1000  #ms of raw_data in a tile
+TILE_PERIODS=256          #tier periods in a tile
+MAX_READ_TILES=64         #reads spanning more tiles than this skip the cache
+
+class tile_cache:
+    def __init__(self,max_bytes=DEFAULT_CACHE_SIZE):
+        self._lock=threading.Lock()
+        self._max_bytes=max_bytes
+        self._tiles=OrderedDict()  #key -> (tile,nbytes), least recently used first
+        self._nbytes=0
+        self._gen=dict()   #(tname,pname) -> generation
+        self._hits=0
+        self._misses=0
+        
+    #returns the tile for key, or None if it isn't cached
+    def get(self,key):
+        with self._lock:
+            entry=self._tiles.get(key,None)
+            if entry is None:
+                self._misses=self._misses+1
+                return None
+            self._tiles.move_to_end(key)
+            self._hits=self._hits+1
+            return entry[0]
+        
+    #call before reading a tile and pass the result to put()
+    def get_generation(self,tname,pname):
+        with self._lock:
+            return self._gen.get((tname,pname),0)
+        
+    #adds a tile, unless the series has been invalidated since gen was read
+    def put(self,key,tile,gen):
+        nbytes=self._get_size(tile)
+        with self._lock:
+            if self._gen.get(key[:2],0)!=gen or nbytes>self._max_bytes:
+                return
+            if key in self._tiles:
+                self._nbytes=self._nbytes-self._tiles.pop(key)[1]
+            self._tiles[key]=(tile,nbytes)
+            self._nbytes=self._nbytes+nbytes
+            while self._nbytes>self._max_bytes:
+                (_,(_,n))=self._tiles.popitem(last=False)
+                self._nbytes=self._nbytes-n
+                
+    #drops the tiles of a table of a series that overlap Tmin..Tmax
+    def invalidate(self,tname,pname,table,Tmin,Tmax,span):
+        i0=int(Tmin)//span
+        i1=int(Tmax)//span
+        with self._lock:
+            self._gen[(tname,pname)]=self._gen.get((tname,pname),0)+1
+            for key in [k for k in self._tiles if k[0]==tname and k[1]==pname and \
+                        k[2]==table and i0<=k[4]<=i1]:
+                self._nbytes=self._nbytes-self._tiles.pop(key)[1]
+                
+    #estimated memory used by a tile
+    def _get_size(self,tile):
+        if _numpy_ok and isinstance(tile,np.ndarray):
+            return tile.nbytes
+        nbytes=sys.getsizeof(tile)
+        if len(tile)>0:
+            nbytes=nbytes+len(tile)*(sys.getsizeof(tile[0])+sum(sys.getsizeof(v) for v in tile[0]))
+        return nbytes
+    
+    def get_stats(self):
+        with self._lock:
+            data=dict()
+            data['tiles']=len(self._tiles)
+            data['bytes']=self._nbytes
+            data['max_bytes']=self._max_bytes
+            data['hits']=self._hits
+            data['misses']=self._misses
+            return data
+
+'''shared_store------------------------------------------------
+Single file store
+
+An alternative to one db file per parameter.  Every series is kept in
+one sqlite3 database file (SHARED_DB_NAME) running in WAL mode.  The
+tables are the same as for param_db with an extra series_id column:-
+
+TABLE: series.  Maps series_id to (tname,pname)
+TABLE: raw_data, comp_data, meta_data.  As param_db plus series_id
+
+All series share one connection and one lock, so a flush of every
+parameter is a single commit (one fsync) instead of one per file.
+'''
+SHARED_DB_NAME='greenhouse.db'
+SHARED_READ_POOL_SIZE=4  #read connections shared by all series
+
+class shared_store:
+    def __init__(self,dbname=None,read_only=False):
+        if dbname is None:
+            dbname=DB_DIR+SHARED_DB_NAME
+        self._dbname=dbname
+        self._lock=threading.Lock()
+        self._read_only=read_only   #see param_db.open
+        if read_only:
+            self._db=sqlite3.connect(get_ro_uri(self._dbname),uri=True,check_same_thread=False)
+            self._read_pool=read_pool(self._dbname,SHARED_READ_POOL_SIZE)
+            return
+        with self._lock:
+            self._db=sqlite3.connect(self._dbname, check_same_thread=False)
+            #WAL makes each commit one sequential append to the log
+            #synchronous=NORMAL only syncs at checkpoints, which is safe in WAL mode
+            self._db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS series (
+                            series_id integer PRIMARY KEY,
+                            tname text,
+                            pname text,
+                            UNIQUE(tname,pname))''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS raw_data (
+                            series_id integer,
+                            timestamp integer,
+                            val integer,
+                            PRIMARY KEY(series_id,timestamp)) WITHOUT ROWID''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS comp_data (
+                            series_id integer,
+                            timestamp integer,
+                            avg integer,
+                            min integer,
+                            max integer,
+                            PRIMARY KEY(series_id,timestamp)) WITHOUT ROWID''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS meta_data (
+                            series_id integer,
+                            key text,
+                            val text)''')
+            self._db.commit()
+        self._read_pool=read_pool(self._dbname,SHARED_READ_POOL_SIZE)
+            
+    def get_connection(self):
+        return self._db
+    
+    def get_read_pool(self):
+        return self._read_pool
+    
+    def get_lock(self):
+        return self._lock
+    
+    def get_dbname(self):
+        return self._dbname
+    
+    #returns the series_id for (tname,pname), adding it if it is new
+    #(read only, -1 which has no rows).  The caller must hold the lock
+    def get_series_id(self,tname,pname):
+        if not self._read_only:
+            self._db.execute('INSERT OR IGNORE INTO series (tname,pname) VALUES (?,?)',(tname,pname))
+        row=self._db.execute('SELECT series_id FROM series WHERE tname=? AND pname=?',(tname,pname)).fetchone()
+        return -1 if row is None else row[0]
+    
+    def close(self):
+        self._read_pool.close()
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+            
+'''series_db
+A param_db that keeps its data in a shared_store
+
+The interface is identical to param_db, so gh_io_graph, gh_webserver etc
+don't need to know which backend is used.
+
+If the store has no data for the series but an old per-parameter file
+exists, it is imported when the series is first opened.  See
+migrate_param_file()
+'''
+class series_db(param_db):
+    def __init__(self,**kwargs):
+        self._store=kwargs.pop('store')
+        param_db.__init__(self,**kwargs)
+        
+    def _open_db(self):
+        self._old_dbname=self._dbname
+        self._dbname=self._store.get_dbname()
+        self._lock=self._store.get_lock()
+        with self._lock:
+            self._db=self._store.get_connection()
+            sid=self._store.get_series_id(self._tname,self._pname)
+            self._sqlkeys={'sid':'series_id=%d AND ' % sid,\
+                           'where':' WHERE series_id=%d' % sid,\
+                           'vals':'%d,' % sid}
+            if self._manifest is None and self._read_meta_data()==0 and \
+                not self._read_only and os.path.exists(self._old_dbname):
+                self.migrate_param_file(self._old_dbname)
+        param_db._open_db(self)
+        
+    #the connection belongs to the store
+    def _connect(self):
+        pass
+    
+    #so does the read_pool
+    def _open_read_pool(self):
+        self._read_pool=self._store.get_read_pool()
+    
+    def _create_tables(self):
+        pass
+    
+    def _create_tier_table(self,table):
+        self._db.execute('''CREATE TABLE IF NOT EXISTS %s (
+                        series_id integer,
+                        timestamp integer,
+                        avg integer,
+                        min integer,
+                        max integer,
+                        PRIMARY KEY(series_id,timestamp)) WITHOUT ROWID''' % table)
+    
+    def _close_db(self):
+        self._read_pool=None
+        if self._db is not None:
+            self.commit()
+            self._db=None
+        self._close_raw_store()
+            
+    '''
+        migrate_param_file
+        Imports all data from a per-parameter db file (as written by
+        param_db) into this series.  The old file is left unchanged.
+        The caller must hold the lock
+    '''
+    def migrate_param_file(self,fname):
+        print('gh_db_manager series_db: Importing ',fname,' into ',self._dbname)
+        self._db.commit()   #ATTACH is not allowed inside a transaction
+        self._db.execute('ATTACH DATABASE ? AS old',(fname,))
+        try:
+            self._db.execute(self._sql('INSERT OR IGNORE INTO raw_data \
+                             SELECT {vals}timestamp,val FROM old.raw_data'))
+            self._db.execute(self._sql('INSERT OR IGNORE INTO comp_data \
+                             SELECT {vals}timestamp,avg,min,max FROM old.comp_data'))
+            self._db.execute(self._sql('INSERT INTO meta_data \
+                             SELECT {vals}key,val FROM old.meta_data'))
+            self._db.commit()
+        finally:
+            self._db.execute('DETACH DATABASE old')
+            
+'''gh_db_writer------------------------------------------------
+Writer thread
+
+All writes to the param_db's go through this thread.  process_data() in
+gh_db_manager only queues the sample, so the gh_mon thread never waits
+for sqlite.
+
+Samples are collected into a batch per param_db.  The batch is flushed
+(one executemany per param_db followed by a commit) when either:-
+ - batch_size samples are waiting, or
+ - the oldest waiting sample is older than commit_delay seconds
+
+commit_delay is the durability/latency knob.  It is the longest time a
+sample can be held before it reaches the disk.  With commit_delay=0 every
+sample is committed as soon as the thread sees it, but any samples that
+queued up while the previous commit was running still share one commit.
+
+An error writing to one param_db (e.g. 'database is locked') is printed
+and counted in get_stats()['errors'] and that param_db's batch is lost,
+but the other param_db's and the thread carry on.
+
+Readers only see committed data, so anything read from the databases
+can be up to commit_delay seconds (DEFAULT_COMMIT_DELAY=20) behind.  To
+hide that from the live views:-
+ - get_latest() and as_of() for the latest sample are answered from
+   memory by gh_db_manager
+ - param_db.get_raw_line and get_raw_array add the samples that are
+   still waiting here (see get_pending)
+Everything else (compressed lines, tiers, buckets, exports) still lags.
+'''
+class gh_db_writer(Thread):
+    def __init__(self,**kwargs):
+        Thread.__init__(self)
+        self.daemon=True
+        self._commit_delay=kwargs.get('commit_delay',DEFAULT_COMMIT_DELAY)
+        self._batch_size=kwargs.get('batch_size',DEFAULT_BATCH_SIZE)
+        self._journal=kwargs.get('journal',None)  #gh_db_journal or None
+        self._on_backlog=kwargs.get('on_backlog',None)  #called when compression falls behind.  See gh_db_compactor
+        self._journaled=set()  #param_db's with samples in the journal
+        self._q=queue.Queue(MAX_WRITE_Q_LEN)
+        self._dropped=0        #samples lost because the queue was full
+        self._errors=0         #samples lost because the write failed
+        self._flush_stats=wait_stats()
+        self._batches=dict()   #param_db -> list of (timestamp,val)
+        self._writing=dict()   #the batches being written by _flush
+        self._batches_lock=threading.Lock()  #for get_pending
+        self._n_pending=0
+        self._t_oldest=None    #monotonic time the oldest pending sample arrived
+        self.__running=True
+        
+    def term(self):
+        self.__running=False
+        self._q.put(None)  #wake the thread up
+        
+    #queue one sample for writing.  Called from the gh_mon thread
+    def put(self,pdb,timestamp,val):
+        try:
+            self._q.put((pdb,timestamp,val),block=False)
+        except queue.Full:
+            self._dropped=self._dropped+1
+            print("gh_db_writer: Unable to write data - write queue is full")
+            
+    #queue a list of (pdb,timestamp,val) as one item, so a batch from io_q
+    #costs one queue operation.  Called from the gh_mon thread
+    def put_batch(self,items):
+        try:
+            self._q.put(items,block=False)
+        except queue.Full:
+            self._dropped=self._dropped+len(items)
+            print("gh_db_writer: Unable to write data - write queue is full")
+            
+    #returns the queue length, samples dropped and the flush timings
+    def get_stats(self):
+        stats=dict()
+        stats['queue']=self._q.qsize()
+        stats['queue_max']=MAX_WRITE_Q_LEN
+        stats['dropped']=self._dropped
+        stats['errors']=self._errors
+        stats['flush']=self._flush_stats.get()
+        return stats
+            
+    #returns a list of the (timestamp,val) samples waiting to be committed
+    #to pdb.  Called from the reader threads
+    def get_pending(self,pdb):
+        with self._batches_lock:
+            return self._writing.get(pdb,[])+self._batches.get(pdb,[])
+            
+    #ask the thread to write everything it has and wait until it is done
+    def flush(self):
+        ev=threading.Event()
+        self._q.put(ev)
+        ev.wait()
+        
+    def run(self):
+        pr_cont.set_name('gh_db_writer') #allows process to be idenfified in htop
+        while(self.__running):
+            try:
+                item=self._q.get(timeout=self._get_timeout())
+            except queue.Empty:
+                item=None
+            #take everything already waiting so it can share one commit
+            while item is not None:
+                if isinstance(item,threading.Event):
+                    self._flush()
+                    item.set()
+                elif isinstance(item,list):
+                    for sample in item:
+                        self._add(sample)
+                else:
+                    self._add(item)
+                try:
+                    item=self._q.get(block=False)
+                except queue.Empty:
+                    item=None
+            if self._journal is not None:
+                self._journal.sync_if_due()
+            if self._flush_due():
+                self._flush()
+        self._flush()
+        if self._journal is not None:
+            self._empty_journal()
+        
+    #time to wait for new data before the oldest pending sample is due
+    #or the journal needs syncing
+    def _get_timeout(self):
+        timeout=None
+        if self._t_oldest is not None:
+            timeout=max(0,self._t_oldest+self._commit_delay-monotonic())
+        if self._journal is not None:
+            t_sync=self._journal.get_timeout()
+            if t_sync is not None and (timeout is None or t_sync<timeout):
+                timeout=t_sync
+        return timeout
+        
+    def _add(self,item):
+        (pdb,timestamp,val)=item
+        if self._journal is not None:
+            (tname,pname)=pdb.get_names()
+            self._journal.append(tname,pname,timestamp,val)
+            self._journaled.add(pdb)
+        with self._batches_lock:
+            if pdb not in self._batches:
+                self._batches[pdb]=[]
+            self._batches[pdb].append((timestamp,val))
+        self._n_pending=self._n_pending+1
+        if self._t_oldest is None:
+            self._t_oldest=monotonic()
+            
+    def _flush_due(self):
+        if self._n_pending==0:
+            return False
+        if self._n_pending>=self._batch_size:
+            return True
+        return (monotonic()-self._t_oldest)>=self._commit_delay
+        
+    def _flush(self):
+        if self._n_pending==0:
+            return
+        t0=monotonic()
+        with self._batches_lock:
+            batches=self._batches
+            self._writing=batches
+            self._batches=dict()
+        self._n_pending=0
+        self._t_oldest=None
+        for pdb in list(batches):
+            try:
+                pdb.write_values(batches[pdb])
+            except Exception as e:
+                self._write_failed(pdb,len(batches.pop(pdb)),e)
+        for pdb in batches:
+            try:
+                pdb.commit()
+                if pdb.compress_if_due() and self._on_backlog is not None:   #compression only runs once per chunk
+                    self._on_backlog()
+            except Exception as e:
+                self._write_failed(pdb,len(batches[pdb]),e)
+        with self._batches_lock:
+            self._writing=dict()
+        self._flush_stats.add(monotonic()-t0)
+        if self._journal is not None and self._journal.get_size()>JOURNAL_MAX_SIZE:
+            self._empty_journal()
+            
+    #reports a write to pdb that failed with exception e.  n samples were in the batch
+    def _write_failed(self,pdb,n,e):
+        (tname,pname)=pdb.get_names()
+        self._errors=self._errors+n
+        print('gh_db_writer: Error writing ',n,' samples to ',tname,'/',pname,': ',repr(e))
+        
+    #everything in the journal has been committed.  Once it is on disk
+    #the journal can be emptied
+    def _empty_journal(self):
+        for pdb in self._journaled:
+            if not pdb.sync():
+                return  #try again after the next flush
+        self._journal.reset()
+        self._journaled=set()
+            
+'''gh_db_journal------------------------------------------------
+Write-ahead journal
+
+The writer holds samples for up to commit_delay seconds before they are
+committed, and with synchronous=NORMAL a commit only reaches the disk at
+the next WAL checkpoint.  So that a power cut doesn't lose them, the
+writer first appends every sample to the journal as a line of text:-
+tname<TAB>pname<TAB>ms timestamp<TAB>value
+The journal is fsync'd at most every JOURNAL_SYNC_DELAY seconds, which is
+the most data that can now be lost.  One fsync of a file that is only
+appended to is much cheaper than committing every db.
+
+Once the journal is bigger than JOURNAL_MAX_SIZE the writer makes the
+dbs durable (see param_db.sync) and empties it.  A torn line at the end
+after a crash is ignored.
+
+At start up gh_db_manager replays anything left in the journal before
+the writer starts.  Samples that did reach the db are skipped.
+'''
+JOURNAL_NAME='samples.journal'
+JOURNAL_SYNC_DELAY=1.0        #max seconds between fsyncs of the journal
+JOURNAL_MAX_SIZE=256*1024     #bytes in the journal before it is emptied
+USE_JOURNAL=True
+
+class gh_db_journal:
+    def __init__(self,fname=None):
+        if fname is None:
+            fname=DB_DIR+JOURNAL_NAME
+        self._fname=fname
+        self._f=open(fname,'a',encoding='utf-8',newline='\n')
+        self._t_unsynced=None  #monotonic time of the first sample not synced
+        
+    def append(self,tname,pname,timestamp,val):
+        self._f.write('%s\t%s\t%d\t%r\n' % (tname,pname,to_timestamp(timestamp),float(val)))
+        if self._t_unsynced is None:
+            self._t_unsynced=monotonic()
+            
+    #seconds until the journal is due to be synced, or None
+    def get_timeout(self):
+        if self._t_unsynced is None:
+            return None
+        return max(0,self._t_unsynced+JOURNAL_SYNC_DELAY-monotonic())
+    
+    def sync_if_due(self):
+        if self._t_unsynced is not None and \
+            monotonic()-self._t_unsynced>=JOURNAL_SYNC_DELAY:
+            self.sync()
+            
+    def sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._t_unsynced=None
+        
+    def get_size(self):
+        return self._f.tell()
+    
+    #empties the journal.  Everything in it must already be in the dbs
+    def reset(self):
+        self._f.flush()
+        self._f.truncate(0)
+        os.fsync(self._f.fileno())
+        self._t_unsynced=None
+        
+    def close(self):
+        self.sync()
+        self._f.close()
+        
+    '''
+        read
+        Returns the samples in journal file fname as a list of
+        (tname,pname,ms timestamp,value)
+    '''
+    @staticmethod
+    def read(fname=None):
+        if fname is None:
+            fname=DB_DIR+JOURNAL_NAME
+        data=[]
+        if not os.path.exists(fname):
+            return data
+        with open(fname,'r',encoding='utf-8',newline='\n',errors='replace') as f:
+            for line in f:
+                fields=line.split('\t')
+                if not line.endswith('\n') or len(fields)!=4:
+                    continue  #torn write
+                try:
+                    data.append((fields[0],fields[1],int(fields[2]),float(fields[3])))
+                except ValueError:
+                    continue
+        return data
+    
+'''gh_db_compactor------------------------------------------------
+Catch-up compaction thread
+
+compress_next_chunk only compresses one chunk each time the writer
+commits, so after downtime or an import comp_data lags raw_data.  This
+thread runs through every param_db and compresses any backlog in bulk
+(COMPACT_CHUNKS chunks per GROUP BY query), releasing the param_db lock
+between queries so the writer and readers are only held up briefly.
+
+It makes a pass at start up, whenever the writer finds a backlog after a
+flush (see wake()) and every COMPACT_PERIOD seconds in case anything else
+has left one.  A pass over dbs with no backlog costs a couple of queries
+each.
+
+Progress is stored in the dbs themselves so a stopped job resumes where
+it left off next time.  get_progress() reports how far each db has got.
+'''
+COMPACT_CHUNKS=144      #chunks per query (1 day of 10 minute chunks)
+COMPACT_STEP_DELAY=0.05 #seconds to yield between queries
+COMPACT_PERIOD=10*60    #seconds between passes if nothing wakes the thread
+
+class gh_db_compactor(Thread):
+    def __init__(self,dbs):
+        Thread.__init__(self)
+        self.daemon=True
+        self._dbs=dbs  #dictionary of param_db's as gh_db_manager._dbs
+        self._progress=dict()
+        self._stop_ev=threading.Event()
+        self._wake_ev=threading.Event()
+        
+    def term(self):
+        self._stop_ev.set()
+        self._wake_ev.set()
+        
+    #start a pass now.  Can be called from any thread
+    def wake(self):
+        self._wake_ev.set()
+        
+    #returns a dictionary (tname,pname) -> fraction of the backlog done (0-1)
+    def get_progress(self):
+        return dict(self._progress)
+        
+    def run(self):
+        pr_cont.set_name('gh_db_compactor') #allows process to be idenfified in htop
+        while not self._stop_ev.is_set():
+            self._wake_ev.clear()
+            nchunks=0
+            for tname in self._dbs:
+                for pname in self._dbs[tname]:
+                    if self._stop_ev.is_set():
+                        return
+                    nchunks=nchunks+self._compact_db(tname,pname,self._dbs[tname][pname])
+            if nchunks>0:
+                print('gh_db_compactor: Compaction complete')
+            self._wake_ev.wait(COMPACT_PERIOD)
+        
+    #compresses the backlog of one db.  Returns the number of chunks written
+    def _compact_db(self,tname,pname,pdb):
+        (Tfirst,Tcl,Tend)=pdb.get_compaction_state()
+        nchunks=0
+        while not self._stop_ev.is_set():
+            n=pdb.compact(COMPACT_CHUNKS)
+            if n==0:
+                break
+            if nchunks==0:
+                print('gh_db_compactor: Compacting ',tname,'/',pname)
+            nchunks=nchunks+n
+            (T,Tcl,Traw_last)=pdb.get_compaction_state()
+            self._progress[(tname,pname)]=max(0.0,min(1.0,(Tcl-Tfirst)/max(1,Tend-Tfirst)))
+            sleep(COMPACT_STEP_DELAY)
+        self._progress[(tname,pname)]=1.0
+        if nchunks>0:
+            print('gh_db_compactor: ',tname,'/',pname,': ',nchunks,' chunks compressed')
+        return nchunks
+            
+'''gh_db_retention------------------------------------------------
+Retention and archive thread
+
+raw_data grows forever unless it is pruned.  Every RETENTION_PERIOD
+seconds this thread deletes raw_data older than the retention time set
+for the ptype of each parameter.  comp_data and the rollup tiers are kept
+forever, and raw_data is only deleted once it has been compressed.
+
+Deletion is done RETENTION_BATCH rows at a time, and freed pages are
+returned with incremental vacuum RETENTION_VACUUM_PAGES at a time, so
+the param_db lock is never held for long.  Files from before incremental
+vacuum keep their free pages for reuse (see param_db.incremental_vacuum).
+
+retention is a dictionary ptype -> days of raw_data to keep.  A ptype
+that isn't listed uses the '*' entry if there is one, otherwise it is
+kept forever.  e.g. {'*':30, 'light':7}
+
+If archive is True, the raw data of each month that is over is also
+moved into the archive files (see param_db.archive_month) before
+pruning.  The retention time applies to the archive as well.
+'''
+RAW_RETENTION=dict()          #keep everything by default
+RETENTION_PERIOD=60*60        #seconds between pruning runs
+RETENTION_BATCH=2000          #rows deleted per query
+RETENTION_VACUUM_PAGES=256    #pages freed per incremental vacuum
+RETENTION_STEP_DELAY=0.05     #seconds to yield between queries
+ARCHIVE_RAW=True              #move the raw data of past months to the archive
+
+class gh_db_retention(Thread):
+    def __init__(self,dbs,retention,archive=ARCHIVE_RAW):
+        Thread.__init__(self)
+        self.daemon=True
+        self._dbs=dbs  #dictionary of param_db's as gh_db_manager._dbs
+        self._retention=retention
+        self._archive=archive
+        self._stop_ev=threading.Event()
+        
+    def term(self):
+        self._stop_ev.set()
+        
+    #returns the number of days of raw_data to keep for a ptype, or None
+    def get_retention_days(self,ptype):
+        if ptype in self._retention:
+            return self._retention[ptype]
+        return self._retention.get('*',None)
+        
+    def run(self):
+        pr_cont.set_name('gh_db_retention') #allows process to be idenfified in htop
+        while not self._stop_ev.is_set():
+            for tname in self._dbs:
+                for pname in self._dbs[tname]:
+                    if self._stop_ev.is_set():
+                        return
+                    self._prune_db(tname,pname,self._dbs[tname][pname])
+            self._stop_ev.wait(RETENTION_PERIOD)
+            
+    def _prune_db(self,tname,pname,pdb):
+        nrows=0
+        if self._archive:
+            nrows=self._archive_db(pdb)
+        days=self.get_retention_days(pdb.get_meta_data().get('ptype',None))
+        if days is not None:
+            Tcutoff=datetime_to_timestamp(datetime.now()-timedelta(days=days))
+            n=self._prune_raw(pdb,Tcutoff)
+            while not self._stop_ev.is_set() and pdb.prune_archive(Tcutoff)>0:
+                pass
+            if n>0:
+                print('gh_db_retention: ',tname,'/',pname,': ',n,' raw rows deleted')
+            nrows=nrows+n
+        if nrows==0:
+            return
+        while not self._stop_ev.is_set():
+            if not pdb.incremental_vacuum(RETENTION_VACUUM_PAGES):
+                break
+            sleep(RETENTION_STEP_DELAY)
+            
+    #deletes raw_data before Tcutoff in batches. Returns the number of rows
+    def _prune_raw(self,pdb,Tcutoff):
+        nrows=0
+        while not self._stop_ev.is_set():
+            n=pdb.prune_raw(Tcutoff,RETENTION_BATCH)
+            if n==0:
+                break
+            nrows=nrows+n
+            sleep(RETENTION_STEP_DELAY)
+        return nrows
+    
+    #archives every month before this one, then deletes the archived raw_data.
+    #Returns the number of raw_data rows deleted
+    def _archive_db(self,pdb):
+        now=datetime.now()
+        Tlimit=datetime_to_timestamp(datetime(now.year,now.month,1))
+        while not self._stop_ev.is_set():
+            if pdb.archive_month(Tlimit)==0:
+                break
+            sleep(RETENTION_STEP_DELAY)
+        return self._prune_raw(pdb,pdb.get_archive_end())
+            
+'''gh_db_backup------------------------------------------------
+Backup thread
+
+Copying DB_DIR while the system is running can give torn files, and
+stopping it to take a copy loses the samples that arrive meanwhile.
+Every period seconds this thread brings dirname up to date with a copy
+of DB_DIR that can be used in its place:-
+sqlite databases - copied with param_db.backup(), which only holds the
+                   lock for BACKUP_PAGES pages at a time.  A database is
+                   only copied if it has changed since the last backup
+archive files - never change once written, so only new ones are copied
+segment files - are only ever appended to, so only the bytes added
+                since the last backup are copied
+partition files - are databases with their own WAL, so a read connection
+                  copies a consistent snapshot in one backup step without
+                  holding up the writer.  Only copied if they have changed
+Archive, segment and partition files that have been deleted from DB_DIR
+(e.g. by gh_db_retention) are deleted from the backup as well.
+
+Samples still in the writer when the backup is taken are not in it.
+'''
+BACKUP_DIR=None               #None for no backups
+BACKUP_PERIOD=6*60*60         #seconds between backups
+BACKUP_PAGES=256              #pages copied per step
+BACKUP_STEP_DELAY=0.01        #seconds to yield the lock between steps
+BACKUP_COPY_SIZE=1024*1024    #bytes copied per read from an archive or segment file
+
+class gh_db_backup(Thread):
+    def __init__(self,dbs,dirname,period=BACKUP_PERIOD):
+        Thread.__init__(self)
+        self.daemon=True
+        self._dbs=dbs  #dictionary of param_db's as gh_db_manager._dbs
+        self._dirname=dirname
+        self._period=period
+        self._changes=dict()   #dbname -> change count when it was last backed up
+        self._stop_ev=threading.Event()
+        
+    def term(self):
+        self._stop_ev.set()
+        
+    def run(self):
+        pr_cont.set_name('gh_db_backup') #allows process to be idenfified in htop
+        while not self._stop_ev.wait(self._period):
+            self.backup_all()
+            
+    '''
+        backup_all
+        Brings the backup up to date.  Can also be called directly, from
+        any thread, for a backup now.
+        Returns the number of bytes copied
+    '''
+    def backup_all(self):
+        t0=monotonic()
+        nbytes=0
+        keep=set()   #the archive, segment and partition files in the backup
+        for tname in self._dbs:
+            for pname in self._dbs[tname]:
+                if self._stop_ev.is_set():
+                    return nbytes
+                pdb=self._dbs[tname][pname]
+                try:
+                    nbytes=nbytes+self._backup_db(pdb)
+                    for (path,size) in pdb.get_raw_files():
+                        dest=self._get_dest(path)
+                        if path.endswith('.db'):
+                            nbytes=nbytes+self._backup_partition(path,dest)
+                        else:
+                            nbytes=nbytes+self._copy_file(path,dest,size)
+                        keep.add(dest)
+                except Exception as e:
+                    print('gh_db_backup: Unable to back up ',tname,'/',pname,': ',e)
+        self._remove_stale(keep)
+        print('gh_db_backup: ',nbytes,' bytes copied to ',self._dirname,' in %.1fs' % (monotonic()-t0))
+        return nbytes
+    
+    #returns the path in the backup for path in DB_DIR
+    def _get_dest(self,path):
+        return os.path.join(self._dirname,os.path.relpath(path,DB_DIR))
+    
+    #copies the sqlite database of pdb if it has changed.  With a shared_store
+    #the param_db's share a database, so it is only copied once
+    def _backup_db(self,pdb):
+        dbname=pdb.get_dbname()
+        changes=pdb.get_change_count()
+        dest=self._get_dest(dbname)
+        if self._changes.get(dbname,None)==changes and os.path.exists(dest):
+            return 0
+        os.makedirs(os.path.dirname(dest),exist_ok=True)
+        pdb.backup(dest)
+        self._changes[dbname]=changes
+        return os.path.getsize(dest)
+    
+    #copies a partition database if its file or WAL has changed since the
+    #last backup
+    def _backup_partition(self,src,dest):
+        state=tuple(os.stat(path).st_mtime_ns for path in (src,src+'-wal') if os.path.exists(path))
+        if self._changes.get(src,None)==state and os.path.exists(dest):
+            return 0
+        os.makedirs(os.path.dirname(dest),exist_ok=True)
+        tmp=dest+'.tmp'
+        con=sqlite3.connect(src)
+        out=sqlite3.connect(tmp)
+        try:
+            con.backup(out)
+        finally:
+            out.close()
+            con.close()
+        os.replace(tmp,dest)
+        self._changes[src]=state
+        return os.path.getsize(dest)
+    
+    #copies the first size bytes of src to dest, starting from the end of
+    #what dest already holds
+    def _copy_file(self,src,dest,size):
+        done=os.path.getsize(dest) if os.path.exists(dest) else 0
+        if done==size:
+            return 0
+        if done>size:
+            done=0   #not the same file any more
+        os.makedirs(os.path.dirname(dest),exist_ok=True)
+        with open(src,'rb') as fin, open(dest,'r+b' if done>0 else 'wb') as fout:
+            fin.seek(done)
+            fout.seek(done)
+            while done<size:
+                data=fin.read(min(BACKUP_COPY_SIZE,size-done))
+                if len(data)==0:
+                    break
+                fout.write(data)
+                done=done+len(data)
+            fout.truncate()
+            fout.flush()
+            os.fsync(fout.fileno())
+        return done
+    
+    #deletes archive, segment and partition files that are no longer in DB_DIR
+    def _remove_stale(self,keep):
+        dirs=set(os.path.dirname(dest) for dest in keep)
+        if os.path.isdir(self._dirname):
+            for fname in os.listdir(self._dirname):
+                if fname.endswith('-raw') or fname.endswith('-archive') or fname.endswith('-parts'):
+                    dirs.add(os.path.join(self._dirname,fname))
+        for dirname in dirs:
+            if not os.path.isdir(dirname):
+                continue
+            for fname in os.listdir(dirname):
+                path=os.path.join(dirname,fname)
+                if fname.endswith(('.seg','.gar','.db')) and path not in keep:
+                    os.remove(path)
+            
 '''gh_db_manager----------------------------------------------
 Database Manager
 
@@ -313,41 +2570,413 @@ Manages access to all database files
 The constructor accepts an all_op_desc object from IO_thread_manager
 It initialises the relevant databases
 
-Process data accepts data from a thread and saves it to the appropriate db
+Process data accepts data from a thread (an io_thread.IO_Sample) and queues
+it for the writer thread which saves it to the appropriate db.
+process_batch does the same for a list of samples, as they arrive from io_q
 
 _dbs stores a dictionary of the param_db's associated with each thread/parameter
+_sids stores ((tname,pname),param_db) for each series id, so a sample only
+needs one list index
+
+Optional kwargs:-
+series - list of (tname,pname) for each series id, from the SERIES? command.
+         By default the series are numbered in all_op_desc order, which is
+         how IO_Thread_Manager numbers them
+commit_delay - max seconds before a sample is committed (see gh_db_writer)
+batch_size - number of waiting samples that forces an early flush
+backend - 'file' for one db file per parameter (param_db)
+          'shared' for all parameters in one WAL mode file (shared_store)
+rollup_tiers - list of (name,period) rollup tiers.  See ROLLUP_TIERS
+compact - True to start a gh_db_compactor to catch up any compression backlog
+raw_retention - dictionary ptype -> days of raw_data to keep.  See gh_db_retention
+archive - True to move the raw data of past months to archive files.  See gh_db_retention
+cache_size - bytes of query results to cache.  0 for no cache.  See tile_cache
+raw_backend - dictionary (tname,pname) -> 'sqlite', 'segment' or 'partition'.  Where to
+              keep the raw data of each series.  '*' sets the default.  See RAW_BACKENDS
+journal - True to journal samples until they are on disk.  See gh_db_journal
+backup_dir - directory to back up DB_DIR to while running, or None.  See gh_db_backup
+backup_period - seconds between backups
+
+The manager keeps the latest sample of every series in memory, updated
+as each sample arrives and seeded from the databases when they are
+opened.  get_latest() and as_of() for a time at or after the latest
+sample are answered from it without touching the databases.  Raw lines
+also include the samples the writer hasn't committed yet, so the live
+views don't lag by commit_delay (see gh_db_writer).  Samples
+from process_data are kept as received, whereas samples read back from
+a database have been rounded by param_db.compress_val.
+
+The databases are opened in the background, OPEN_THREADS at a time, so
+the constructor returns straight away and the IO threads can be started.
+Samples that arrive before then wait in the writer queue, and
+get_database() waits for that database to be opened.  The meta_data and
+tiers of each database are saved in a manifest file (MANIFEST_NAME), so
+an open only has to connect and find the last compressed time.
 '''
+OPEN_THREADS=4
+MANIFEST_NAME='manifest-%s.json'  #% backend
 class gh_db_manager:
     
     #gh_db_manager constructor - accepts a dictionary containing all of the parameter
     #descriptions, as provided by IO_thread_manager
     def __init__(self,**kwargs):
         self._all_op_desc=kwargs.get('all_op_desc',None)
+        self._backend=kwargs.get('backend',DEFAULT_BACKEND)
+        rollup_tiers=kwargs.get('rollup_tiers',ROLLUP_TIERS)
+        raw_backends=kwargs.get('raw_backend',RAW_BACKENDS)
+        self._store=None
+        cache_size=kwargs.get('cache_size',DEFAULT_CACHE_SIZE)
+        self._cache=tile_cache(cache_size) if cache_size>0 else None
+        self._manifest=self._read_manifest()
+        if self._backend=='shared':
+            if not os.path.exists(DB_DIR+SHARED_DB_NAME):
+                self._manifest=dict()   #a new store, so nothing in it yet
+            self._store=shared_store()
         self._dbs=dict()
+        self._sids=[]
+        self._latest=dict()   #(tname,pname) -> (ms timestamp,val) of the latest sample
+        self._latest_lock=threading.Lock()
         #initialise one database for every thread/parameter
         for tname in self._all_op_desc:
             self._dbs[tname]=dict()
             for pname in self._all_op_desc[tname]:
                 op_desc=self._all_op_desc[tname][pname]
+                raw_backend=raw_backends.get((tname,pname),raw_backends.get('*',DEFAULT_RAW_BACKEND))
+                manifest=self._manifest.get(tname,dict()).get(pname,None)
+                if self._store is None and not os.path.exists(get_db_fname(tname,pname)):
+                    manifest=None
                 #print('gh_db_manager __init__: tname=',tname,'pname=',pname,'opdesc=',op_desc)
-                self._dbs[tname][pname]=param_db(tname=tname,\
-                                                 pname=pname,\
-                                                 op_desc=op_desc)
+                if self._store is not None:
+                    self._dbs[tname][pname]=series_db(tname=tname,\
+                                                      pname=pname,\
+                                                      op_desc=op_desc,\
+                                                      rollup_tiers=rollup_tiers,\
+                                                      cache=self._cache,\
+                                                      raw_backend=raw_backend,\
+                                                      manifest=manifest,\
+                                                      lazy=True,\
+                                                      store=self._store)
+                else:
+                    self._dbs[tname][pname]=param_db(tname=tname,\
+                                                     pname=pname,\
+                                                     op_desc=op_desc,\
+                                                     rollup_tiers=rollup_tiers,\
+                                                     cache=self._cache,\
+                                                     raw_backend=raw_backend,\
+                                                     manifest=manifest,\
+                                                     lazy=True)
+        series=kwargs.get('series',None)
+        if series is None:
+            series=[(tname,pname) for tname in self._all_op_desc for pname in self._all_op_desc[tname]]
+        for (tname,pname) in series:
+            self._sids.append(((tname,pname),self._dbs[tname][pname]))
+        self._journal=None
+        self._replay=[]   #samples left in the journal.  See _replay_journal()
+        if kwargs.get('journal',USE_JOURNAL):
+            self._replay=gh_db_journal.read()
+            self._journal=gh_db_journal()
+        self._compactor=gh_db_compactor(self._dbs)
+        self._compact=kwargs.get('compact',True)
+        self._writer=gh_db_writer(commit_delay=kwargs.get('commit_delay',DEFAULT_COMMIT_DELAY),\
+                                  batch_size=kwargs.get('batch_size',DEFAULT_BATCH_SIZE),\
+                                  journal=self._journal,\
+                                  on_backlog=self._compactor.wake if self._compact else None)
+        for tname in self._dbs:
+            for pname in self._dbs[tname]:
+                self._dbs[tname][pname].set_pending(self._writer.get_pending)
+        self._retention=gh_db_retention(self._dbs,kwargs.get('raw_retention',RAW_RETENTION),\
+                                        kwargs.get('archive',ARCHIVE_RAW))
+        self._backup=None
+        backup_dir=kwargs.get('backup_dir',BACKUP_DIR)
+        if backup_dir is not None:
+            self._backup=gh_db_backup(self._dbs,backup_dir,kwargs.get('backup_period',BACKUP_PERIOD))
+        self._opener=Thread(target=self._open_all,name='gh_db_open')
+        self._opener.daemon=True
+        self._opener.start()
+        
+    '''
+        _open_all
+        Runs in the opener thread.  Opens all the databases, saves the
+        manifest, replays the journal and then starts the writer and the
+        background threads
+    '''
+    def _open_all(self):
+        pr_cont.set_name('gh_db_open') #allows process to be idenfified in htop
+        t0=monotonic()
+        pdbs=[]
+        for tname in self._dbs:
+            for pname in self._dbs[tname]:
+                pdbs.append(self._dbs[tname][pname])
+        with ThreadPoolExecutor(max_workers=OPEN_THREADS) as pool:
+            ok=list(pool.map(self._open_db,pdbs))
+        print('gh_db_manager: Opened ',ok.count(True),' databases in %.2fs' % (monotonic()-t0))
+        self._write_manifest()
+        self._replay_journal()
+        for pdb in pdbs:
+            self._seed_latest(pdb)
+        self._writer.start()
+        if self._compact:
+            self._compactor.start()
+        self._retention.start()
+        if self._backup is not None:
+            self._backup.start()
+        
+    def _open_db(self,pdb):
+        try:
+            pdb.open()
+            return True
+        except Exception as e:
+            print('gh_db_manager: Unable to open ',pdb.get_names(),': ',e)
+            return False
+        
+    #adds the last sample in pdb to the latest sample index, unless a newer
+    #one has already arrived
+    def _seed_latest(self,pdb):
+        try:
+            row=pdb.as_of(inf)
+        except AttributeError:
+            return  #didn't open
+        if row is None:
+            return
+        self._set_latest(pdb.get_names(),row)
+        
+    def _set_latest(self,key,row):
+        with self._latest_lock:
+            if key not in self._latest or self._latest[key][0]<=row[0]:
+                self._latest[key]=row
+        
+    #returns the saved manifest, or an empty one.  See param_db.get_manifest
+    def _read_manifest(self):
+        fname=DB_DIR+MANIFEST_NAME % self._backend
+        try:
+            with open(fname,'r') as f:
+                return json.load(f)
+        except (OSError,ValueError):
+            return dict()
+        
+    #saves the manifest if anything has changed
+    def _write_manifest(self):
+        manifest=dict()
+        for tname in self._dbs:
+            manifest[tname]=dict()
+            for pname in self._dbs[tname]:
+                try:
+                    manifest[tname][pname]=self._dbs[tname][pname].get_manifest()
+                except AttributeError:
+                    pass  #didn't open
+        if manifest==self._manifest:
+            return
+        fname=DB_DIR+MANIFEST_NAME % self._backend
+        with open(fname+'.tmp','w') as f:
+            json.dump(manifest,f,indent=1)
+        os.replace(fname+'.tmp',fname)
+        self._manifest=manifest
+        
+    #waits until all the databases are open and the writer is running
+    def wait_open(self):
+        self._opener.join()
+        
+    #writes any samples left in the journal by a crash to the dbs
+    def _replay_journal(self):
+        batches=dict()
+        nsamples=0
+        replay=self._replay
+        self._replay=[]
+        for (tname,pname,ts,val) in replay:
+            if tname in self._dbs and pname in self._dbs[tname]:
+                pdb=self._dbs[tname][pname]
+                if pdb not in batches:
+                    batches[pdb]=[]
+                batches[pdb].append((ts,val))
+                nsamples=nsamples+1
+        if nsamples==0:
+            return
+        print('gh_db_manager: Replaying ',nsamples,' samples from the journal')
+        for pdb in batches:
+            pdb.restore_values(batches[pdb])
+            pdb.commit()
+            pdb.compress_if_due()
+        for pdb in batches:
+            if not pdb.sync():
+                return  #leave the journal.  It is safe to replay again
+        self._journal.reset()
         
     def process_data(self,data):
-        #get the associated parameter database
-        pdb=self.get_database(data['tname'],data['pname'])
-        #write the data
-        pdb.write_value(data['time'],data['data'])
+        #get the associated parameter database.  It may not be open yet,
+        #but the writer doesn't start until it is
+        (key,pdb)=self._sids[data.sid]
+        #queue the data for the writer thread
+        self._writer.put(pdb,data.time,data.data)
+        self._set_latest(key,(data.time,data.data))
+        
+    '''
+        process_batch
+        As process_data for a list of samples, e.g. one batch from io_q.
+        The whole batch is one item on the writer queue and the latest
+        samples are updated under one lock
+    '''
+    def process_batch(self,batch):
+        sids=self._sids
+        items=[(sids[data.sid][1],data.time,data.data) for data in batch]
+        self._writer.put_batch(items)
+        with self._latest_lock:
+            for data in batch:
+                key=sids[data.sid][0]
+                if key not in self._latest or self._latest[key][0]<=data.time:
+                    self._latest[key]=(data.time,data.data)
+        
+    #returns (ms timestamp,val) of the latest sample of a series, or None
+    def get_latest(self,tname,pname):
+        with self._latest_lock:
+            return self._latest.get((tname,pname),None)
+        
+    #returns all[tname][pname]=(ms timestamp,val) of the latest sample, or None
+    def get_latest_all(self):
+        data=dict()
+        for tname in self._dbs:
+            data[tname]=dict()
+            for pname in self._dbs[tname]:
+                data[tname][pname]=self.get_latest(tname,pname)
+        return data
+    
+    '''
+        as_of
+        Returns (ms timestamp,val) of the last sample of a series at or
+        before T (ms), or None.  If T is after the latest sample it is
+        returned from memory, otherwise see param_db.as_of
+    '''
+    def as_of(self,tname,pname,T):
+        latest=self.get_latest(tname,pname)
+        if latest is not None and T>=latest[0]:
+            return latest
+        return self.get_database(tname,pname).as_of(T)
+    
+    '''
+        get_aligned
+        Lines up several series on the same time buckets so they can be
+        compared or overlaid.  series is a list of (tname,pname).  See
+        param_db.get_buckets for Tbucket and mode ('avg' or 'locf').
+        Returns (times,data) where times is the start time (ms) of each bucket
+        and data has one row per bucket holding a value (or None) for each
+        series, in the order given
+    '''
+    def get_aligned(self,series,Tstart,Tstop,Tbucket,mode='avg'):
+        columns=[]
+        for (tname,pname) in series:
+            columns.append(self.get_database(tname,pname).get_buckets(Tstart,Tstop,Tbucket,mode))
+        nbuckets=int((Tstop-Tstart)//Tbucket)+1
+        times=[Tstart+i*Tbucket for i in range(nbuckets)]
+        data=[list(row) for row in zip(*columns)]
+        return (times,data)
+    
+    '''
+        export
+        Writes series (a list of (tname,pname), or None for all of them)
+        between Tstart and Tstop (ms, None for now) to the file fname for
+        offline analysis.  table is 'raw_data', 'comp_data' or a rollup tier
+        table (see param_db.get_tiers).  The format comes from the
+        extension - .parquet, .arrow or .csv.  See gh_db_export.
+        The data is streamed a window at a time (see param_db.iter_export),
+        so any amount can be exported while the system runs.
+        Returns the number of rows written, or None if the file couldn't be
+        written
+    '''
+    def export(self,fname,series=None,Tstart=0,Tstop=None,table='raw_data'):
+        if series is None:
+            series=[(tname,pname) for tname in self._dbs for pname in self._dbs[tname]]
+        if Tstop is None:
+            Tstop=datetime_to_timestamp(datetime.now())
+        pdbs=[((tname,pname),self.get_database(tname,pname)) for (tname,pname) in series]
+        return export_dbs(fname,pdbs,Tstart,Tstop,table)
+    
+    #returns all[tname][pname]=as_of(tname,pname,T)
+    def as_of_all(self,T):
+        data=dict()
+        for tname in self._dbs:
+            data[tname]=dict()
+            for pname in self._dbs[tname]:
+                data[tname][pname]=self.as_of(tname,pname,T)
+        return data
         
     def get_database(self,tname,pname):
-        return self._dbs[tname][pname]
+        pdb=self._dbs[tname][pname]
+        pdb.wait_open()
+        return pdb
+    
+    #see gh_db_compactor.get_progress
+    def get_compaction_progress(self):
+        return self._compactor.get_progress()
+    
+    '''
+        get_stats
+        Returns the write path timings.  See wait_stats for the format.
+        series[tname][pname] - param_db.get_stats() for each series
+        total - the same, totalled over all the series
+        writer - gh_db_writer.get_stats()
+        Times are in seconds.  It can all be sent as JSON
+    '''
+    def get_stats(self):
+        series=dict()
+        totals=dict()
+        for tname in self._dbs:
+            series[tname]=dict()
+            for pname in self._dbs[tname]:
+                stats=self._dbs[tname][pname].get_stats()
+                series[tname][pname]=stats
+                for name in stats:
+                    if name not in totals:
+                        totals[name]=wait_stats()
+                    totals[name].add_stats(stats[name])
+        stats=dict()
+        stats['series']=series
+        stats['total']=dict((name,totals[name].get()) for name in totals)
+        stats['writer']=self._writer.get_stats()
+        return stats
+    
+    #returns all[tname][pname]=lock wait stats.  See param_db.get_lock_wait
+    def get_lock_wait(self):
+        data=dict()
+        for tname in self._dbs:
+            data[tname]=dict()
+            for pname in self._dbs[tname]:
+                data[tname][pname]=self._dbs[tname][pname].get_lock_wait()
+        return data
+        
+    #returns the tile_cache stats, or None if caching is off
+    def get_cache_stats(self):
+        if self._cache is None:
+            return None
+        return self._cache.get_stats()
         
     #writes all pending data to disk.  This is used prior to exiting the program
-    #we allow up to MAX_COMMIT_DELAY seconds of data to build up to speed up the program
+    #the writer holds up to commit_delay seconds of data to speed up the program
     #if each point were committed as it arrived, it would be too slow
     def commit_all(self):
+        self.wait_open()
+        if self._writer.is_alive():
+            self._writer.flush()
         for tname in self._dbs:
             for pname in self._dbs[tname]:
                 self._dbs[tname][pname].commit()
-        print('gh_db_manager: All databases flushed')
\ No newline at end of file
+        print('gh_db_manager: All databases flushed')
+        
+    #flush everything and stop the writer thread
+    def close(self):
+        self.commit_all()
+        self._writer.term()
+        self._writer.join()
+        if self._journal is not None:
+            self._journal.close()
+        if self._compactor.is_alive():
+            self._compactor.term()
+            self._compactor.join()
+        self._retention.term()
+        self._retention.join()
+        if self._backup is not None and self._backup.is_alive():
+            self._backup.term()
+            self._backup.join()
+        for tname in self._dbs:
+            for pname in self._dbs[tname]:
+                self._dbs[tname][pname].close()
+        if self._store is not None:
+            self._store.close()
@@ -0,0 +1,307 @@
+'''
+gh_db_partition
+
+Monthly partitions for raw data
+
+An alternative to the single raw_data table.  Each month of raw data is
+kept in its own sqlite file, in one directory per series.  Each file is
+named after its month (YYYYMM.db) and holds a raw_data table as
+param_db's:-
+timestamp - integer - ms timestamp
+val - integer - value of the data, as param_db.compress_val()
+Months are in local time, as param_db.archive_month().
+
+The first and last timestamps of every partition are kept in memory, so
+a read only queries the partitions that overlap the range (the query
+router - see _overlapping()), and each of those is a smaller B-tree than
+one table holding everything.  Old data is deleted a month at a time by
+unlinking the file (see drop_before()), instead of a large DELETE that
+rewrites pages of the B-tree and leaves free pages to vacuum.
+
+Each partition is its own WAL mode database with its own connection.
+Only PARTITION_MAX_OPEN connections are kept open - usually the current
+month and a few recently read.  Appends are committed by flush(), which
+is called by param_db when it commits.
+'''
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from bisect import bisect_right
+from collections import OrderedDict
+from urllib.request import pathname2url
+
+try:
+    import numpy as np    #optional - only needed for read_array()
+    _numpy_ok=True
+except ImportError:
+    _numpy_ok=False
+
+PARTITION_MAX_OPEN=4      #connections kept open per series
+
+if _numpy_ok:
+    PART_DTYPE=np.dtype([('ts','<i8'),('val','<i8')])
+
+#returns the month (YYYYMM) holding ms timestamp ts
+def get_month(ts):
+    d=datetime.fromtimestamp(ts/1000)
+    return d.year*100+d.month
+
+#returns (Tstart,Tend) - the ms timestamps of the start of month and the next
+def get_month_range(month):
+    (year,mon)=divmod(month,100)
+    Tstart=round(datetime(year,mon,1).timestamp()*1000)
+    Tend=round(datetime(year+mon//12,mon%12+1,1).timestamp()*1000)
+    return (Tstart,Tend)
+
+'''partition
+One month.  Only used by partition_store, which does the locking
+'''
+class partition:
+    def __init__(self,path,month,read_only=False):
+        self.path=path
+        self.month=month
+        (self.Tstart,self.Tend)=get_month_range(month)
+        self._con=None
+        self._read_only=read_only
+        row=self.connect().execute('SELECT MIN(timestamp),MAX(timestamp) FROM raw_data').fetchone()
+        (self.Tfirst,self.Tlast)=row   #None if it is empty
+
+    #returns the connection, opening it if need be
+    def connect(self):
+        if self._con is None and self._read_only:
+            self._con=sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(self.path)),\
+                                      uri=True,check_same_thread=False)
+        elif self._con is None:
+            self._con=sqlite3.connect(self.path,check_same_thread=False)
+            self._con.execute('PRAGMA journal_mode=WAL')
+            self._con.execute('PRAGMA synchronous=NORMAL')
+            self._con.execute('''CREATE TABLE IF NOT EXISTS raw_data (
+                            timestamp integer PRIMARY KEY,
+                            val integer)''')
+        return self._con
+
+    def is_open(self):
+        return self._con is not None
+
+    #records that rows between Tmin and Tmax have been added
+    def add_range(self,Tmin,Tmax):
+        self.Tfirst=Tmin if self.Tfirst is None else min(self.Tfirst,Tmin)
+        self.Tlast=Tmax if self.Tlast is None else max(self.Tlast,Tmax)
+
+    #commits anything outstanding and closes the connection
+    def close(self):
+        if self._con is not None:
+            self._con.commit()
+            self._con.close()
+            self._con=None
+
+'''partition_store
+All the partitions of one series.  dirname is the directory for the
+files.  The interface is the same as gh_db_segment.segment_store.
+The methods can be called from any thread.
+With read_only=True the files are opened read only and empty ones are
+left alone.  Only the read methods can be used then
+'''
+class partition_store:
+    def __init__(self,dirname,read_only=False):
+        self._dirname=dirname
+        self._lock=threading.Lock()
+        self._parts=[]            #partitions in month order
+        self._months=[]           #month of each of _parts, for bisect
+        self._open=OrderedDict()  #month -> partition with an open connection, least recently used first
+        self._dirty=set()         #partitions with uncommitted rows
+        self._unsynced=set()      #partitions committed since the last sync()
+        if read_only and not os.path.isdir(dirname):
+            return
+        os.makedirs(dirname,exist_ok=True)
+        for fname in sorted(os.listdir(dirname)):
+            if fname.endswith('.db') and fname[:-3].isdigit():
+                part=partition(os.path.join(dirname,fname),int(fname[:-3]),read_only)
+                if part.Tfirst is None:
+                    part.close()
+                    if not read_only:
+                        self._remove(part)
+                    continue
+                self._parts.append(part)
+                self._months.append(part.month)
+                self._used(part)
+
+    #returns the connection to part and marks it most recently used.
+    #Caller holds the lock
+    def _connect(self,part):
+        con=part.connect()
+        self._used(part)
+        return con
+
+    #closes the least recently used connections over PARTITION_MAX_OPEN.
+    #Caller holds the lock
+    def _used(self,part):
+        self._open[part.month]=part
+        self._open.move_to_end(part.month)
+        while len(self._open)>PARTITION_MAX_OPEN:
+            (month,old)=self._open.popitem(last=False)
+            old.close()   #commits any uncommitted rows
+            if old in self._dirty:
+                self._dirty.discard(old)
+                self._unsynced.add(old)
+
+    #returns the partition for month, creating it if need be.  Caller holds the lock
+    def _get_partition(self,month):
+        k=bisect_right(self._months,month)
+        if k>0 and self._months[k-1]==month:
+            return self._parts[k-1]
+        part=partition(os.path.join(self._dirname,'%06d.db' % month),month)
+        self._parts.insert(k,part)
+        self._months.insert(k,month)
+        return part
+
+    #deletes the files of part.  Caller holds the lock
+    def _remove(self,part):
+        for path in (part.path,part.path+'-wal',part.path+'-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    '''
+        append
+        Adds a list of (timestamp,val) integer pairs, each to the partition
+        for its month.  Any with a timestamp already stored are ignored.
+        The rows are not committed until flush()
+        Returns the number of rows added
+    '''
+    def append(self,rows):
+        n=0
+        with self._lock:
+            part=None
+            i0=0
+            for i in range(len(rows)+1):
+                if i<len(rows) and part is not None and part.Tstart<=rows[i][0]<part.Tend:
+                    continue
+                if part is not None:
+                    n=n+self._insert(part,rows[i0:i])
+                if i<len(rows):
+                    part=self._get_partition(get_month(rows[i][0]))
+                    i0=i
+        return n
+
+    #inserts rows (all in the month of part).  Caller holds the lock
+    def _insert(self,part,rows):
+        con=self._connect(part)
+        n=con.executemany('INSERT OR IGNORE INTO raw_data VALUES (?,?)',rows).rowcount
+        part.add_range(min(rows)[0],max(rows)[0])
+        self._dirty.add(part)
+        return n
+
+    #commits the appended rows
+    def flush(self):
+        with self._lock:
+            for part in self._dirty:
+                if part.is_open():
+                    part.connect().commit()
+            self._unsynced.update(self._dirty)
+            self._dirty=set()
+
+    #commits and makes sure the rows are on disk.  With synchronous=NORMAL
+    #that needs a checkpoint of the WAL
+    def sync(self):
+        self.flush()
+        with self._lock:
+            for part in list(self._unsynced):
+                con=self._connect(part)
+                (busy,nlog,nckpt)=con.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+                if busy==0 and nlog==nckpt:
+                    self._unsynced.discard(part)
+
+    #returns the partitions that overlap Tstart..Tstop.  Caller holds the lock
+    def _overlapping(self,Tstart,Tstop):
+        parts=[]
+        for part in self._parts:
+            if part.Tfirst is not None and part.Tlast>=Tstart and part.Tfirst<=Tstop:
+                parts.append(part)
+        return parts
+
+    #returns a list of (timestamp,val) between Tstart and Tstop inclusive
+    def read(self,Tstart,Tstop):
+        data=[]
+        with self._lock:
+            for part in self._overlapping(Tstart,Tstop):
+                data.extend(self._connect(part).execute('SELECT timestamp,val FROM raw_data \
+                            WHERE timestamp>=? AND timestamp<=? ORDER BY timestamp ASC',(Tstart,Tstop)))
+        return data
+
+    #as read(), but returns a PART_DTYPE NumPy array
+    def read_array(self,Tstart,Tstop):
+        parts=[]
+        with self._lock:
+            for part in self._overlapping(Tstart,Tstop):
+                rows=self._connect(part).execute('SELECT timestamp,val FROM raw_data \
+                            WHERE timestamp>=? AND timestamp<=? ORDER BY timestamp ASC',(Tstart,Tstop))
+                parts.append(np.fromiter(rows,dtype=PART_DTYPE))
+        if len(parts)==0:
+            return np.empty(0,dtype=PART_DTYPE)
+        if len(parts)==1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    #returns the first timestamp after T, or None
+    def get_first_after(self,T):
+        with self._lock:
+            for part in self._parts:
+                if part.Tlast is not None and part.Tlast>T:
+                    return self._connect(part).execute('SELECT MIN(timestamp) FROM raw_data \
+                                WHERE timestamp>?',(T,)).fetchone()[0]
+        return None
+
+    #returns (timestamp,val) of the last row at or before T, or None
+    def get_last_at(self,T):
+        with self._lock:
+            for part in reversed(self._parts):
+                if part.Tfirst is not None and part.Tfirst<=T:
+                    return self._connect(part).execute('SELECT timestamp,val FROM raw_data \
+                                WHERE timestamp<=? ORDER BY timestamp DESC LIMIT 1',(T,)).fetchone()
+        return None
+
+    #returns the last timestamp, or None
+    def get_last_time(self):
+        with self._lock:
+            for part in reversed(self._parts):
+                if part.Tlast is not None:
+                    return part.Tlast
+        return None
+
+    #returns a list of (path,nbytes) of the partition files.  They are sqlite
+    #databases, so must be copied with the backup API (see gh_db_backup)
+    def get_files(self):
+        with self._lock:
+            return [(part.path,os.path.getsize(part.path)) for part in self._parts]
+
+    '''
+        drop_before
+        Deletes whole partitions whose rows are all before Tlimit, oldest
+        first, until at least nmax rows have gone.  The newest partition is
+        never deleted.
+        Returns the number of rows deleted
+    '''
+    def drop_before(self,Tlimit,nmax):
+        nrows=0
+        with self._lock:
+            while len(self._parts)>1 and nrows<nmax:
+                part=self._parts[0]
+                if part.Tlast is not None and part.Tlast>=Tlimit:
+                    break
+                nrows=nrows+self._connect(part).execute('SELECT count(*) FROM raw_data').fetchone()[0]
+                part.close()
+                self._open.pop(part.month,None)
+                self._dirty.discard(part)
+                self._unsynced.discard(part)
+                self._remove(part)
+                del self._parts[0]
+                del self._months[0]
+        return nrows
+
+    def close(self):
+        with self._lock:
+            for part in self._parts:
+                part.close()
+            self._open=OrderedDict()
+            self._dirty=set()
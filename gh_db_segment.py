@@ -0,0 +1,322 @@
+'''
+gh_db_segment
+
+Append-only segment files for raw data
+
+An alternative to the sqlite raw_data table for high rate series.  Each
+sample is appended to the current segment file as a fixed width record:-
+timestamp - int64 - ms timestamp
+val - int32 - value of the data, as param_db.compress_val()
+so an insert is a 12 byte append instead of a B-tree insert.
+
+The segments of one series are kept in one directory.  Each file is
+named after the timestamp of its first record and holds records in
+time order.  A new segment is started every SEGMENT_SPAN ms or once the
+current one holds SEGMENT_MAX_RECORDS records, so old data can be
+deleted a whole file at a time (see drop_before()).
+
+Reads go through mmap.  Every SPARSE_STEP'th timestamp of each segment is
+kept in memory (the sparse index), so finding the start and end of a
+range is a bisect of the sparse index plus a binary search of one block
+of the file.  The records between are then sliced straight out of the
+mapping.
+
+Appends are buffered until flush(), which is called by param_db when it
+commits.  Readers only see flushed records.
+'''
+import os
+import mmap
+import struct
+import threading
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np    #optional - only needed for read_array()
+    _numpy_ok=True
+except ImportError:
+    _numpy_ok=False
+
+SEGMENT_SPAN=24*60*60*1000     #ms of data in one segment file
+SEGMENT_MAX_RECORDS=1024*1024  #max records in one segment file
+SPARSE_STEP=128                #records between sparse index entries
+
+REC=struct.Struct('<qi')       #record layout (timestamp,val)
+REC_SIZE=REC.size
+TS=struct.Struct('<q')         #the timestamp at the start of a record
+if _numpy_ok:
+    SEG_DTYPE=np.dtype([('ts','<i8'),('val','<i4')])  #packed, matches REC
+
+'''segment
+One segment file.  Only used by segment_store, which does the locking
+'''
+class segment:
+    def __init__(self,path,read_only=False):
+        self.path=path
+        self._mm=None
+        self._mm_n=0   #records in the current mapping
+        size=os.path.getsize(path)
+        self.n=size//REC_SIZE
+        if size%REC_SIZE!=0 and not read_only:
+            #partial record left by a crash during an append
+            print('gh_db_segment: Truncating partial record in ',path)
+            with open(path,'r+b') as f:
+                f.truncate(self.n*REC_SIZE)
+        self.Tfirst=None
+        self.Tlast=None
+        self.sparse=[]
+        if self.n>0:
+            with open(path,'rb') as f:
+                mm=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+                try:
+                    for i in range(0,self.n,SPARSE_STEP):
+                        self.sparse.append(TS.unpack_from(mm,i*REC_SIZE)[0])
+                    self.Tfirst=self.sparse[0]
+                    self.Tlast=TS.unpack_from(mm,(self.n-1)*REC_SIZE)[0]
+                finally:
+                    mm.close()
+
+    #records (ts) appended to the file at index i onwards are now visible
+    def add_to_index(self,i,timestamps):
+        for ts in timestamps:
+            if i%SPARSE_STEP==0:
+                self.sparse.append(ts)
+            i=i+1
+        if self.Tfirst is None:
+            self.Tfirst=timestamps[0]
+        self.Tlast=timestamps[-1]
+        self.n=i
+
+    #returns a read only mapping of the whole file
+    def get_map(self):
+        if self._mm is None or self._mm_n!=self.n:
+            self.close()
+            with open(self.path,'rb') as f:
+                self._mm=mmap.mmap(f.fileno(),self.n*REC_SIZE,access=mmap.ACCESS_READ)
+            self._mm_n=self.n
+        return self._mm
+
+    '''
+        find
+        Returns the index of the first record with timestamp >= T
+        (right=False) or > T (right=True)
+        The sparse index gives the block of SPARSE_STEP records that holds
+        the answer, which is then binary searched in the file
+    '''
+    def find(self,T,right=False):
+        if right:
+            k=bisect_right(self.sparse,T)
+        else:
+            k=bisect_left(self.sparse,T)
+        if k==0:
+            return 0
+        lo=(k-1)*SPARSE_STEP+1
+        hi=min(k*SPARSE_STEP,self.n)
+        mm=self.get_map()
+        while lo<hi:
+            mid=(lo+hi)//2
+            ts=TS.unpack_from(mm,mid*REC_SIZE)[0]
+            if ts<T or (right and ts==T):
+                lo=mid+1
+            else:
+                hi=mid
+        return lo
+
+    #returns (i0,i1) - the records between Tstart and Tstop are i0..i1-1
+    def find_range(self,Tstart,Tstop):
+        return (self.find(Tstart),self.find(Tstop,right=True))
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm=None
+
+'''segment_store
+All the segments of one series.  dirname is the directory for the files.
+The methods can be called from any thread.
+With read_only=True nothing is changed on disk - a partial record or an
+empty segment left by a crash, or by the writer of a running system, is
+just skipped.  Only the read methods can be used then
+'''
+class segment_store:
+    def __init__(self,dirname,read_only=False):
+        self._dirname=dirname
+        self._lock=threading.Lock()
+        self._file=None       #the segment being appended to
+        self._pending=[]      #timestamps appended since the last flush
+        self._segments=[]
+        if read_only and not os.path.isdir(dirname):
+            self._Tlast=None
+            return
+        os.makedirs(dirname,exist_ok=True)
+        for fname in sorted(os.listdir(dirname)):
+            if fname.endswith('.seg'):
+                seg=segment(os.path.join(dirname,fname),read_only)
+                if seg.n>0:
+                    self._segments.append(seg)
+                elif not read_only:
+                    os.remove(seg.path)
+        self._Tlast=self._segments[-1].Tlast if len(self._segments)>0 else None
+
+    '''
+        append
+        Appends a list of (timestamp,val) integer pairs.  Samples must
+        arrive in time order.  Any at or before the last timestamp already
+        stored are dropped, as a duplicate timestamp would be by sqlite.
+        Nothing is visible to readers until flush()
+        Returns the number of records written
+    '''
+    def append(self,rows):
+        n=0
+        for (ts,val) in rows:
+            if self._Tlast is not None and ts<=self._Tlast:
+                print('gh_db_segment: Dropping out of order sample ts=',ts,' in ',self._dirname)
+                continue
+            if self._file is None and len(self._segments)>0 and not self._need_new_segment(ts):
+                self._file=open(self._segments[-1].path,'ab')  #carry on after a restart
+            elif self._file is None or self._need_new_segment(ts):
+                self._start_segment(ts)
+            self._file.write(REC.pack(ts,val))
+            self._pending.append(ts)
+            self._Tlast=ts
+            n=n+1
+        return n
+
+    def _need_new_segment(self,ts):
+        seg=self._segments[-1]
+        ntotal=seg.n+len(self._pending)
+        Tfirst=seg.Tfirst if seg.Tfirst is not None else self._pending[0]
+        return ntotal>=SEGMENT_MAX_RECORDS or ts>=Tfirst+SEGMENT_SPAN
+
+    def _start_segment(self,ts):
+        if self._file is not None:
+            self.flush()
+            os.fsync(self._file.fileno())   #the old segment won't be written again
+            self._file.close()
+        path=os.path.join(self._dirname,'%016d.seg' % ts)
+        self._file=open(path,'ab')
+        with self._lock:
+            self._segments.append(segment(path))
+
+    '''
+        get_new
+        Returns the rows that append() would keep - those after the last
+        timestamp appended (flushed or not), in order
+    '''
+    def get_new(self,rows):
+        new=[]
+        Tlast=self._Tlast
+        for row in rows:
+            if Tlast is None or row[0]>Tlast:
+                new.append(row)
+                Tlast=row[0]
+        return new
+
+    #makes the appended records visible to readers
+    def flush(self):
+        if len(self._pending)==0:
+            return
+        self._file.flush()
+        with self._lock:
+            seg=self._segments[-1]
+            seg.add_to_index(seg.n,self._pending)
+        self._pending=[]
+
+    #flushes and makes sure the records are on disk
+    def sync(self):
+        self.flush()
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+            
+    #returns the segments that overlap Tstart..Tstop.  Caller holds the lock
+    def _overlapping(self,Tstart,Tstop):
+        segs=[]
+        for seg in self._segments:
+            if seg.n>0 and seg.Tlast>=Tstart and seg.Tfirst<=Tstop:
+                segs.append(seg)
+        return segs
+
+    #returns a list of (timestamp,val) between Tstart and Tstop inclusive
+    def read(self,Tstart,Tstop):
+        data=[]
+        with self._lock:
+            for seg in self._overlapping(Tstart,Tstop):
+                (i0,i1)=seg.find_range(Tstart,Tstop)
+                data.extend(REC.iter_unpack(seg.get_map()[i0*REC_SIZE:i1*REC_SIZE]))
+        return data
+
+    #as read(), but returns a SEG_DTYPE NumPy array
+    def read_array(self,Tstart,Tstop):
+        parts=[]
+        with self._lock:
+            for seg in self._overlapping(Tstart,Tstop):
+                (i0,i1)=seg.find_range(Tstart,Tstop)
+                if i1>i0:
+                    #a view of the mapping - copied before the lock is released
+                    parts.append(np.frombuffer(seg.get_map(),dtype=SEG_DTYPE,count=i1-i0,\
+                                               offset=i0*REC_SIZE).copy())
+        if len(parts)==0:
+            return np.empty(0,dtype=SEG_DTYPE)
+        if len(parts)==1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    #returns the first timestamp after T, or None
+    def get_first_after(self,T):
+        with self._lock:
+            for seg in self._segments:
+                if seg.n>0 and seg.Tlast>T:
+                    i=seg.find(T,right=True)
+                    return TS.unpack_from(seg.get_map(),i*REC_SIZE)[0]
+        return None
+
+    #returns (timestamp,val) of the last record at or before T, or None
+    def get_last_at(self,T):
+        with self._lock:
+            for seg in reversed(self._segments):
+                if seg.n>0 and seg.Tfirst<=T:
+                    i=seg.find(T,right=True)
+                    return REC.unpack_from(seg.get_map(),(i-1)*REC_SIZE)
+        return None
+    
+    #returns a list of (path,nbytes) of the segment files.  Only the first
+    #nbytes of each file are visible - anything after hasn't been flushed
+    def get_files(self):
+        with self._lock:
+            return [(seg.path,seg.n*REC_SIZE) for seg in self._segments]
+    
+    #returns the last visible timestamp, or None
+    def get_last_time(self):
+        with self._lock:
+            for seg in reversed(self._segments):
+                if seg.n>0:
+                    return seg.Tlast
+        return None
+
+    '''
+        drop_before
+        Deletes whole segments whose records are all before Tlimit, oldest
+        first, until at least nmax records have gone.  The segment being
+        appended to is never deleted.
+        Returns the number of records deleted
+    '''
+    def drop_before(self,Tlimit,nmax):
+        nrecs=0
+        with self._lock:
+            while len(self._segments)>1 and nrecs<nmax:
+                seg=self._segments[0]
+                if seg.Tlast>=Tlimit:
+                    break
+                seg.close()
+                os.remove(seg.path)
+                del self._segments[0]
+                nrecs=nrecs+seg.n
+        return nrecs
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file=None
+        with self._lock:
+            for seg in self._segments:
+                seg.close()
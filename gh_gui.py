@@ -229,9 +229,11 @@ if __name__ == "__main__":
             else:
                 return 'normal'
             
-        #read back the current heater mode
+        #read back the current heater mode.  show_mode is called with it
         def get_mode(self):
-            mode=self._gio.io_query('HEATER:MODE?',0,1)
+            self._gio.io_query_cb('HEATER:MODE?',0,self.show_mode,1)
+            
+        def show_mode(self,mode):
             self.b1.state=self.map_key_state((mode=='OFF'))
             self.b2.state=self.map_key_state(mode=='AUTO')
             self.b3.state=self.map_key_state(mode=='BOOST')
@@ -292,9 +294,11 @@ if __name__ == "__main__":
             else:
                 return 'normal'
             
-        #read back the current heater mode
+        #read back the current heater mode.  show_mode is called with it
         def get_mode(self):
-            mode=self._gio.io_query('LIGHT_CTRL:MODE?',0,1)
+            self._gio.io_query_cb('LIGHT_CTRL:MODE?',0,self.show_mode,1)
+            
+        def show_mode(self,mode):
             self.b1.state=self.map_key_state((mode=='OFF'))
             self.b2.state=self.map_key_state(mode=='AUTO')
             self.b3.state=self.map_key_state(mode=='BOOST')
@@ -353,7 +357,7 @@ if __name__ == "__main__":
             
         def start_io(self,gio,io_desc):
             #GRID
-            self.statusgrid=gh_io_status_grid(all_op_desc=io_desc)
+            self.statusgrid=gh_io_status_grid(all_op_desc=io_desc,series=gio.get_series())
             self.non_menu_root.add_widget(self.statusgrid) 
             gio.bind(on_io_data=self.process_io_data)
             self.statusgrid.bind(on_desc_click=self.desc_click)
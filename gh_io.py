@@ -4,6 +4,12 @@
 gh_io.py
 
 Entry point to gh_io process
+
+The main loop sleeps in multiprocessing.connection.wait() until either a
+command arrives on io_ctrl or an IO thread puts a sample on local_io_q,
+which is an IO_Wakeup_Queue, so both are handled straight away.  The
+only timeout is for a batch that is due (see IO_BATCH_DELAY), so the
+loop doesn't wake at all when there is nothing to do.
 '''
 
 from io_thread import IO_Thread, IO_Thread_Manager, IO_Thread_ExampleIO, \
@@ -15,15 +21,74 @@ from io_thread import IO_Thread, IO_Thread_Manager, IO_Thread_ExampleIO, \
 from io_sprinkler import IO_Thread_Sprinkler
 from io_heater import IO_Thread_Heater
 from io_light_ctrl import IO_Thread_Light_Ctrl
-from time import sleep
+from time import sleep, monotonic
 from datetime import datetime, timedelta
 import queue
+import socket
+from multiprocessing.connection import wait
 from io_buffer import IO_Buffer
 from process_control import pr_cont
 import platform
 
+#Samples are sent to io_q in batches, so each one doesn't pay for its own
+#pickle and pipe write.  A batch is sent once its first sample is
+#IO_BATCH_DELAY seconds old or it holds IO_BATCH_SIZE samples
+IO_BATCH_DELAY=0.1  #seconds.  0 sends whatever has arrived each time round the loop
+IO_BATCH_SIZE=100
+
+'''IO_Wakeup_Queue
+A queue.Queue that can be waited on with multiprocessing.connection.wait
+(or select) alongside the control pipe.  A put() to an empty queue writes
+a byte to a socket pair and get_wakeup_fd() returns the read end.
+A socket pair rather than a pipe, as wait() only takes sockets on Windows
+Call clear_wakeup() before taking the items, so a put() after that wakes
+the loop again
+'''
+class IO_Wakeup_Queue(queue.Queue):
+    def __init__(self,maxsize=0):
+        queue.Queue.__init__(self,maxsize)
+        (self._wake_r,self._wake_w)=socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._woken=False  #a byte is waiting in the socket pair
+        
+    #called by put() with self.mutex held
+    def _put(self,item):
+        queue.Queue._put(self,item)
+        if not self._woken:
+            self._woken=True
+            self._wake_w.send(b'\0')
+            
+    def get_wakeup_fd(self):
+        return self._wake_r
+    
+    def clear_wakeup(self):
+        with self.mutex:
+            if self._woken:
+                self._wake_r.recv(16)
+                self._woken=False
+                
+    def close(self):
+        self._wake_r.close()
+        self._wake_w.close()
+
+#forwards a batch (list) of samples to the host application as one message
+def _send_batch(io_q,batch):
+    if io_q is None or len(batch)==0:
+        return
+    try:
+        io_q.put(batch)
+    except queue.Full:
+        print("gh_io MAIN LOOP: io_q is full")
 
-def gh_io_main(io_q,io_ctrl):
+'''gh_io_main
+io_q - queue for the samples, as lists of IO_Sample (see IO_BATCH_DELAY)
+io_ctrl - pipe for commands.  Each is a dict of 'command', 'data' and 'id'.
+          A command with an id is a query and is always answered, with a
+          dict of the same 'id' and 'data' (the response, or None).  See
+          gh_db.gh_rpc
+batch_delay - max seconds a sample waits in a batch
+'''
+def gh_io_main(io_q,io_ctrl,batch_delay=IO_BATCH_DELAY):
     
     #assume we must simulate the data on windows - no real HW present
     if platform.system()=='Windows':
@@ -33,7 +98,7 @@ def gh_io_main(io_q,io_ctrl):
         sim_mode=False
     
     
-    local_io_q=queue.Queue(20)  #allow max of 20 items
+    local_io_q=IO_Wakeup_Queue(20)  #allow max of 20 items
     
     io_manager=IO_Thread_Manager(sim_hw=sim_mode)  #sim_hw for the Manager determinest whether to start pigpio
     
@@ -153,28 +218,41 @@ def gh_io_main(io_q,io_ctrl):
 
         
     all_op_desc=io_manager.get_all_op_descriptions()
+    series=io_manager.get_series_table()
            
     iob=None
        
     pr_cont.set_proctitle('gh_io process') #allows process to be idenfified in htop
     pr_cont.set_name('gh_io main') #allows process to be idenfified in htop
     
+    batch=[]        #samples waiting to be sent to io_q
+    t_batch=None    #monotonic time the first of them arrived
     _main_loop_running=True
     #GH_IO MAIN LOOP------------------ 
     while(_main_loop_running): 
-        if io_ctrl.poll(): #check if there are any commands
+        timeout=None  #Block until a command or a sample arrives, or the batch is due
+        if t_batch is not None:
+            timeout=max(0,t_batch+batch_delay-monotonic())
+        wait([io_ctrl,local_io_q.get_wakeup_fd()],timeout)
+        
+        while io_ctrl.poll(): #take all the commands waiting
             try:
                 ctrl_data=io_ctrl.recv()
-            except EOFError:
-                print("gh_io MAIN LOOP: Poll true but no data")
+            except EOFError:  #the host has gone
+                print("gh_io MAIN LOOP: io_ctrl closed")
+                _main_loop_running=False
+                break
             cmd=ctrl_data['command']
             data=ctrl_data['data']
+            response=None
             if(cmd=='TERMINATE'):  #Command to stop the process
                 _main_loop_running=False
                 print("gh_io MAIN LOOP: TERMINATE Command Received. data =",data)
                 break
             if(cmd=='OPDESC?'):  #output descriptions query
-                io_ctrl.send(all_op_desc)
+                response=all_op_desc
+            if(cmd=='SERIES?'):  #(tname,pname) of each series id
+                response=series
             if(cmd=='START'):
                 io_manager.start_threads()
                 iob=io_manager.get_iob()  #get the IO buffer
@@ -182,29 +260,37 @@ def gh_io_main(io_q,io_ctrl):
                 io_thread_sprink.command(cmd,data)
             if(cmd[:6]=='HEATER'):
                 response=io_thread_heater.command(cmd,data)
-                if response is not None:
-                    io_ctrl.send(response)
             if(cmd[:10]=='LIGHT_CTRL'):
                 response=io_thread_light_ctrl1.command(cmd,data)
-                if response is not None:
-                    io_ctrl.send(response)                    
+            if ctrl_data['id'] is not None:  #a query - answer it, even if with None
+                io_ctrl.send({'id':ctrl_data['id'],'data':response})
+        if not _main_loop_running:
+            _send_batch(io_q,batch)
+            break
                 
-        try:
-            op_data=local_io_q.get(timeout=0.1) #Block here max 100ms
-        except queue.Empty:
-            continue
-        if iob is not None:
-            iob.add_data(op_data)  #feed the local buffer.  This may block
-                                #if any threads have locked it while they read
-        if io_q is not None:
+        #take everything already waiting
+        local_io_q.clear_wakeup()
+        while True:
             try:
-                io_q.put(op_data) #forward the data to the host application
-            except queue.Full:
-                print("gh_io MAIN LOOP: io_q is full")
+                op_data=local_io_q.get(block=False)
+            except queue.Empty:
+                break
+            if iob is not None:
+                iob.add_data(op_data)  #feed the local buffer.  This may block
+                                    #if any threads have locked it while they read
+            batch.append(op_data)
+            if t_batch is None:
+                t_batch=monotonic()
+        if t_batch is not None and \
+           (len(batch)>=IO_BATCH_SIZE or monotonic()>=t_batch+batch_delay):
+            _send_batch(io_q,batch) #forward the data to the host application
+            batch=[]
+            t_batch=None
                 
     #END GH_IO MAIN LOOP------------------
                
     io_manager.kill_threads()
+    local_io_q.close()
     
     #END OF GH_IO_MAIN
 
@@ -310,8 +396,7 @@ if __name__ == "__main__":
             iob.add_data(op_data)  #feed the local buffer.  This may block
                                     #if any threads have locked it while they read
             
-            if io_q is not None:
-                io_q.put(op_data) #forward the data to the host application
+            _send_batch(io_q,[op_data]) #forward the data to the host application
             
         print("IO Buffer after running")
         iob.printall()
@@ -59,13 +59,17 @@ from process_control import pr_cont
 
 MAX_GH_EV_Q_LEN = 50
 EV_Q_CLOCK_PERIOD = 0.2 #Period of checking GH_EV_Q in seconds
+GH_DB_KWARGS = ('io_batch_delay','transport','commit_delay')
 
 #START class gh_io_dispatcher-------------------------------------
 class gh_io_dispatcher(gh_db,EventDispatcher):
+    #the gh_db kwargs (see gh_db.__init__) are passed on to it, the rest
+    #to EventDispatcher
     def __init__(self, **kwargs):
         self.register_event_type('on_io_data')
+        db_kwargs={key:kwargs.pop(key) for key in GH_DB_KWARGS if key in kwargs}
         EventDispatcher.__init__(self,**kwargs)
-        gh_db.__init__(self)  
+        gh_db.__init__(self,**db_kwargs)
         self._gh_ev_q=queue.Queue(MAX_GH_EV_Q_LEN)
         self._clock_event=Clock.schedule_interval(self._clock_heartbeat,EV_Q_CLOCK_PERIOD)
                 
@@ -74,24 +78,26 @@ class gh_io_dispatcher(gh_db,EventDispatcher):
     #we must not touch any Kivy structures from here.  We must send the data
     #through a queue and pick it up with a clock
     #This function effectively takes the data from the io_q and
-    #passes it to gh_ev_q
-    def _consumer_fn(self,data):
-        gh_db._consumer_fn(self,data)  #Call parent - saves to database
+    #passes it to gh_ev_q, a batch (list) of samples at a time
+    def _consumer_fn(self,batch):
+        gh_db._consumer_fn(self,batch)  #Call parent - saves to database
         try:
-            self._gh_ev_q.put(data,block=False)
+            self._gh_ev_q.put(batch,block=False)
         except queue.Full:  #consumer must have stopped - throw data away
             Logger.info("gh_io_dispatcher: _consumer_fn(): Unable to output data - Queue gh_ev_q is full")
         
     #this function is running on a clock heartbeat in the kivy thread
     #it receives data from the _consumer_fn() via the gh_ev_q
+    #on_io_data is still dispatched once per sample
     def _clock_heartbeat(self,dt):
         datavalid=True
               
         while(datavalid):  #read everything on the queue
             try:
-                data=self._gh_ev_q.get(block=False) 
-                if data:
-                    self.dispatch('on_io_data',data)
+                batch=self._gh_ev_q.get(block=False) 
+                if batch:
+                    for data in batch:
+                        self.dispatch('on_io_data',data)
                 else:
                     datavalid=False
             except queue.Empty:
@@ -99,6 +105,26 @@ class gh_io_dispatcher(gh_db,EventDispatcher):
               
     def on_io_data(self,*args):
         pass  
+    
+    '''io_query_cb
+    Query that doesn't block the kivy thread.  callback(response) is called
+    in the kivy thread when the response arrives, or with None if there
+    isn't one within timeout seconds
+    '''
+    def io_query_cb(self,cmd,data,callback,timeout):
+        fut=self.io_query_async(cmd,data)
+        timer=Clock.schedule_once(lambda dt: fut.cancel(),timeout)
+        #runs in the gh_rpc thread (or this one if the response is already there)
+        def done(fut):
+            Clock.schedule_once(lambda dt: self._query_done(fut,timer,callback))
+        fut.add_done_callback(done)
+        
+    def _query_done(self,fut,timer,callback):
+        timer.cancel()
+        if fut.cancelled() or fut.exception() is not None:
+            callback(None)
+        else:
+            callback(fut.result())
 #END class gh_io_dispatcher-------------------------------------
 
 
@@ -146,7 +172,7 @@ if __name__ == "__main__":
                 sys.exit(1)
         
             #Build the status grid - see gh_io_status_grid.py
-            self.statusgrid=gh_io_status_grid(all_op_desc=io_desc)
+            self.statusgrid=gh_io_status_grid(all_op_desc=io_desc,series=self._gio.get_series())
             self.ti1.add_widget(self.statusgrid)  
             self._gio.start_events()
             
@@ -183,4 +209,4 @@ if __name__ == "__main__":
         multiprocessing.set_start_method('fork')
     pr_cont.set_proctitle('gh_main process') #allows process to be idenfified in htop
     pr_cont.set_name('kivy main') #allows process to be idenfified in htop
-    gh_db_dispatcher_test_app().run()
\ No newline at end of file
+    gh_db_dispatcher_test_app().run()
\ No newline at end of file
@@ -17,9 +17,28 @@ from kivy.properties import NumericProperty, BooleanProperty,\
     DictProperty, AliasProperty
 from kivy.graphics import Mesh, Color, Rectangle, Point
 import sys,traceback
+if gh_db_manager._numpy_ok:
+    import numpy as np
 
 MAX_RAW_POINTS=16000  #don't try to draw raw points for more than this much data
 
+'''array_px
+Vectorised version of Plot.x_px() and Plot.y_px() for NumPy arrays.
+Returns the pixel coordinates (xp,yp) of the points (x,y)
+'''
+def array_px(plot,x,y):
+    params=plot.params
+    size=params['size']
+    funcx=np.log10 if params['xlog'] else (lambda v: v)
+    funcy=np.log10 if params['ylog'] else (lambda v: v)
+    xmin=funcx(params['xmin'])
+    xmax=funcx(params['xmax'])
+    ymin=funcy(params['ymin'])
+    ymax=funcy(params['ymax'])
+    ratiox=(size[2]-size[0])/float(xmax-xmin)
+    ratioy=(size[3]-size[1])/float(ymax-ymin)
+    return ((funcx(x)-xmin)*ratiox+size[0],(funcy(y)-ymin)*ratioy+size[1])
+
 ''' Plotter for raw_data
     The maximum number of vertex instructions is around 30000, which
     is the limit to the number of points that can be plotted
@@ -39,6 +58,9 @@ class db_raw_line(kgraph.PointPlot):
         self.unbind(points=self.ask_draw)      
         
     def draw(self,*args):
+        if gh_db_manager._numpy_ok:
+            self._draw_array(*args)
+            return
         if self._db is not None and self.visible:
             self.points=self._db.get_raw_line(self.params['xmin'],self.params['xmax'])
         else:
@@ -51,6 +73,23 @@ class db_raw_line(kgraph.PointPlot):
             k1=round(0.5*(k+MAX_RAW_POINTS))
             self.points=self.points[k0:k1]
         super(db_raw_line,self).draw(*args)
+        
+    #as draw() but the data stays in NumPy arrays until it is handed to the Point
+    def _draw_array(self,*args):
+        if self._db is not None and self.visible:
+            data=self._db.get_raw_array(self.params['xmin'],self.params['xmax'])
+        else:
+            data=np.empty(0,dtype=gh_db_manager.RAW_DTYPE)
+        
+        #if it's too long, just display the centre
+        k=len(data)    
+        if k>MAX_RAW_POINTS:
+            k0=round(0.5*(k-MAX_RAW_POINTS))
+            k1=round(0.5*(k+MAX_RAW_POINTS))
+            data=data[k0:k1]
+        kgraph.Plot.draw(self,*args)  #clears the plot
+        (xp,yp)=array_px(self,data['ts'],data['val'])
+        self._point.points=np.column_stack((xp,yp)).ravel().tolist()
 
     def set_database(self,db):
         self._db=db
@@ -81,9 +120,16 @@ class db_comp_line(kgraph.Plot):
         return [self._grc]
 
     def draw(self, *args):
+        if gh_db_manager._numpy_ok:
+            self._draw_array(*args)
+            return
         #get data from the db
+        #use the coarsest rollup tier that still gives one period per pixel
         if (self._db is not None) and self.visible:
-            comp_data=self._db.get_comp_line(self.params['xmin'],self.params['xmax'])
+            size=self.params['size']
+            (self._Tchunk,comp_data)=self._db.get_tier_line(self.params['xmin'],\
+                                                            self.params['xmax'],\
+                                                            size[2]-size[0])
         else:
             comp_data=[]
            
@@ -144,6 +190,48 @@ class db_comp_line(kgraph.Plot):
         mesh_avg.vertices = vert_avg
         mesh_rect.vertices = vert_rect
         
+    #as draw() but the vertices are built from NumPy arrays in one go
+    def _draw_array(self, *args):
+        #get data from the db
+        #use the coarsest rollup tier that still gives one period per pixel
+        if (self._db is not None) and self.visible:
+            size=self.params['size']
+            (self._Tchunk,comp_data)=self._db.get_tier_array(self.params['xmin'],\
+                                                             self.params['xmax'],\
+                                                             size[2]-size[0])
+        else:
+            comp_data=np.empty(0,dtype=gh_db_manager.COMP_DTYPE)
+           
+        super(db_comp_line, self).draw(*args) #this clears the graph
+        
+        n=len(comp_data)
+        x1=comp_data['ts']
+        x0=x1-self._Tchunk
+        if n>0:
+            x0=np.maximum(x0,np.concatenate(([0],x1[:-1])))  #prevent overlap
+        (x0p,yavg)=array_px(self,x0,comp_data['avg'])
+        (x1p,ymin)=array_px(self,x1,comp_data['min'])
+        (x1p,ymax)=array_px(self,x1,comp_data['max'])
+        
+        #stepped line for average
+        vert_avg=np.zeros((n,8))
+        vert_avg[:,0]=x0p
+        vert_avg[:,1]=yavg
+        vert_avg[:,4]=x1p
+        vert_avg[:,5]=yavg
+        
+        #rectangles for min/max extents (built from two OpenGL triangles)
+        vert_rect=np.zeros((n,24))
+        for (col,x,y) in ((0,x0p,ymax),(4,x0p,ymin),(8,x1p,ymin),\
+                          (12,x0p,ymax),(16,x1p,ymax),(20,x1p,ymin)):
+            vert_rect[:,col]=x
+            vert_rect[:,col+1]=y
+            
+        self._mesh1.indices=list(range(n*2))
+        self._mesh2.indices=list(range(n*6))
+        self._mesh1.vertices=vert_avg.ravel().tolist()
+        self._mesh2.vertices=vert_rect.ravel().tolist()
+        
                
     def set_database(self,db):
         self._db=db
@@ -203,4 +291,4 @@ class gh_io_graph(kgraph.Graph):
             self.y_ticks_major=10.0
         
     
-    
\ No newline at end of file
+    
\ No newline at end of file
@@ -36,6 +36,7 @@ class gh_io_status_grid(BoxLayout):
         self.orientation='vertical'
         BoxLayout.__init__(self)
         self._all_op_desc=kwargs.get('all_op_desc',None)
+        self._series=kwargs.get('series',None)  #(tname,pname) of each series id.  See gh_db.get_series
         self._controls=dict()
         self._statuslabel=dict()
         self._desclabel=dict()
@@ -90,14 +91,16 @@ class gh_io_status_grid(BoxLayout):
     def set_webserver_newdata_fn(self,fn):
         self._webserver_newdata_fn=fn
     
+    #data is an IO_Sample
     def process_data(self,data):
+        (tname,pname)=self._series[data.sid]
         #update the value
-        self._controls[data['tname']][data['pname']].text=\
-                        '[b]'+'{0:.2f}'.format(data['data'])+'[/b]'
-        self._last_data[data['tname']][data['pname']]=\
-                        '{0:.2f}'.format(data['data'])                        
+        self._controls[tname][pname].text=\
+                        '[b]'+'{0:.2f}'.format(data.data)+'[/b]'
+        self._last_data[tname][pname]=\
+                        '{0:.2f}'.format(data.data)                        
         #pulse the LED to show progress
-        lbl=self._statuslabel[data['tname']][data['pname']]
+        lbl=self._statuslabel[tname][pname]
         lbl.color_on=LED_COL_BLUE_ON
         lbl.color_off=LED_COL_BLUE_OFF
         lbl.auto_off=True
@@ -106,8 +109,8 @@ class gh_io_status_grid(BoxLayout):
         #send data to webserver if it's connected
         if self._webserver_newdata_fn is not None:
             webdata=dict()      
-            webdata['val']=self._last_data[data['tname']][data['pname']]
-            webdata['i']=self._dataitemindex[data['tname']][data['pname']]
+            webdata['val']=self._last_data[tname][pname]
+            webdata['i']=self._dataitemindex[tname][pname]
             self._webserver_newdata_fn(webdata)
         
     def get_table_data(self):
@@ -0,0 +1,147 @@
+'''
+gh_ring
+
+Shared memory ring buffer for samples from gh_io to gh_db
+
+An alternative to io_q (a multiprocessing.Queue), which pickles every
+batch of sample dicts and pushes it through a pipe via a feeder thread.
+Here the samples are packed into fixed size records in a block of shared
+memory (multiprocessing.shared_memory) that both processes map.  They
+are the fields of io_thread.IO_Sample:-
+time - int64 - ms timestamp
+data - float64 - the data
+sid - uint32 - series id
+There is one producer (the gh_io main loop) and one consumer (gh_mon).
+
+Shared memory layout:-
+HEADER - head (records written) and tail (records read), on separate
+         cache lines as each is only written by one side
+records - RING_CAPACITY records.  Record n is at n % capacity
+
+The wakeup pipe
+Each put() writes its records, moves head on and then sends the new head
+down a one way multiprocessing.Pipe.  get() waits on the pipe and only
+reads records up to the head it has been sent.  The pipe write and read
+are system calls, so they also order the memory accesses between the
+processes (which matters on the Pi's ARM CPU), and get() never sees a
+record before it is complete.  That is one small message per batch
+instead of the whole batch.
+
+put() and get() behave as multiprocessing.Queue's, raising queue.Full
+and queue.Empty, so sample_ring can be passed to gh_io_main and gh_mon
+in place of io_q.  See gh_db (transport='ring').
+'''
+import queue
+import struct
+from time import sleep, monotonic
+from multiprocessing import Pipe, shared_memory
+from io_thread import IO_Sample
+
+RING_CAPACITY=4096      #records in the ring
+RING_PUT_TIMEOUT=1.0    #seconds put() waits for space before raising queue.Full
+
+REC=struct.Struct('<qdI4x')  #(time,data,sid) - padded to 24 bytes
+REC_SIZE=REC.size
+INDEX=struct.Struct('<Q')
+HEAD_OFFSET=0
+TAIL_OFFSET=64
+HEADER_SIZE=128
+
+'''sample_ring
+Create it in the consumer's process (gh_db) and pass it to the producer's
+process as an argument of multiprocessing.Process.  It is attached by
+name there.  Call unlink() once both have finished with it
+'''
+class sample_ring:
+    def __init__(self,capacity=RING_CAPACITY):
+        self._capacity=capacity
+        self._shm=shared_memory.SharedMemory(create=True,size=HEADER_SIZE+capacity*REC_SIZE)
+        self._buf=self._shm.buf
+        INDEX.pack_into(self._buf,HEAD_OFFSET,0)
+        INDEX.pack_into(self._buf,TAIL_OFFSET,0)
+        (self._wake_r,self._wake_w)=Pipe(duplex=False)
+        self._init_local()
+
+    #state that belongs to one side only
+    def _init_local(self):
+        self._head=None      #consumer: the last head sent down the pipe
+
+    #sent to the gh_io process with spawn.  With fork it is just inherited
+    def __getstate__(self):
+        return {'name':self._shm.name,'capacity':self._capacity,\
+                'wake_r':self._wake_r,'wake_w':self._wake_w}
+
+    def __setstate__(self,state):
+        self._capacity=state['capacity']
+        self._shm=shared_memory.SharedMemory(name=state['name'])
+        self._buf=self._shm.buf
+        self._wake_r=state['wake_r']
+        self._wake_w=state['wake_w']
+        self._init_local()
+
+    #the capacity, for queue stats
+    def get_capacity(self):
+        return self._capacity
+
+    '''
+        put
+        Producer.  Adds a list of IO_Sample.
+        Waits up to RING_PUT_TIMEOUT for space, then drops the batch and
+        raises queue.Full
+    '''
+    def put(self,batch):
+        if len(batch)==0:
+            return
+        head=INDEX.unpack_from(self._buf,HEAD_OFFSET)[0]
+        t_end=monotonic()+RING_PUT_TIMEOUT
+        while self._capacity-(head-INDEX.unpack_from(self._buf,TAIL_OFFSET)[0])<len(batch):
+            if monotonic()>=t_end:
+                raise queue.Full
+            sleep(0.01)
+        for sample in batch:
+            REC.pack_into(self._buf,HEADER_SIZE+(head%self._capacity)*REC_SIZE,\
+                          sample.time,float(sample.data),sample.sid)
+            head=head+1
+        INDEX.pack_into(self._buf,HEAD_OFFSET,head)
+        self._wake_w.send(head)
+
+    '''
+        get
+        Consumer.  Waits up to timeout seconds for samples and returns a
+        list of IO_Sample of everything written so far, or raises
+        queue.Empty
+    '''
+    def get(self,timeout=None):
+        tail=INDEX.unpack_from(self._buf,TAIL_OFFSET)[0]
+        t_end=None if timeout is None else monotonic()+timeout
+        while True:
+            while self._wake_r.poll():
+                self._head=self._wake_r.recv()
+            if self._head is not None and self._head!=tail:
+                break
+            if not self._wake_r.poll(None if t_end is None else max(0,t_end-monotonic())):
+                raise queue.Empty
+        batch=[]
+        #the records are in one or two runs, depending on whether they wrap
+        (i0,i1)=(tail%self._capacity,self._head%self._capacity)
+        if i1>i0:
+            runs=[(i0,i1)]
+        else:
+            runs=[(i0,self._capacity),(0,i1)]
+        for (i0,i1) in runs:
+            for (ts,val,sid) in REC.iter_unpack(self._buf[HEADER_SIZE+i0*REC_SIZE:HEADER_SIZE+i1*REC_SIZE]):
+                batch.append(IO_Sample(sid,ts,val))
+        INDEX.pack_into(self._buf,TAIL_OFFSET,self._head)
+        return batch
+
+    #records written but not yet read
+    def qsize(self):
+        return INDEX.unpack_from(self._buf,HEAD_OFFSET)[0]-INDEX.unpack_from(self._buf,TAIL_OFFSET)[0]
+
+    def close(self):
+        self._buf=None
+        self._shm.close()
+
+    #frees the shared memory.  Call once, from the process that created it
+    def unlink(self):
+        self._shm.unlink()
@@ -66,14 +66,45 @@ class gh_webserver(Thread):
             return render_template('graph1.html')
         
         #----------------------    
+        #the points are sent as two columns {'ts':[...],'val':[...]}, which
+        #the page pairs up, so no list is made per point
         @socketio.on('get_graph_raw_data')
         def get_graph_raw_data(tname,pname,xmin,xmax):
             db=self._db_manager.get_database(tname,pname)
-            data=db.get_raw_line(xmin,xmax)
+            if gh_db_manager._numpy_ok:
+                arr=db.get_raw_array(xmin,xmax)
+                data={'ts':arr['ts'].tolist(),'val':arr['val'].tolist()}
+            else:
+                rows=db.get_raw_line(xmin,xmax)
+                data={'ts':[row[0] for row in rows],'val':[row[1] for row in rows]}
             print('gh_webserver.get_graph_raw_data(',tname,',',pname,',',xmin,',',xmax,')')
             #self._log_fn('gh_webserver.get_graph_raw_data(',tname,',',pname,',',xmin,',',xmax,')')
             emit('on_graphrawdata',json.dumps(data))
         
+        #----------------------
+        #latest sample of every series, or the sample at or before ts (ms)
+        @socketio.on('get_latest_data')
+        def get_latest_data(ts=None):
+            if ts is None:
+                data=self._db_manager.get_latest_all()
+            else:
+                data=self._db_manager.as_of_all(ts)
+            emit('on_latestdata',json.dumps(data))
+        
+        #----------------------
+        #several series on the same time buckets.  series is a list of [tname,pname]
+        @socketio.on('get_aligned_data')
+        def get_aligned_data(series,xmin,xmax,bucket,mode='avg'):
+            series=[(tname,pname) for (tname,pname) in series]
+            (times,data)=self._db_manager.get_aligned(series,xmin,xmax,bucket,mode)
+            emit('on_aligneddata',json.dumps({'series':series,'times':times,'data':data}))
+        
+        #----------------------
+        #write path timings and queue lengths.  See gh_db.get_db_stats
+        @socketio.on('get_db_stats')
+        def get_db_stats():
+            emit('on_dbstats',json.dumps(self._gio.get_db_stats()))
+        
         #----------------------
         if __name__ == '__main__':
             self.socketio.run(self.app,
@@ -94,4 +125,4 @@ if __name__ == '__main__':
     server=gh_webserver()
     server.start()
     while True:
-        time.sleep(10)
\ No newline at end of file
+        time.sleep(10)
\ No newline at end of file
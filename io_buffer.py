@@ -12,10 +12,11 @@ import threading
 
 '''init
 all_op_desc=the output of io_thread_manager.get_all_op_descriptions
+series=the output of io_thread_manager.get_series_table
 
 '''
 class IO_Buffer:
-    def __init__(self,all_op_desc,buf_size):
+    def __init__(self,all_op_desc,buf_size,series):
         self._all_op_desc=all_op_desc
         self._buf=dict()
         self._buf_size=buf_size
@@ -26,6 +27,8 @@ class IO_Buffer:
             self._buf[tname]=dict()
             for pname in self._all_op_desc[tname]:  #for each output parameter                
                 self._buf[tname][pname]=deque(maxlen=self._buf_size)
+        #the same deques indexed by series id
+        self._sid_buf=[self._buf[tname][pname] for (tname,pname) in series]
             
     #Diagnostic to print out the buffer in a structured format        
     def printall(self):
@@ -40,10 +43,10 @@ class IO_Buffer:
                     print("    Buffer=",datapoints)
     
     #add_data must only ever be used in the main loop.  Never in a thread.
+    #d is an IO_Sample
     def add_data(self,d):
         with self._lock:
-            datapoint=(d['time'],d['data'])
-            self._buf[d['tname']][d['pname']].appendleft(datapoint)
+            self._sid_buf[d.sid].appendleft((d.time,d.data))
         
     #the lock can be used by any other threads to prevent writing
     #to do this, use get_lock() to get the lock and then acquire/release it
@@ -54,7 +57,7 @@ class IO_Buffer:
     '''get_databuffer(tname,pname)
     returns (n,datapoints) where n is the number of points and datapoints is
     the deque object.  The newest data is at the left.
-    data in the deque is in the format (time,data)
+    data in the deque is in the format (time,data) where time is a ms timestamp
     '''
     def get_databuffer(self,tname,pname):
         datapoints=self._buf[tname][pname]
@@ -72,4 +75,4 @@ class IO_Buffer:
         
         
     
-    
\ No newline at end of file
+    
\ No newline at end of file
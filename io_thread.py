@@ -39,11 +39,14 @@ winpos - window opener position
 
 
 The actual output data is pushed to the specified queue on the heartbeat.
-The format of the data is a dictionary as follows
-'tname'=name of the originating IO_Thread
-'time'=time of data
-'pname'=parameter name matching the descriptions above
-'data'=value of parameter
+The format of the data is an IO_Sample (a namedtuple) as follows
+sid=series id - a small integer standing for the thread name and parameter
+    name.  IO_Thread_Manager numbers them as threads are added and
+    get_series_table() gives the (tname,pname) of each
+time=time of data - integer ms timestamp
+data=value of parameter
+A sample is then just a tuple of three numbers.  There are no strings to
+copy or pickle, and consumers can look the series up by indexing a list.
 
 etc
 
@@ -69,6 +72,7 @@ from time import sleep
 from datetime import datetime, timedelta
 from threading import Thread
 from random import seed,random
+from collections import namedtuple
 import queue
 from io_buffer import IO_Buffer
 
@@ -78,6 +82,8 @@ import io_dht22
 from process_control import pr_cont
 import io_moist
 
+IO_Sample=namedtuple('IO_Sample',['sid','time','data'])  #see above
+
 #START class IO_Thread------------------------------------------------
 class IO_Thread(Thread):
 
@@ -101,6 +107,7 @@ class IO_Thread(Thread):
         self._threadname=kwargs.get('threadname','Unnamed Thread')
         self._op_desc=dict()
         self._set_op_desc() #set the parameter descriptions
+        self._sids=dict()   #pname -> series id.  Set by IO_Thread_Manager.add_thread
         
     def term(self):
         self.__running=False
@@ -203,14 +210,13 @@ class IO_Thread(Thread):
         
     def get_threadname(self):
         return self._threadname
+        
+    def set_sids(self,sids):
+        self._sids=sids
     
-    #adds the dictionary op_data to the queue, tagging on the standard extras
+    #adds an IO_Sample to the queue.  triggertime is a datetime
     def _add_to_out_q(self,pname,data,triggertime):
-        op_data=dict()
-        op_data['tname']=self._threadname
-        op_data['time']=triggertime
-        op_data['pname']=pname
-        op_data['data']=data
+        op_data=IO_Sample(self._sids[pname],round(triggertime.timestamp()*1000),data)
         try:
             self._out_q.put(op_data,block=False)
         except queue.Full:  #consumer must have stopped - throw data away
@@ -472,6 +478,7 @@ class IO_Thread_Manager:
     '''
     def __init__(self,sim_hw):
         self._threads=[]
+        self._series=[]   #(tname,pname) of each series id
         self._sim_hw=sim_hw
         self._start_pigpio()
         seed(1)    #for random number gen
@@ -491,16 +498,22 @@ class IO_Thread_Manager:
     
     '''add_thread
     #t =  Instance of IO_Thread (or object derived from it) to add
+    Each of its output parameters is given the next series id
     '''    
     def add_thread(self,t):
         self._threads.append(t)
+        sids=dict()
+        for pname in t.get_op_desc():
+            sids[pname]=len(self._series)
+            self._series.append((t.get_threadname(),pname))
+        t.set_sids(sids)
                     
     '''
         Start all the threads
         At this point we can add an io buffer, iob
     '''             
     def start_threads(self):
-        self._iob=IO_Buffer(self.get_all_op_descriptions(),10)
+        self._iob=IO_Buffer(self.get_all_op_descriptions(),10,self.get_series_table())
         for t in self._threads:
             t.set_iob(self._iob)
             if not self._sim_hw:
@@ -530,7 +543,14 @@ class IO_Thread_Manager:
         for t in self._threads:
             all_op_desc[t.get_threadname()]=t.get_op_desc()
         return all_op_desc
+    
+    '''series=get_series_table()
+    Returns a list of (tname,pname) indexed by series id - the sid of an
+    IO_Sample.  It is sent to the host with the SERIES? command
+    '''
+    def get_series_table(self):
+        return list(self._series)
         
 #END class IO_Thread_Manager------------------------------------------------        
     
-        
\ No newline at end of file
+        
\ No newline at end of file